@@ -11,8 +11,34 @@ Since: 2019-08
 """
 
 
+import bisect, copy, heapq, operator
+
 MAX_VALUE=100000000    # an upper bound (not necessarily tight) on the agents' values.
 
+
+def random_generator(seed=None):
+    """
+    :param seed: a seed, or a numpy.random.Generator (returned as-is).
+                 If None, the seed is drawn from the `random` module,
+                 so that seeding `random` (e.g. by experiment_runner) makes the generated values reproducible.
+    :return: a numpy.random.Generator.
+
+    >>> import random
+    >>> random.seed(1); a = random_generator().integers(100, size=3).tolist()
+    >>> random.seed(1); b = random_generator().integers(100, size=3).tolist()
+    >>> a == b
+    True
+    >>> generator = random_generator(1)
+    >>> random_generator(generator) is generator
+    True
+    """
+    import numpy, random
+    if isinstance(seed, numpy.random.Generator):
+        return seed
+    if seed is None:
+        seed = random.getrandbits(64)
+    return numpy.random.default_rng(seed)
+
 class AgentCategory:
     """
     Represents a category of single-parametric agents in a market, for example: "buyers".
@@ -36,20 +62,141 @@ class AgentCategory:
     >>> a.append([3.2,3.8])
     >>> str(a)
     'buyer: [4, 3.8, 3.5, 3.2, 3]'
+
+    >>> a = AgentCategory("seller", [-1,-6,-3,-7], storage="array")
+    >>> str(a)
+    'seller: [-1, -3, -6, -7]'
+    >>> a.remove_highest_agents(2)
+    >>> a.remove_lowest_agent()
+    >>> str(a), a.size(), a.highest_agent_value()
+    ('seller: [-6]', 1, -6)
     """
-    def __init__(self, name:str, values:list):
+    def __init__(self, name:str, values:list, storage:str="list"):
+        """
+        :param name:    the category name, e.g. "buyer".
+        :param values:  the values of the agents in this category (in any order).
+        :param storage: "list" (default) keeps the values in a Python list;
+                        "array" keeps them in a NumPy array, which is more compact for very large categories.
+        In both cases, removing the highest or lowest agent only moves an offset - no memory is shifted.
+        """
+        if storage not in ("list", "array"):
+            raise ValueError("Unknown storage {}; should be 'list' or 'array'".format(storage))
         self.name = name
-        self.values = list(values)
-        self.values.sort(reverse=True)
+        self.storage = storage
+        if storage == "array":
+            import numpy
+            self._buffer = numpy.sort(numpy.asarray(values))[::-1]
+        else:
+            self._buffer = values.tolist() if hasattr(values, "tolist") else list(values)   # a NumPy array becomes a list of Python numbers
+            self._buffer.sort(reverse=True)
+        self._head = 0      # number of highest agents removed from the start of the buffer
+        self._trimmed = 0   # number of lowest agents removed from the end of the buffer
+        self._shared = False  # whether the buffer may be shared with clones; if so, it is copied before any in-place change
+        self.version = 0      # incremented whenever the values may change; used by callers that cache computations on the values
+
+    @staticmethod
+    def from_sorted(name:str, values:list, check:bool=False):
+        """
+        A fast constructor for values that are already sorted in descending order:
+        the values are used as-is, without copying or sorting.
+        :param name:   the category name, e.g. "buyer".
+        :param values: a list or a NumPy array, sorted in descending order.
+                       A NumPy array is kept with the "array" storage.
+                       The category never changes the given values in-place; it copies them first.
+        :param check:  if True, verify that the values are indeed sorted (takes O(n) time).
+
+        >>> str(AgentCategory.from_sorted("buyer", [9, 7, 6]))
+        'buyer: [9, 7, 6]'
+        >>> import numpy
+        >>> a = AgentCategory.from_sorted("seller", numpy.array([-1, -3, -6]), check=True)
+        >>> a.storage, str(a)
+        ('array', 'seller: [-1, -3, -6]')
+        >>> AgentCategory.from_sorted("buyer", [6, 7, 9], check=True)
+        Traceback (most recent call last):
+        ...
+        ValueError: The values of buyer are not sorted in descending order
+        """
+        category = AgentCategory.__new__(AgentCategory)
+        category.name = name
+        if isinstance(values, list):
+            category.storage = "list"
+            category._shared = True   # the list belongs to the caller - do not change it in-place
+        elif hasattr(values, "dtype"):
+            category.storage = "array"
+            category._shared = False
+        else:
+            category.storage = "list"
+            category._shared = False
+            values = list(values)
+        category._buffer = values
+        category._head = category._trimmed = 0
+        category.version = 0
+        if check:
+            is_sorted = (bool((values[:-1] >= values[1:]).all()) if category.storage == "array"
+                         else all(a >= b for (a, b) in zip(values, values[1:])))
+            if not is_sorted:
+                raise ValueError("The values of {} are not sorted in descending order".format(name))
+        return category
+
+    @property
+    def values(self)->list:
+        """
+        The values of the remaining agents, as a new list sorted in descending order.
+        Reading this property does not change the category, and changing the returned list does not change the category;
+        to modify the values in-place, use values_for_update.
+
+        >>> a = AgentCategory("buyer", [1,6,3], storage="array")
+        >>> a.values.append(0); a.values, a.storage, a.version
+        ([6, 3, 1], 'array', 0)
+        """
+        return self._remaining_values()
+
+    @values.setter
+    def values(self, values:list):
+        self.version += 1
+        self._buffer = values
+        self.storage = "list"
+        self._head = self._trimmed = 0
+        self._shared = False
+
+    def values_for_update(self)->list:
+        """
+        The values of the remaining agents, as a list sorted in descending order, that can be modified in-place
+        (the caller must keep it sorted).
+        It compacts the storage into a plain list that is not shared with any clone, and increments the version.
+
+        >>> a = AgentCategory("buyer", [1,6,3])
+        >>> a.values_for_update().pop(); str(a)
+        1
+        'buyer: [6, 3]'
+        """
+        self.version += 1
+        if self.storage == "array" or self._head > 0 or self._trimmed > 0 or self._shared:
+            self._buffer = self._remaining_values()
+            self.storage = "list"
+            self._head = self._trimmed = 0
+            self._shared = False
+        return self._buffer
+
+    def _end(self)->int:
+        return len(self._buffer) - self._trimmed
+
+    def _remaining_values(self)->list:
+        remaining = self._buffer[self._head:self._end()]
+        return remaining.tolist() if self.storage == "array" else remaining
+
+    def _check_size(self, count:int):
+        if count > self.size():
+            raise IndexError("{} has {} agents but {} are required".format(self.name, self.size(), count))
 
     def size(self):
-        return len(self.values)
+        return len(self._buffer) - self._head - self._trimmed
 
     def __len__(self):
-        return len(self.values)
+        return self.size()
 
     def __str__(self)->str:
-        return "{}: {}".format(self.name, self.values)
+        return "{}: {}".format(self.name, self._remaining_values())
 
     def __repr__(self)->str:
         return self.__str__()
@@ -58,57 +205,214 @@ class AgentCategory:
         """
         Adds an agent with the given value to the category.
         Keeps the values sorted in descending order.
-        :param value: the value of the new agent.
+        :param value: the value of the new agent, or a list of values of new agents.
+        A single value is inserted at its place in O(log n) comparisons;
+        a list of values is sorted and merged with the existing values in O(n + m log m).
+
+        >>> a = AgentCategory("buyer", [9, 7, 5, 3])
+        >>> a.remove_highest_agent(); a.remove_lowest_agent()
+        >>> a.append(8); a.append(1); a.append(6)
+        >>> str(a)
+        'buyer: [8, 7, 6, 5, 1]'
+        >>> a = AgentCategory("buyer", [9, 7, 5, 3], storage="array")
+        >>> a.append(6); a.append([8, 2]); a.append(4.5)
+        >>> str(a)
+        'buyer: [9.0, 8.0, 7.0, 6.0, 5.0, 4.5, 3.0, 2.0]'
         """
+        self.version += 1
         if isinstance(value, list):
-            self.values += value
+            if len(value) == 1:
+                self._insert(value[0])
+            elif len(value) > 1:
+                self._merge(value)
+        else:
+            self._insert(value)
+
+    def _insert(self, value:float):
+        end = self._end()
+        if self.storage == "array":
+            import numpy
+            if numpy.result_type(self._buffer.dtype, value) != self._buffer.dtype:
+                self._merge([value])
+                return
+            remaining = self._buffer[self._head:end]
+            position = len(remaining) - numpy.searchsorted(remaining[::-1], value)
+            self._buffer = numpy.insert(remaining, position, value)
+            self._head = self._trimmed = 0
+            return
+        if self._shared:
+            self._unshare()
+            end = self._end()
+        position = bisect.bisect_left(self._buffer, -value, lo=self._head, hi=end, key=operator.neg)
+        if position == self._head and self._head > 0:    # re-use a slot of a removed highest agent
+            self._head -= 1
+            self._buffer[self._head] = value
+        elif position == end and self._trimmed > 0:      # re-use a slot of a removed lowest agent
+            self._buffer[end] = value
+            self._trimmed -= 1
+        else:
+            self._buffer.insert(position, value)
+
+    def _merge(self, values:list):
+        if self.storage == "array":
+            import numpy
+            new_values = numpy.concatenate((self._buffer[self._head:self._end()], numpy.asarray(values)))
+            self._buffer = numpy.sort(new_values, kind="stable")[::-1]
+        else:
+            new_values = sorted(values, reverse=True)
+            merged_values = heapq.merge(self._remaining_values(), new_values, reverse=True)
+            if self._shared:
+                self._buffer = list(merged_values)
+                self._shared = False
+            else:
+                self._buffer[:] = merged_values
+        self._head = self._trimmed = 0
+
+    def remove(self, value:float):
+        """
+        Removes one agent with the given value from the category.
+        The agent is found in O(log n) comparisons.
+
+        >>> a = AgentCategory("buyer", [9, 7, 7, 3])
+        >>> b = a.clone()
+        >>> a.remove(7); a.remove(3)
+        >>> str(a), str(b)
+        ('buyer: [9, 7]', 'buyer: [9, 7, 7, 3]')
+        >>> a = AgentCategory("seller", [-1, -6, -3], storage="array")
+        >>> a.remove(-3); str(a)
+        'seller: [-1, -6]'
+        >>> a.remove(-2)
+        Traceback (most recent call last):
+        ...
+        ValueError: seller has no agent with value -2
+        """
+        end = self._end()
+        if self.storage == "array":
+            import numpy
+            remaining = self._buffer[self._head:end]
+            position = len(remaining) - int(numpy.searchsorted(remaining[::-1], value, side="right"))
+            if position >= len(remaining) or remaining[position] != value:
+                raise ValueError("{} has no agent with value {}".format(self.name, value))
+            self._buffer = numpy.delete(remaining, position)
+            self._head = self._trimmed = 0
         else:
-            self.values.append(value)
-        self.values.sort(reverse=True)
+            position = bisect.bisect_left(self._buffer, -value, lo=self._head, hi=end, key=operator.neg)
+            if position >= end or self._buffer[position] != value:
+                raise ValueError("{} has no agent with value {}".format(self.name, value))
+            if self._shared:
+                position -= self._head
+                self._unshare()
+            del self._buffer[position]
+        self.version += 1
+
+    def _unshare(self):
+        """
+        Copy-on-write: give this category its own copy of a list buffer that may be shared with clones.
+        Array buffers are never changed in-place, so they can stay shared.
+        """
+        self._buffer = self._buffer[self._head:self._end()]
+        self._head = self._trimmed = 0
+        self._shared = False
 
 
     def highest_agent_value(self)->float:
         """
         :return: the highest value of an agent in this category.
         """
-        return self.values[0]  # Assumes the values are sorted
+        self._check_size(1)
+        value = self._buffer[self._head]  # Assumes the values are sorted
+        return value.item() if self.storage == "array" else value
 
     def highest_agent_values(self, count:int)->list:
         """
         :return: the highest 'count' value of agents in this category.
         """
-        return self.values[0:count]  # Assumes the values are sorted
+        highest = self._buffer[self._head:min(self._head+count, self._end())]  # Assumes the values are sorted
+        return highest.tolist() if self.storage == "array" else highest
+
+    def highest_agent_values_array(self, count:int):
+        """
+        :return: the highest 'count' values of agents in this category, as a NumPy array.
+        With the "array" storage, this is a view into the buffer - no values are copied.
+
+        >>> AgentCategory("buyer", [1,6,3,7], storage="array").highest_agent_values_array(3)
+        array([7, 6, 3])
+        """
+        import numpy
+        highest = self._buffer[self._head:min(self._head+count, self._end())]  # Assumes the values are sorted
+        return highest if self.storage == "array" else numpy.array(highest)
 
     def lowest_agent_value(self)->float:
         """
         :return: the lowest value of an agent in this category.
         """
-        return self.values[-1]  # Assumes the values are sorted
+        self._check_size(1)
+        value = self._buffer[self._end()-1]  # Assumes the values are sorted
+        return value.item() if self.storage == "array" else value
+
+    def agent_value(self, index:int)->float:
+        """
+        :return: the value of the index-th highest agent in this category (the highest is index 0).
+
+        >>> AgentCategory("buyer", [1,6,3,7]).agent_value(2)
+        3
+        """
+        if not 0 <= index < self.size():
+            raise IndexError("{} has {} agents; index {} is out of range".format(self.name, self.size(), index))
+        value = self._buffer[self._head + index]
+        return value.item() if self.storage == "array" else value
 
     def remove_highest_agent(self):
         """
         Removes the highest-valued agent from this category.
         :return:
         """
-        self.values.pop(0)
+        self._check_size(1)
+        self._head += 1
+        self.version += 1
 
     def remove_highest_agents(self, count:int):
         """
         Removes the 'count' highest-valued agents from this category.
         """
-        # del self.values[0:count]
-        for i in range(count):
-            self.values.pop(0)
+        self._check_size(count)
+        self._head += count
+        self.version += 1
 
     def remove_lowest_agent(self):
         """
         Removes the lowest-valued agent from this category.
         :return:
         """
-        self.values.pop(-1)
+        self._check_size(1)
+        self._trimmed += 1
+        self.version += 1
+
+    def remove_lowest_agents(self, count:int):
+        """
+        Removes the 'count' lowest-valued agents from this category.
+        """
+        self._check_size(count)
+        self._trimmed += count
+        self.version += 1
 
     def clone(self):
-        return AgentCategory(self.name, self.values)
+        """
+        Create a copy of this category in O(1) time.
+        The copy shares the sorted buffer with this category, and has its own head and tail offsets.
+        The buffer is copied only when one of them is about to change it in-place.
+
+        >>> a = AgentCategory("buyer", [1,6,3,7,4,9])
+        >>> b = a.clone()
+        >>> a.remove_highest_agent(); b.remove_lowest_agent(); b.append(8)
+        >>> str(a), str(b)
+        ('buyer: [7, 6, 4, 3, 1]', 'buyer: [9, 8, 7, 6, 4, 3]')
+        >>> a.values_for_update().append(0); str(a), str(b)
+        ('buyer: [7, 6, 4, 3, 1, 0]', 'buyer: [9, 8, 7, 6, 4, 3]')
+        """
+        clone = copy.copy(self)
+        clone._shared = self._shared = True
+        return clone
 
 
 
@@ -137,6 +441,53 @@ class AgentCategory:
         return AgentCategory(name, values)
 
 
+    # The following variants draw all the values of a category with a single NumPy call.
+    # They return categories with the "array" storage, whose values are an int64 array rounded like `round`
+    # (halves to even) and sorted once. The values follow the same distributions as above,
+    # but are not the same numbers as those drawn by the `random` module.
+    # :param seed: a seed or a numpy.random.Generator; see random_generator.
+
+    @staticmethod
+    def uniformly_random_array(name:str, num_of_agents:int, min_value:float, max_value:float, seed=None):
+        """
+        >>> a = AgentCategory.uniformly_random_array("buyer", 5, 10, 20, seed=1)
+        >>> a.storage, a.size(), all(10 <= value <= 20 for value in a.values), a.values == sorted(a.values, reverse=True)
+        ('array', 5, True, True)
+        >>> str(a) == str(AgentCategory.uniformly_random_array("buyer", 5, 10, 20, seed=1))
+        True
+        """
+        values = random_generator(seed).uniform(min_value, max_value, num_of_agents)
+        return AgentCategory._from_random_values(name, values)
+
+    @staticmethod
+    def normalvariate_random_array(name: str, num_of_agents: int, sign_multiple: float, mu, sigma, seed=None):
+        """
+        >>> a = AgentCategory.normalvariate_random_array("seller", 4, -1, 100, 10, seed=1)
+        >>> a.size(), all(value <= 0 for value in a.values)
+        (4, True)
+        """
+        values = sign_multiple * abs(random_generator(seed).normal(mu, sigma, num_of_agents))
+        return AgentCategory._from_random_values(name, values)
+
+    @staticmethod
+    def gammavariate_random_array(name: str, num_of_agents: int, sign_multiple: float, alpha, beta, seed=None):
+        values = sign_multiple * abs(random_generator(seed).gamma(alpha, beta, num_of_agents))
+        return AgentCategory._from_random_values(name, values)
+
+    @staticmethod
+    def paretovariate_random_array(name: str, num_of_agents: int, sign_multiple: float, alpha, seed=None):
+        # numpy's pareto is shifted to start at 0; random.paretovariate starts at 1.
+        values = sign_multiple * abs(random_generator(seed).pareto(alpha, num_of_agents) + 1)
+        return AgentCategory._from_random_values(name, values)
+
+    @staticmethod
+    def _from_random_values(name:str, values):
+        import numpy
+        values = numpy.rint(values).astype(numpy.int64)
+        values.sort()
+        return AgentCategory.from_sorted(name, values[::-1])
+
+
 class EmptyCategoryException(Exception):
     pass
 
@@ -9,16 +9,17 @@ Since:  2019-08
 """
 
 from agents import AgentCategory, EmptyCategoryException, MAX_VALUE
-from markets import Market
-from trade import TradeWithSinglePrice
-import prices
+from markets import Market, batch_categories, batch_optimal_trade
+from trade import TradeWithSinglePrice, BatchTradeWithSinglePrice
+import prices, tracing
 from prices import AscendingPriceVector, PriceStatus
 
-import math, logging, sys
+import math, logging, numpy, sys
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 # logger.setLevel(logging.INFO)
 # To enable tracing, set logger.setLevel(logging.INFO)
+# To record the price changes as structured events, run the auction inside "with tracing.TraceBuffer() as trace:"
 
 
 def budget_balanced_ascending_auction(market:Market, ps_recipe: list, max_iterations=999999999)->TradeWithSinglePrice:
@@ -100,23 +101,41 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe: list, max_iterat
 
     logger.info("\n#### Budget-Balanced Ascending Auction\n")
     logger.info(market)
-    logger.info("Procurement-set recipe: {}".format(ps_recipe))
+    logger.info("Procurement-set recipe: %s", ps_recipe)
 
-    optimal_trade = market.optimal_trade(ps_recipe, max_iterations=max_iterations)[0]
-    logger.info("For comparison, the optimal trade is: %s\n", optimal_trade)
+    if logger.isEnabledFor(logging.INFO):
+        optimal_trade = market.optimal_trade(ps_recipe, max_iterations=max_iterations)[0]
+        logger.info("For comparison, the optimal trade is: %s\n", optimal_trade)
 
     remaining_market = market.clone()
+    if logger.isEnabledFor(logging.INFO) or tracing.active_trace is not None:
+        prices = ascend_step_by_step(remaining_market, ps_recipe, relevant_category_indices)
+    else:
+        prices = ascend_to_stopping_point(remaining_market, ps_recipe, relevant_category_indices)
+
+    logger.info(remaining_market)
+    return TradeWithSinglePrice(remaining_market.categories, ps_recipe, prices.prices)
+
+
+def ascend_step_by_step(remaining_market:Market, ps_recipe:list, relevant_category_indices:list)->AscendingPriceVector:
+    """
+    Run the ascending auction one agent at a time, logging each step and recording it in the active trace.
+    Removes from remaining_market the agents that leave the auction.
+    :return: the final price-vector.
+    """
     prices = AscendingPriceVector(ps_recipe, -MAX_VALUE)
 
     # Functions for calculating the number of potential PS that can be supported by a category:
     fractional_potential_ps = lambda category_index: remaining_market.categories[category_index].size() / ps_recipe[category_index]
     integral_potential_ps   = lambda category_index: math.floor(remaining_market.categories[category_index].size() / ps_recipe[category_index])
 
+    trace = tracing.active_trace
+    iteration = 0
     while True:
         # find a category with a largest number of potential PS, and increase its price
         main_category_index = max(relevant_category_indices, key=fractional_potential_ps)
         main_category = remaining_market.categories[main_category_index]
-        logger.info("Chosen category: {} with {} agents and ratio {}".format(main_category.name, main_category.size(), fractional_potential_ps(main_category_index)))
+        logger.info("Chosen category: %s with %d agents and ratio %s", main_category.name, main_category.size(), fractional_potential_ps(main_category_index))
 
         if main_category.size() == 0:
             logger.info("\nThe %s category became empty - no trade!", main_category.name)
@@ -125,17 +144,234 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe: list, max_iterat
 
         prices.increase_price_up_to_balance(main_category_index, main_category.lowest_agent_value(), main_category.name)
         if prices.status == PriceStatus.STOPPED_AT_ZERO_SUM:
+            if trace is not None:
+                trace.record(iteration, main_category_index, prices[main_category_index], main_category.size())
             logger.info("\nPrice crossed zero.")
             logger.info("  Final price-per-unit vector: %s", prices)
             break
 
         main_category.remove_lowest_agent()
-        logger.info("  {} price increases to {}: {} agents and ratio {}".format(main_category.name, prices[main_category_index], main_category.size(), fractional_potential_ps(main_category_index)))
-
-    logger.info(remaining_market)
-    return TradeWithSinglePrice(remaining_market.categories, ps_recipe, prices.prices)
+        if trace is not None:
+            trace.record(iteration, main_category_index, prices[main_category_index], main_category.size())
+        logger.info("  %s price increases to %s: %d agents and ratio %s", main_category.name, prices[main_category_index], main_category.size(), fractional_potential_ps(main_category_index))
+        iteration += 1
+    return prices
 
 
+def ascend_to_stopping_point(remaining_market:Market, ps_recipe:list, relevant_category_indices:list)->AscendingPriceVector:
+    """
+    Compute the outcome of ascend_step_by_step directly, without simulating the auction one agent at a time.
+
+    At each step, the auction removes the lowest agent of the category with the largest ratio size/ps_recipe[i]
+    (the first such category on ties). So the step in which category m goes from size s to size s-1
+    comes after all steps of category i at sizes s' with s'/ps_recipe[i] > s/ps_recipe[m]
+    (or >=, for i before m). This determines how many agents each category lost before any given step,
+    hence the price-vector at that step: the price of a category is the value of its latest removed agent.
+    The price-sum only increases along the steps, so for each category, the first of its steps
+    in which the price-sum reaches zero is found by binary search; the auction stops at the earliest of these steps.
+    Total time is O(k^2 log n) for k categories with at most n agents each.
+
+    Removes from remaining_market the agents that leave the auction.
+    :return: the final price-vector.
+
+    >>> market = Market([AgentCategory("buyer", [17, 14, 13, 9, 6]), AgentCategory("mediator", [-1, -3, -4, -7, -10]), AgentCategory("seller", [-1, -4, -5, -8, -11])])
+    >>> prices = ascend_to_stopping_point(market, [1,1,1], [0,1,2])
+    >>> prices.prices, prices.status
+    ([13, -5.0, -8], <PriceStatus.STOPPED_AT_ZERO_SUM: 2>)
+    >>> print(market)
+    Traders: [buyer: [17, 14], mediator: [-1, -3, -4], seller: [-1, -4, -5]]
+    """
+    categories = remaining_market.categories
+    num_categories = len(categories)
+    sizes = [category.size() for category in categories]
+
+    def removed_counts(main_category_index:int, main_category_size:int)->list:
+        # The number of agents removed from each category before main_category goes down from main_category_size.
+        main_count = ps_recipe[main_category_index]
+        counts = [0] * num_categories
+        for i in relevant_category_indices:
+            if i == main_category_index:
+                counts[i] = sizes[i] - main_category_size
+            else:
+                product = main_category_size * ps_recipe[i]
+                remaining_size = (product - 1) // main_count if i < main_category_index else product // main_count
+                counts[i] = max(0, sizes[i] - remaining_size)
+        return counts
+
+    def prices_after_removal(counts:list)->AscendingPriceVector:
+        return AscendingPriceVector(ps_recipe, [
+            categories[i].agent_value(sizes[i] - counts[i]) if counts[i] > 0 else -MAX_VALUE
+            for i in range(num_categories)])
+
+    def crosses_zero(main_category_index:int, main_category_size:int)->bool:
+        prices = prices_after_removal(removed_counts(main_category_index, main_category_size))
+        new_price = categories[main_category_index].agent_value(main_category_size - 1)
+        return prices.price_sum_after_increase(main_category_index, new_price) >= 0
+
+    # For each category, find its largest size at which increasing its price makes the price-sum cross zero:
+    stop = None   # (category index, category size) of the earliest step in which the price-sum crosses zero.
+    for m in relevant_category_indices:
+        if sizes[m] == 0 or not crosses_zero(m, 1):
+            continue
+        (low, high) = (1, sizes[m])   # crosses_zero(m, low) is True
+        while low < high:
+            middle = (low + high + 1) // 2
+            if crosses_zero(m, middle):
+                low = middle
+            else:
+                high = middle - 1
+        if stop is None:
+            stop = (m, low)
+        else:   # the earlier step is the one with the larger ratio size/recipe (the earlier category on ties)
+            (stop_index, stop_size) = stop
+            if low * ps_recipe[stop_index] > stop_size * ps_recipe[m]:
+                stop = (m, low)
+
+    if stop is None:   # all categories became empty - no trade
+        counts = [sizes[i] if ps_recipe[i] > 0 else 0 for i in range(num_categories)]
+        prices = prices_after_removal(counts)
+        if sum(counts) > 0:
+            prices.status = PriceStatus.STOPPED_AT_AGENT_VALUE
+    else:
+        (main_category_index, main_category_size) = stop
+        counts = removed_counts(main_category_index, main_category_size)
+        prices = prices_after_removal(counts)
+        main_category = categories[main_category_index]
+        prices.increase_price_up_to_balance(main_category_index, main_category.agent_value(main_category_size - 1), main_category.name)
+    for (category, count) in zip(categories, counts):
+        category.remove_lowest_agents(count)
+    return prices
+
+
+
+def budget_balanced_ascending_auction_batch(values, ps_recipe:list)->BatchTradeWithSinglePrice:
+    """
+    Runs budget_balanced_ascending_auction on many markets of the same shape at once.
+    This is the batch version of ascend_to_stopping_point: since all markets have the same category sizes,
+    the binary searches for the stopping step of each category run in lock-step on all markets,
+    with arrays of the removed counts, the prices and the price-sums of all markets.
+    The price-sums are calculated like in AscendingPriceVector (with compensated summation), so the results are the same also for float values.
+    :param values: the values of the markets - a list with an array of shape (num_of_markets, n_i) per category,
+                   or an array of shape (num_of_markets, num_of_categories, n); see markets.batch_categories.
+                   The values of each category in each market should be sorted in descending order.
+    :param ps_recipe: a list of integers, one integer per category.
+    :return: a BatchTradeWithSinglePrice, whose entry m is equal to the result of budget_balanced_ascending_auction on market m,
+             with the optimal count and GFT of each market.
+
+    >>> values = [numpy.array([[9., 8.], [9., 8.], [9., 4.]]), numpy.array([[-3., -4.], [-7., -8.], [-3., -8.]])]
+    >>> trade = budget_balanced_ascending_auction_batch(values, [1,1])
+    >>> trade.num_of_deals().tolist(), trade.prices.tolist()
+    ([1, 1, 1], [[8.0, -8.0], [8.0, -8.0], [8.0, -8.0]])
+
+    The results are the same as those of budget_balanced_ascending_auction on each market:
+
+    >>> generator = numpy.random.default_rng(1)
+    >>> values = [-numpy.sort(-generator.integers(0, 100, (200, 10))), -numpy.sort(-generator.integers(-50, 0, (200, 20)))]
+    >>> trade = budget_balanced_ascending_auction_batch(values, [1,2])
+    >>> single_trades = [budget_balanced_ascending_auction(Market([AgentCategory("buyer", values[0][m]), AgentCategory("seller", values[1][m])]), [1,2]) for m in range(200)]
+    >>> all(single.num_of_deals() == trade.num_of_deals()[m] and single.gain_from_trade() == trade.gain_from_trade()[m]
+    ...     and single.gain_from_trade(including_auctioneer=False) == trade.gain_from_trade(including_auctioneer=False)[m]
+    ...     for (m, single) in enumerate(single_trades))
+    True
+    """
+    categories = batch_categories(values, ps_recipe)
+    num_of_markets = categories[0].shape[0]
+    num_categories = len(categories)
+    sizes = [category.shape[1] for category in categories]
+    relevant_category_indices = [i for i in range(num_categories) if ps_recipe[i]>0]
+    markets = numpy.arange(num_of_markets)
+
+    def removed_counts(main_category_index:int, main_category_sizes)->list:
+        # The number of agents removed from each category before main_category goes down from main_category_sizes (one size per market).
+        main_count = ps_recipe[main_category_index]
+        counts = [numpy.zeros_like(main_category_sizes) for _ in range(num_categories)]
+        for i in relevant_category_indices:
+            if i == main_category_index:
+                counts[i] = sizes[i] - main_category_sizes
+            else:
+                product = main_category_sizes * ps_recipe[i]
+                remaining_sizes = (product - 1) // main_count if i < main_category_index else product // main_count
+                counts[i] = numpy.maximum(0, sizes[i] - remaining_sizes)
+        return counts
+
+    def prices_after_removal(rows, counts:list)->tuple:
+        # The prices of the given markets after the given removals, and their price-sums (as in AscendingPriceVector).
+        prices = []
+        for i in range(num_categories):
+            if sizes[i] == 0:
+                prices.append(numpy.full(len(rows), -MAX_VALUE, dtype=categories[i].dtype))
+            else:
+                latest_removed_values = categories[i][rows, numpy.minimum(sizes[i] - counts[i], sizes[i] - 1)]
+                prices.append(numpy.where(counts[i] > 0, latest_removed_values, -MAX_VALUE))
+        price_sum = numpy.zeros(len(rows), dtype=numpy.result_type(*prices))
+        price_sum_error = numpy.zeros_like(price_sum)
+        for (weight, price) in zip(ps_recipe, prices):
+            (price_sum, price_sum_error) = _add_to_price_sums(price_sum, price_sum_error, weight*price)
+        return (prices, price_sum, price_sum_error)
+
+    def price_sums_without_category(prices:list, price_sum, price_sum_error, category_index:int):
+        return (price_sum - ps_recipe[category_index]*prices[category_index]) + price_sum_error
+
+    def crosses_zero(rows, main_category_index:int, main_category_sizes):
+        prices_and_sums = prices_after_removal(rows, removed_counts(main_category_index, main_category_sizes))
+        new_prices = categories[main_category_index][rows, main_category_sizes - 1]
+        return price_sums_without_category(*prices_and_sums, main_category_index) + ps_recipe[main_category_index]*new_prices >= 0
+
+    # For each category, find its largest size at which increasing its price makes the price-sum cross zero:
+    stop_index = numpy.full(num_of_markets, -1)   # (category index, category size) of the earliest step in which the price-sum crosses zero.
+    stop_size = numpy.zeros(num_of_markets, dtype=int)
+    for m in relevant_category_indices:
+        if sizes[m] == 0:
+            continue
+        crosses = crosses_zero(markets, m, numpy.ones(num_of_markets, dtype=int))
+        (low, high) = (numpy.ones(num_of_markets, dtype=int), numpy.where(crosses, sizes[m], 1))   # crosses_zero(m, low) is True
+        while True:
+            searching = markets[low < high]
+            if len(searching) == 0:
+                break
+            middle = (low[searching] + high[searching] + 1) // 2
+            middle_crosses = crosses_zero(searching, m, middle)
+            low[searching] = numpy.where(middle_crosses, middle, low[searching])
+            high[searching] = numpy.where(middle_crosses, high[searching], middle - 1)
+        recipe_of_stop = numpy.array(ps_recipe)[numpy.maximum(stop_index, 0)]
+        # the earlier step is the one with the larger ratio size/recipe (the earlier category on ties):
+        is_earlier = crosses & ((stop_index < 0) | (low * recipe_of_stop > stop_size * ps_recipe[m]))
+        stop_index[is_earlier] = m
+        stop_size[is_earlier] = low[is_earlier]
+
+    # When there is no stop, all categories became empty - no trade:
+    counts = [numpy.full(num_of_markets, sizes[i] if ps_recipe[i] > 0 else 0) for i in range(num_categories)]
+    (final_prices, _, _) = prices_after_removal(markets, counts)
+    final_prices = numpy.stack(final_prices, axis=1).astype(float)
+    for m in relevant_category_indices:
+        rows = markets[stop_index == m]
+        if len(rows) == 0:
+            continue
+        main_category_sizes = stop_size[rows]
+        stop_counts = removed_counts(m, main_category_sizes)
+        (prices, price_sum, price_sum_error) = prices_after_removal(rows, stop_counts)
+        for i in range(num_categories):
+            counts[i][rows] = stop_counts[i]
+        # prices.increase_price_up_to_balance(m, the value of the next agent of category m):
+        new_prices = categories[m][rows, main_category_sizes - 1]
+        sum_without_category = price_sums_without_category(prices, price_sum, price_sum_error, m)
+        new_sums = sum_without_category + ps_recipe[m]*new_prices
+        prices[m] = numpy.where(new_sums >= 0, (0 - sum_without_category) / ps_recipe[m], new_prices)
+        final_prices[rows] = numpy.stack(prices, axis=1)
+
+    # The traders are the agents that remain in the auction:
+    is_trading = [numpy.arange(sizes[i]) < (sizes[i] - counts[i])[:, None] for i in range(num_categories)]
+    (_, optimal_count, optimal_gft) = batch_optimal_trade(categories, ps_recipe)
+    return BatchTradeWithSinglePrice.from_traders(categories, is_trading, ps_recipe, final_prices, optimal_count, optimal_gft)
+
+
+def _add_to_price_sums(price_sum, price_sum_error, amount)->tuple:
+    """
+    Neumaier's compensated summation, as in AscendingPriceVector._add_to_price_sum, for arrays of price-sums.
+    """
+    new_sum = price_sum + amount
+    price_sum_error = price_sum_error + numpy.where(abs(price_sum) >= abs(amount), (price_sum - new_sum) + amount, (amount - new_sum) + price_sum)
+    return (new_sum, price_sum_error)
 
 
 if __name__ == "__main__":
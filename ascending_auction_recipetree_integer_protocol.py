@@ -29,10 +29,11 @@ from prices_integer import SimultaneousAscendingPriceVectors, PriceStatus
 from typing import *
 from recipetree_integer import RecipeTree
 
-import logging, sys, math
+import logging, sys, math, tracing
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 # To enable tracing, set logger.setLevel(logging.INFO)
+# To record the price changes as structured events, run the auction inside "with tracing.TraceBuffer() as trace:"
 
 
 EPSILON = 0.00001
@@ -48,8 +49,10 @@ class TradeWithMultipleRecipes(Trade):
         self.recipe_tree = recipe_tree
         self.agent_counts = agent_counts if agent_counts else [1] * len(categories)
         self.prices = prices
-        (self.num_of_deals_cache, self.num_of_deals_explanation_cache, self.kmin, self.kmax) = recipe_tree.num_of_deals_explained(prices)
-        self.gft_cache = recipe_tree.optimal_trade_GFT()
+        (self.num_of_deals_cache, self.kmin, self.kmax) = recipe_tree.num_of_deals_with_bounds()
+        # The explanation and the GFT are computed on first use (the categories do not change after the auction ends):
+        self.num_of_deals_explanation_cache = None
+        self.gft_cache = None
 
     def num_of_deals(self):
         return self.num_of_deals_cache
@@ -61,6 +64,8 @@ class TradeWithMultipleRecipes(Trade):
         return self.kmax
 
     def gain_from_trade(self, including_auctioneer:bool=True):
+        if self.gft_cache is None:
+            self.gft_cache = self.recipe_tree.optimal_trade_GFT()
         return self.gft_cache
 
     def optimal_trade(self):
@@ -69,10 +74,12 @@ class TradeWithMultipleRecipes(Trade):
     def __repr__(self):
         if self.num_of_deals_cache==0:
             return "No trade"
+        if self.num_of_deals_explanation_cache is None:
+            self.num_of_deals_explanation_cache = self.recipe_tree.num_of_deals_explained(self.prices)[1]
         return self.num_of_deals_explanation_cache.rstrip()
 
 
-def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any], agent_counts:List[int]=None)->TradeWithMultipleRecipes:
+def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any], agent_counts:List[int]=None, optimal_trade:tuple=None)->TradeWithMultipleRecipes:
     """
     Calculate the trade and prices using generalized-ascending-auction.
     Allows multiple recipes, but they must be represented by a *recipe tree*.
@@ -82,6 +89,8 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
                              The nested list represents a tree, where each path from root to leaf represents a recipe.
                              For example: [0, [1, None]] is a single recipe with categories {0,1}.
                                     [0, [1, None, 2, None]] is two recipes with categories {0,1} and {0,2}.
+    :param optimal_trade:    optional - the (deals, count, GFT) of the optimal trade in the given market, if the caller already computed it.
+                             It is used only for logging; when it is not given, it is computed only if the logger is enabled for INFO.
 
     :return: Trade object, representing the trade and prices.
 
@@ -141,23 +150,29 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
 
     logger.info("\n#### Multi-Recipe Budget-Balanced Ascending Auction\n")
     logger.info(market)
-    logger.info("Procurement-set recipe struct: {}".format(ps_recipe_struct))
-    logger.info("Procurement-set recipe agent counts: {}".format(agent_counts))
+    logger.info("Procurement-set recipe struct: %s", ps_recipe_struct)
+    logger.info("Procurement-set recipe agent counts: %s", agent_counts)
 
     remaining_market = market.clone()
     recipe_tree = RecipeTree(remaining_market.categories, ps_recipe_struct, agent_counts)
-    logger.info("Tree of recipes: {}".format(recipe_tree.paths_to_leaf()))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Tree of recipes: %s", recipe_tree.paths_to_leaf())
     ps_recipes = recipe_tree.recipes()
-    logger.info("Procurement-set recipes: {}".format(ps_recipes))
+    logger.info("Procurement-set recipes: %s", ps_recipes)
 
 
-    optimal_trade, optimal_count, optimal_GFT = recipe_tree.optimal_trade()
-    logger.info("For comparison, the optimal trade has k=%d, GFT=%f: %s\n", optimal_count,optimal_GFT,optimal_trade)
+    if logger.isEnabledFor(logging.INFO):
+        if optimal_trade is None:
+            optimal_trade = recipe_tree.optimal_trade()
+        (optimal_deals, optimal_count, optimal_GFT) = optimal_trade[:3]
+        logger.info("For comparison, the optimal trade has k=%d, GFT=%f: %s\n", optimal_count,optimal_GFT,optimal_deals)
     # optimal_trade = market.optimal_trade(ps_recipe)[0]
 
     #### STOPPED HERE
 
     prices = SimultaneousAscendingPriceVectors(ps_recipes, -MAX_VALUE)
+    trace = tracing.active_trace
+    iteration = 0
     while True:
         largest_category_size, combined_category_size, indices_of_prices_to_increase = recipe_tree.largest_categories(indices=True)
         logger.info("\n")
@@ -181,6 +196,9 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
         map_category_index_to_price = prices.map_category_index_to_price()
 
         if prices.status == PriceStatus.STOPPED_AT_ZERO_SUM:
+            if trace is not None:
+                for category_index in indices_of_prices_to_increase:
+                    trace.record(iteration, category_index, map_category_index_to_price[category_index], remaining_market.categories[category_index].size())
             logger.info("\nPrice crossed zero.")
             logger.info("  Final price-per-unit vector: %s", map_category_index_to_price)
             logger.info(remaining_market)
@@ -192,7 +210,11 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
                 and category.size()>0 \
                 and category.lowest_agent_value() <= map_category_index_to_price[category_index]:
                     category.remove_lowest_agent()
-                    logger.info("{} after: {} agents remain".format(category.name, category.size()))
+                    logger.info("%s after: %s agents remain", category.name, category.size())
+        if trace is not None:
+            for category_index in indices_of_prices_to_increase:
+                trace.record(iteration, category_index, map_category_index_to_price[category_index], remaining_market.categories[category_index].size())
+        iteration += 1
 
 
 
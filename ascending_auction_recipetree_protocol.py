@@ -28,10 +28,11 @@ from prices import SimultaneousAscendingPriceVectors, PriceStatus
 from typing import *
 from recipetree import RecipeTree
 
-import logging, sys, math
+import logging, sys, math, tracing
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 # To enable tracing, set logger.setLevel(logging.INFO)
+# To record the price changes as structured events, run the auction inside "with tracing.TraceBuffer() as trace:"
 
 
 EPSILON = 0.00001
@@ -46,8 +47,10 @@ class TradeWithMultipleRecipes(Trade):
         self.num_categories = len(categories)
         self.recipe_tree = recipe_tree
         self.prices = prices
-        (self.num_of_deals_cache, self.num_of_deals_explanation_cache, self.kmin, self.kmax) = recipe_tree.num_of_deals_explained(prices)
-        self.gft_cache = recipe_tree.optimal_trade_GFT()
+        (self.num_of_deals_cache, self.kmin, self.kmax) = recipe_tree.num_of_deals_with_bounds()
+        # The explanation and the GFT are computed on first use (the categories do not change after the auction ends):
+        self.num_of_deals_explanation_cache = None
+        self.gft_cache = None
 
     def num_of_deals(self):
         return self.num_of_deals_cache
@@ -59,6 +62,8 @@ class TradeWithMultipleRecipes(Trade):
         return self.kmax
 
     def gain_from_trade(self, including_auctioneer:bool=True):
+        if self.gft_cache is None:
+            self.gft_cache = self.recipe_tree.optimal_trade_GFT()
         return self.gft_cache
 
     def optimal_trade(self):
@@ -67,10 +72,12 @@ class TradeWithMultipleRecipes(Trade):
     def __repr__(self):
         if self.num_of_deals_cache==0:
             return "No trade"
+        if self.num_of_deals_explanation_cache is None:
+            self.num_of_deals_explanation_cache = self.recipe_tree.num_of_deals_explained(self.prices)[1]
         return self.num_of_deals_explanation_cache.rstrip()
 
 
-def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any])->TradeWithMultipleRecipes:
+def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any], optimal_trade:tuple=None)->TradeWithMultipleRecipes:
     """
     Calculate the trade and prices using generalized-ascending-auction.
     Allows multiple recipes, but they must be represented by a *recipe tree*.
@@ -80,6 +87,8 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
                              The nested list represents a tree, where each path from root to leaf represents a recipe.
                              For example: [0, [1, None]] is a single recipe with categories {0,1}.
                                     [0, [1, None, 2, None]] is two recipes with categories {0,1} and {0,2}.
+    :param optimal_trade:    optional - the (deals, count, GFT) of the optimal trade in the given market, if the caller already computed it.
+                             It is used only for logging; when it is not given, it is computed only if the logger is enabled for INFO.
 
     :return: Trade object, representing the trade and prices.
 
@@ -138,22 +147,28 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
 
     logger.info("\n#### Multi-Recipe Budget-Balanced Ascending Auction\n")
     logger.info(market)
-    logger.info("Procurement-set recipe struct: {}".format(ps_recipe_struct))
+    logger.info("Procurement-set recipe struct: %s", ps_recipe_struct)
 
     remaining_market = market.clone()
     recipe_tree = RecipeTree(remaining_market.categories, ps_recipe_struct)
-    logger.info("Tree of recipes: {}".format(recipe_tree.paths_to_leaf()))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Tree of recipes: %s", recipe_tree.paths_to_leaf())
     ps_recipes = recipe_tree.recipes()
-    logger.info("Procurement-set recipes: {}".format(ps_recipes))
+    logger.info("Procurement-set recipes: %s", ps_recipes)
 
 
-    optimal_trade, optimal_count, optimal_GFT = recipe_tree.optimal_trade()
-    logger.info("For comparison, the optimal trade has k=%d, GFT=%f: %s\n", optimal_count,optimal_GFT,optimal_trade)
+    if logger.isEnabledFor(logging.INFO):
+        if optimal_trade is None:
+            optimal_trade = recipe_tree.optimal_trade()
+        (optimal_deals, optimal_count, optimal_GFT) = optimal_trade[:3]
+        logger.info("For comparison, the optimal trade has k=%d, GFT=%f: %s\n", optimal_count,optimal_GFT,optimal_deals)
     # optimal_trade = market.optimal_trade(ps_recipe)[0]
 
     #### STOPPED HERE
 
     prices = SimultaneousAscendingPriceVectors(ps_recipes, -MAX_VALUE)
+    trace = tracing.active_trace
+    iteration = 0
     while True:
         largest_category_size, combined_category_size, indices_of_prices_to_increase = recipe_tree.largest_categories(indices=True)
         logger.info("\n")
@@ -177,6 +192,9 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
         map_category_index_to_price = prices.map_category_index_to_price()
 
         if prices.status == PriceStatus.STOPPED_AT_ZERO_SUM:
+            if trace is not None:
+                for category_index in indices_of_prices_to_increase:
+                    trace.record(iteration, category_index, map_category_index_to_price[category_index], remaining_market.categories[category_index].size())
             logger.info("\nPrice crossed zero.")
             logger.info("  Final price-per-unit vector: %s", map_category_index_to_price)
             logger.info(remaining_market)
@@ -187,8 +205,12 @@ def budget_balanced_ascending_auction(market:Market, ps_recipe_struct: List[Any]
             if map_category_index_to_price[category_index] is not None \
                 and category.size()>0 \
                 and category.lowest_agent_value() <= map_category_index_to_price[category_index]:
-                    category.remove_lowest_agent()
-                    logger.info("{} after: {} agents remain".format(category.name, category.size()))
+                    recipe_tree.remove_lowest_agent(category_index)
+                    logger.info("%s after: %s agents remain", category.name, category.size())
+        if trace is not None:
+            for category_index in indices_of_prices_to_increase:
+                trace.record(iteration, category_index, map_category_index_to_price[category_index], remaining_market.categories[category_index].size())
+        iteration += 1
 
 
 
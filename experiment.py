@@ -28,17 +28,19 @@ Author: Erel Segal-Halevi
 
 
 from markets import Market
-from agents import AgentCategory
+from agents import AgentCategory, random_generator
 from typing import Callable
 
 from tee_table.tee_table import TeeTable
 from collections import OrderedDict
+from experiment_runner import run_tasks, sum_blocks, iteration_blocks
 
 TABLE_COLUMNS = ["iterations","auction_name", "recipe", "num_of_agents",
                  "mean_optimal_count", "mean_auction_count", "count_ratio",
                  "mean_optimal_gft", "mean_auction_total_gft", "total_gft_ratio", "mean_auction_market_gft", "market_gft_ratio"]
 
-def experiment(results_csv_file:str, auction_function:Callable, auction_name:str, recipe:tuple, value_ranges:list, nums_of_agents:list, num_of_iterations:int):
+def experiment(results_csv_file:str, auction_function:Callable, auction_name:str, recipe:tuple, value_ranges:list, nums_of_agents:list, num_of_iterations:int,
+               num_of_workers:int=1, numpy_random:bool=False):
     """
     Run an experiment similar to McAfee (1992) experiment on the given auction.
 
@@ -47,27 +49,18 @@ def experiment(results_csv_file:str, auction_function:Callable, auction_name:str
     :param nums_of_agents: a list of the numbers of agents with which to run the experiment.
     :param value_ranges: for each category, a pair (min_value,max_value). The value for each agent in this category is selected uniformly at random between min_value and max_value.
     :param num_of_iterations: how many times to repeat the experiment for each num of agents.
+    :param num_of_workers: the number of processes that run the iterations (None = all CPUs). See experiment_runner.
+    :param numpy_random: if True, the values of each category are drawn with a single NumPy call (see AgentCategory.uniformly_random_array),
+                         which is much faster for large categories, but gives different random values.
     """
     results_table = TeeTable(TABLE_COLUMNS, results_csv_file)
     recipe_str = ":".join(map(str,recipe))
-    num_of_categories = len(recipe)
+    tasks = [((num_of_agents_per_category, block), (auction_function, recipe, value_ranges, num_of_agents_per_category, stop-start, numpy_random))
+             for num_of_agents_per_category in nums_of_agents
+             for (block, (start, stop)) in enumerate(iteration_blocks(num_of_iterations))]
+    total_sums = sum_blocks(run_tasks(experiment_iterations, tasks, num_of_workers))
     for num_of_agents_per_category in nums_of_agents:
-        sum_optimal_count = sum_auction_count = 0  # count the number of deals done in the optimal vs. the actual auction.
-        sum_optimal_gft = sum_auction_total_gft = sum_auction_market_gft = 0
-        for _ in range(num_of_iterations):
-            market = Market([
-                AgentCategory.uniformly_random("agent", num_of_agents_per_category*recipe[category], value_ranges[category][0], value_ranges[category][1])
-                for category in range(num_of_categories)
-            ])
-            (optimal_trade, _) = market.optimal_trade(recipe)
-            auction_trade = auction_function(market, recipe)
-
-            sum_optimal_count += optimal_trade.num_of_deals()
-            sum_auction_count += auction_trade.num_of_deals()
-
-            sum_optimal_gft += optimal_trade.gain_from_trade()
-            sum_auction_total_gft += auction_trade.gain_from_trade(including_auctioneer=True)
-            sum_auction_market_gft += auction_trade.gain_from_trade(including_auctioneer=False)
+        (sum_optimal_count, sum_auction_count, sum_optimal_gft, sum_auction_total_gft, sum_auction_market_gft) = total_sums[num_of_agents_per_category]
 
         # print("Num of times {} attains the maximum GFT: {} / {} = {:.2f}%".format(title, count_optimal_gft, num_of_iterations, count_optimal_gft * 100 / num_of_iterations))
         # print("GFT of {}: {:.2f} / {:.2f} = {:.2f}%".format(title, sum_auction_gft, sum_optimal_gft, 0 if sum_optimal_gft==0 else sum_auction_gft * 100 / sum_optimal_gft))
@@ -86,3 +79,33 @@ def experiment(results_csv_file:str, auction_function:Callable, auction_name:str
             ("market_gft_ratio", 0 if sum_optimal_gft == 0 else round(sum_auction_market_gft / sum_optimal_gft * 100, 2)),
         )))
     results_table.done()
+
+
+def experiment_iterations(auction_function:Callable, recipe:tuple, value_ranges:list, num_of_agents_per_category:int, num_of_iterations:int,
+                          numpy_random:bool=False)->list:
+    """
+    Runs the given number of iterations of the experiment with a fixed number of agents.
+    :return: the sums [optimal count, auction count, optimal GFT, auction total GFT, auction market GFT] over these iterations.
+    """
+    num_of_categories = len(recipe)
+    sum_optimal_count = sum_auction_count = 0  # count the number of deals done in the optimal vs. the actual auction.
+    sum_optimal_gft = sum_auction_total_gft = sum_auction_market_gft = 0
+    generator = random_generator() if numpy_random else None
+    for _ in range(num_of_iterations):
+        if numpy_random:
+            categories = [AgentCategory.uniformly_random_array("agent", num_of_agents_per_category*recipe[category], value_ranges[category][0], value_ranges[category][1], generator)
+                          for category in range(num_of_categories)]
+        else:
+            categories = [AgentCategory.uniformly_random("agent", num_of_agents_per_category*recipe[category], value_ranges[category][0], value_ranges[category][1])
+                          for category in range(num_of_categories)]
+        market = Market(categories)
+        (optimal_trade, _) = market.optimal_trade(recipe)
+        auction_trade = auction_function(market, recipe)
+
+        sum_optimal_count += optimal_trade.num_of_deals()
+        sum_auction_count += auction_trade.num_of_deals()
+
+        sum_optimal_gft += optimal_trade.gain_from_trade()
+        sum_auction_total_gft += auction_trade.gain_from_trade(including_auctioneer=True)
+        sum_auction_market_gft += auction_trade.gain_from_trade(including_auctioneer=False)
+    return [sum_optimal_count, sum_auction_count, sum_optimal_gft, sum_auction_total_gft, sum_auction_market_gft]
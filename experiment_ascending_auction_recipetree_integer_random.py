@@ -83,7 +83,7 @@ def experiment(results_csv_file: str, recipe: list, value_ranges:list, nums_of_a
             recipe_tree = RecipeTree(market.categories, recipe, recipe_tree_agent_counts)
             optimal_trade, optimal_count, optimal_gft, kmin, kmax = recipe_tree.optimal_trade_with_counters()
             #print('optimal trade:', optimal_trade, optimal_count, optimal_gft)
-            auction_trade = budget_balanced_ascending_auction(market, recipe, recipe_tree_agent_counts)
+            auction_trade = budget_balanced_ascending_auction(market, recipe, recipe_tree_agent_counts, optimal_trade=(optimal_trade, optimal_count, optimal_gft))
             auction_count = auction_trade.num_of_deals()
             gft = auction_trade.gain_from_trade()
             if optimal_count > 0 and gft < optimal_gft * (kmin - 1)/(kmin + 2):
@@ -36,7 +36,7 @@ Since:  2020-08
 
 
 from markets import Market
-from agents import AgentCategory
+from agents import AgentCategory, random_generator
 
 from tee_table.tee_table import TeeTable
 from collections import OrderedDict
@@ -44,9 +44,10 @@ from tree_calculations import get_agents_analyze, get_children_counts
 from ascending_auction_recipetree_protocol import budget_balanced_ascending_auction
 from ascending_auction_recipetree_protocol import TradeWithMultipleRecipes
 from recipetree import RecipeTree
+from experiment_runner import run_tasks, sum_blocks, iteration_blocks
 
 def experiment(results_csv_file: str, recipe: list, value_ranges:list, nums_of_agents:list, num_of_iterations:int,
-               agent_counts:list, agent_values:list):
+               agent_counts:list, agent_values:list, num_of_workers:int=1, numpy_random:bool=False):
     """
     Run an experiment similar to McAfee (1992) experiment on the given auction.
     :param results_csv_file: the experiment result file.
@@ -56,6 +57,9 @@ def experiment(results_csv_file: str, recipe: list, value_ranges:list, nums_of_a
     :param nums_of_agents: list of n(s) for number of possible trades to make the calculations.
     :param stocks_prices: list of prices for each stock and each agent.
     :param stock_names: list of stocks names which prices are belongs, for naming only.
+    :param num_of_workers: the number of processes that run the iterations (None = all CPUs). See experiment_runner.
+    :param numpy_random: if True, the values of each category are drawn with a single NumPy call (see AgentCategory.uniformly_random_array),
+                         which is much faster for large categories, but gives different random values.
     """
     TABLE_COLUMNS = ["iterations", "recipe", "numofagents",
                      "meanoptimalcount", "meanoptimalkmin", "meanoptimalkmax","gftformula",
@@ -66,48 +70,12 @@ def experiment(results_csv_file: str, recipe: list, value_ranges:list, nums_of_a
     recipe_str = str(recipe).replace(',', '-')
     category_size_list = get_agents_analyze(recipe)
     children_counts = get_children_counts(recipe, category_size_list)
+    tasks = [((i, block), (recipe, value_ranges, nums_of_agents[i], agent_counts, agent_values, category_size_list, start, stop, numpy_random))
+             for i in range(len(nums_of_agents))
+             for (block, (start, stop)) in enumerate(iteration_blocks(num_of_iterations))]
+    total_sums = sum_blocks(run_tasks(experiment_iterations, tasks, num_of_workers))
     for i in range(len(nums_of_agents)):
-        sum_optimal_count = sum_auction_count = sum_optimal_kmin = sum_optimal_kmax = 0  # count the number of deals done in the optimal vs. the actual auction.
-        sum_optimal_gft = sum_auction_total_gft = sum_auction_market_gft = 0
-        for iteration in range(num_of_iterations):
-            if iteration % 10000 == 0:
-                print('iteration:', iteration)
-            agents = []
-            for category in range(len(category_size_list)):
-                sign = 0 if category == 0 else 1
-                agents.append(AgentCategory.uniformly_random("agent", int(nums_of_agents[i]*agent_counts[category]),
-                                                             value_ranges[sign][0]*agent_values[category],
-                                                             value_ranges[sign][1]*agent_values[category]))
-                #agents.append(AgentCategory.uniformly_random("agent", nums_of_agents[i], value_ranges[sign][0], value_ranges[sign][1]))
-            market = Market(agents)
-            #print(agents)
-            recipe_tree = RecipeTree(market.categories, recipe)
-            optimal_trade, optimal_count, optimal_gft, kmin, kmax = recipe_tree.optimal_trade_with_counters()
-            #print('optimal trade:', optimal_trade, optimal_count, optimal_gft)
-            auction_trade = budget_balanced_ascending_auction(market, recipe)
-            auction_count = auction_trade.num_of_deals()
-            gft = auction_trade.gain_from_trade()
-            #if optimal_count > 0 and gft < optimal_gft * (1 - 1/optimal_count):
-                #the auction count is less more than 1 than the optimal count.
-            #    print('Warning GFT!!!', 'optimal_count:', optimal_count, 'auction_count:', auction_count,
-            #          'num_of_possible_ps:', nums_of_agents[i], 'optimal_gft:', optimal_gft, 'gft:', gft)
-            #    if nums_of_agents[i] < 20:
-            #        print(market.categories)
-
-            sum_optimal_count += optimal_count
-            sum_auction_count += auction_count
-
-            sum_optimal_kmin += kmin
-            sum_optimal_kmax += kmax
-
-            sum_optimal_gft += optimal_gft
-            sum_auction_total_gft += gft
-
-            if auction_count < optimal_count - 2:
-                #the auction count is less more than 1 than the optimal count.
-                print('Warning!!!', 'optimal_count:', optimal_count, 'auction_count:', auction_count, 'num_of_possible_ps:', nums_of_agents[i])
-                if nums_of_agents[i] < 10:
-                    print(market.categories)
+        (sum_optimal_count, sum_auction_count, sum_optimal_kmin, sum_optimal_kmax, sum_optimal_gft, sum_auction_total_gft) = total_sums[i]
 
         # print("Num of times {} attains the maximum GFT: {} / {} = {:.2f}%".format(title, count_optimal_gft, num_of_iterations, count_optimal_gft * 100 / num_of_iterations))
         # print("GFT of {}: {:.2f} / {:.2f} = {:.2f}%".format(title, sum_auction_gft, sum_optimal_gft, 0 if sum_optimal_gft==0 else sum_auction_gft * 100 / sum_optimal_gft))
@@ -127,3 +95,59 @@ def experiment(results_csv_file: str, recipe: list, value_ranges:list, nums_of_a
             ("totalgftratio", 0 if sum_optimal_gft==0 else sum_auction_total_gft / sum_optimal_gft*100),
         ]))
     results_table.done()
+
+
+def experiment_iterations(recipe: list, value_ranges:list, num_of_agents:int, agent_counts:list, agent_values:list,
+                          category_size_list:list, start:int, stop:int, numpy_random:bool=False)->list:
+    """
+    Runs the iterations range(start,stop) of the experiment with a fixed number of agents.
+    :return: the sums [optimal count, auction count, optimal kmin, optimal kmax, optimal GFT, auction GFT] over these iterations.
+    """
+    sum_optimal_count = sum_auction_count = sum_optimal_kmin = sum_optimal_kmax = 0  # count the number of deals done in the optimal vs. the actual auction.
+    sum_optimal_gft = sum_auction_total_gft = 0
+    generator = random_generator() if numpy_random else None
+    for iteration in range(start, stop):
+        if iteration % 10000 == 0:
+            print('iteration:', iteration)
+        agents = []
+        for category in range(len(category_size_list)):
+            sign = 0 if category == 0 else 1
+            if numpy_random:
+                agents.append(AgentCategory.uniformly_random_array("agent", int(num_of_agents*agent_counts[category]),
+                                                                   value_ranges[sign][0]*agent_values[category],
+                                                                   value_ranges[sign][1]*agent_values[category], generator))
+            else:
+                agents.append(AgentCategory.uniformly_random("agent", int(num_of_agents*agent_counts[category]),
+                                                             value_ranges[sign][0]*agent_values[category],
+                                                             value_ranges[sign][1]*agent_values[category]))
+            #agents.append(AgentCategory.uniformly_random("agent", num_of_agents, value_ranges[sign][0], value_ranges[sign][1]))
+        market = Market(agents)
+        #print(agents)
+        recipe_tree = RecipeTree(market.categories, recipe)
+        optimal_trade, optimal_count, optimal_gft, kmin, kmax = recipe_tree.optimal_trade_with_counters()
+        #print('optimal trade:', optimal_trade, optimal_count, optimal_gft)
+        auction_trade = budget_balanced_ascending_auction(market, recipe, optimal_trade=(optimal_trade, optimal_count, optimal_gft))
+        auction_count = auction_trade.num_of_deals()
+        gft = auction_trade.gain_from_trade()
+        #if optimal_count > 0 and gft < optimal_gft * (1 - 1/optimal_count):
+            #the auction count is less more than 1 than the optimal count.
+        #    print('Warning GFT!!!', 'optimal_count:', optimal_count, 'auction_count:', auction_count,
+        #          'num_of_possible_ps:', num_of_agents, 'optimal_gft:', optimal_gft, 'gft:', gft)
+        #    if num_of_agents < 20:
+        #        print(market.categories)
+
+        sum_optimal_count += optimal_count
+        sum_auction_count += auction_count
+
+        sum_optimal_kmin += kmin
+        sum_optimal_kmax += kmax
+
+        sum_optimal_gft += optimal_gft
+        sum_auction_total_gft += gft
+
+        if auction_count < optimal_count - 2:
+            #the auction count is less more than 1 than the optimal count.
+            print('Warning!!!', 'optimal_count:', optimal_count, 'auction_count:', auction_count, 'num_of_possible_ps:', num_of_agents)
+            if num_of_agents < 10:
+                print(market.categories)
+    return [sum_optimal_count, sum_auction_count, sum_optimal_kmin, sum_optimal_kmax, sum_optimal_gft, sum_auction_total_gft]
@@ -40,7 +40,7 @@ from agents import AgentCategory
 
 from tee_table.tee_table import TeeTable
 from collections import OrderedDict
-from get_stocks_data import getStocksTreePrices
+from get_stocks_data import StockData
 from tree_calculations import get_agents_analyze
 from ascending_auction_recipetree_protocol import budget_balanced_ascending_auction
 from ascending_auction_recipetree_protocol import TradeWithMultipleRecipes
@@ -57,6 +57,7 @@ def experiment(results_csv_file: str, recipe: list, agent_counts:list, agent_val
     :param recipe: can be any vector of ones, e.g. (1,1,1), for our trade-reduction mechanism, or any vector of positive integers for our ascending-auction mechanism.
     :param nums_of_agents: list of n(s) for number of possible trades to make the calculations.
     :param stocks_prices: list of prices for each stock and each agent.
+                          If None, the prices are read lazily, one stock at a time, from the stocks directory (see StockData).
     :param stock_names: list of stocks names which prices are belongs, for naming only.
     """
     TABLE_COLUMNS = ["stockname", "recipe", "numpossibletrades",
@@ -67,20 +68,24 @@ def experiment(results_csv_file: str, recipe: list, agent_counts:list, agent_val
     recipe_str = str(recipe).replace(',', '->')
     category_size_list = get_agents_analyze(recipe)
     if stocks_prices is None:
-        (stocks_prices, stock_names) = getStocksTreePrices(recipe, agent_counts, agent_values)
+        stocks = StockData().tree_prices(agent_counts, agent_values)
+    else:
+        stocks = zip(stock_names, stocks_prices)
 
     if nums_of_agents is None:
         nums_of_agents = [10000000]
     total_results = {}
     for num_of_agents_per_category in nums_of_agents:
         total_results[str(num_of_agents_per_category)] = []
-    for i in range(len(stock_names)):
+    num_of_stocks = 0
+    for (stock_name, stock_prices) in stocks:
+        num_of_stocks += 1
         for _ in range(num_of_iterations):
             last_iteration = False
-            for j in range(len(stocks_prices[i])):
-                random.shuffle(stocks_prices[i][j])
+            for j in range(len(stock_prices)):
+                random.shuffle(stock_prices[j])
             for num_of_agents_per_category in nums_of_agents:
-                num_of_possible_ps = min(num_of_agents_per_category, len(stocks_prices[i][0]))
+                num_of_possible_ps = min(num_of_agents_per_category, len(stock_prices[0]))
                 if last_iteration is True and num_of_possible_ps < num_of_agents_per_category:
                     break
                 if num_of_possible_ps < num_of_agents_per_category:
@@ -88,15 +93,15 @@ def experiment(results_csv_file: str, recipe: list, agent_counts:list, agent_val
                         break
                     else:
                         last_iteration = True
-                        market = Market([AgentCategory("agent", stocks_prices[i][j]) for j in range(len(stocks_prices[i]))])
+                        market = Market([AgentCategory("agent", stock_prices[j]) for j in range(len(stock_prices))])
                 else:
-                    market = Market([AgentCategory("agent", stocks_prices[i][j][0:int(num_of_possible_ps*agent_counts[j])]) for j in range(len(stocks_prices[i]))])
+                    market = Market([AgentCategory("agent", stock_prices[j][0:int(num_of_possible_ps*agent_counts[j])]) for j in range(len(stock_prices))])
                 if num_of_agents_per_category == 6 and _ == 0:
-                    print(stock_names[i], market.categories)
+                    print(stock_name, market.categories)
                 recipe_tree = RecipeTree(market.categories, recipe)
                 optimal_trade, optimal_count, optimal_gft, kmin, kmax = recipe_tree.optimal_trade_with_counters()
                 #print('optimal trade:', optimal_trade, optimal_count, optimal_gft)
-                auction_trade = budget_balanced_ascending_auction(market, recipe)
+                auction_trade = budget_balanced_ascending_auction(market, recipe, optimal_trade=(optimal_trade, optimal_count, optimal_gft))
                 auction_count = auction_trade.num_of_deals()
                 gft = auction_trade.gain_from_trade()
                 #if auction_count < optimal_count - 1:
@@ -116,7 +121,7 @@ def experiment(results_csv_file: str, recipe: list, agent_counts:list, agent_val
                           'num_of_possible_ps:', num_of_possible_ps, 'optimal_gft:', optimal_gft, 'gft:', gft)
                     if num_of_possible_ps < 20:
                         print(market.categories)
-                results = [("stockname", stock_names[i]),
+                results = [("stockname", stock_name),
                            ("recipe", recipe_str),
                            ("numpossibletrades", num_of_possible_ps),
                            ("optimalcount", optimal_count),
@@ -146,7 +151,7 @@ def experiment(results_csv_file: str, recipe: list, agent_counts:list, agent_val
                 #elif 'count' in results[index][0]:
                 #    results[index] = (results[index][0], results[index][1]/len(stock_names))
                 #else:
-                results[index] = (results[index][0], results[index][1]/len(stock_names)/num_of_iterations)
+                results[index] = (results[index][0], results[index][1]/num_of_stocks/num_of_iterations)
             elif index == 0:
                 results[index] = (results[index][0], 'Average')
             if results[index][0] == 'optimalkmin':
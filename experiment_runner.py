@@ -0,0 +1,220 @@
+#!python3
+
+"""
+Runs the iterations of a simulation experiment as independent tasks, possibly in several processes.
+
+The iterations of each configuration of an experiment (e.g. a recipe and a number of agents)
+are split into blocks of consecutive iterations. Each block is a task, identified by a key (configuration, block index),
+which returns the partial sums of the result columns of its iterations.
+The partial sums of each configuration are then added up in the order of the blocks.
+
+Before running a task, the `random` module is seeded with a seed derived from a base seed and the task key.
+Hence, for a given base seed and block size, the results do not depend on the number of workers.
+When the tasks run in the current process, the state of the `random` module is restored after them,
+so running an experiment does not change the random stream of the caller.
+
+>>> tasks = [((n, block), (n, start, stop)) for n in (10, 20) for (block, (start, stop)) in enumerate(iteration_blocks(5, block_size=2))]
+>>> tasks[:3]
+[((10, 0), (10, 0, 2)), ((10, 1), (10, 2, 4)), ((10, 2), (10, 4, 5))]
+>>> serial = sum_blocks(run_tasks(_random_sums, tasks, num_of_workers=1, base_seed=1))
+>>> sorted(serial.keys())
+[10, 20]
+>>> parallel = sum_blocks(run_tasks(_random_sums, tasks, num_of_workers=2, base_seed=1))
+>>> serial == parallel
+True
+>>> random.seed(5); _ = run_tasks(_random_sums, tasks, base_seed=1); after_tasks = random.random()
+>>> random.seed(5); after_tasks == random.random()
+True
+
+A long experiment can be made restartable by giving run_tasks a checkpoint file:
+the result of each finished task is appended to it, and when the experiment is restarted,
+the tasks whose results are in the file are not run again.
+
+>>> import os, tempfile
+>>> checkpoint_file = os.path.join(tempfile.mkdtemp(), "experiment.checkpoint.jsonl")
+>>> first = run_tasks(_random_sums, tasks[:4], base_seed=1, checkpoint_file=checkpoint_file)   # interrupted after 4 tasks
+>>> resumed = run_tasks(_random_sums, tasks, base_seed=2, checkpoint_file=checkpoint_file)     # the seed of the checkpoint is used
+>>> sum_blocks(resumed) == serial
+True
+
+The parameters of the experiment can be kept in the checkpoint file too;
+a checkpoint that was written with different parameters is discarded, rather than resumed:
+
+>>> first = run_tasks(_random_sums, tasks[:4], base_seed=1, checkpoint_file=checkpoint_file, checkpoint_parameters={"n": [10, 20]})
+>>> load_checkpoint(checkpoint_file, {"n": [10, 20]})[0], load_checkpoint(checkpoint_file, {"n": [10, 30]})
+(1, (None, {}))
+>>> os.path.exists(checkpoint_file)
+False
+
+Note: with num_of_workers > 1, the task function must be picklable (e.g. a module-level function or a functools.partial of one),
+and on platforms that start workers with "spawn", the calling script must be guarded by `if __name__ == "__main__":`.
+"""
+
+import hashlib, json, os, random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import *
+
+DEFAULT_BLOCK_SIZE = 10   # iterations per task
+
+
+def task_seed(base_seed:int, key:Hashable)->int:
+    """
+    A deterministic seed for the task with the given key.
+    It does not depend on Python's hash randomization, so it is the same in all processes.
+
+    >>> task_seed(1, (10, 0)) == task_seed(1, (10, 0)), task_seed(1, (10, 0)) == task_seed(1, (10, 1))
+    (True, False)
+    """
+    digest = hashlib.sha256(repr((base_seed, key)).encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def iteration_blocks(num_of_iterations:int, block_size:int=DEFAULT_BLOCK_SIZE)->List[Tuple[int,int]]:
+    """
+    Splits range(num_of_iterations) into consecutive blocks.
+
+    >>> iteration_blocks(25, 10)
+    [(0, 10), (10, 20), (20, 25)]
+    """
+    return [(start, min(start+block_size, num_of_iterations)) for start in range(0, num_of_iterations, block_size)]
+
+
+def _run_task(task_function:Callable, base_seed:int, key:Hashable, args:tuple):
+    random.seed(task_seed(base_seed, key))
+    return task_function(*args)
+
+
+def run_tasks(task_function:Callable, tasks:List[Tuple[Hashable,tuple]], num_of_workers:int=1, base_seed:int=None,
+              checkpoint_file:str=None, checkpoint_parameters:dict=None, initializer:Callable=None, initargs:tuple=())->Dict[Hashable,Any]:
+    """
+    Runs task_function(*args) for each (key, args) in tasks.
+
+    :param num_of_workers: the number of worker processes. 0 or 1 runs the tasks in the current process; None uses all CPUs.
+    :param base_seed: the seed from which the task seeds are derived.
+                      If None, it is drawn from the `random` module, so that seeding it before the experiment makes the experiment reproducible.
+    :param checkpoint_file: optional - a file in which the results of finished tasks are kept (see load_checkpoint).
+                      Tasks whose results are already in the file are not run again, and the base seed of the file is used.
+                      The task keys and results must be JSON-serializable; tuples are read back as lists.
+    :param checkpoint_parameters: optional - the JSON-serializable parameters that determine the task results (see load_checkpoint).
+    :param initializer, initargs: optional - initializer(*initargs) is called once in each worker process (or once in the current process)
+                      before its tasks. It can keep large data that is shared by many tasks (e.g. in a module-level variable),
+                      so that the data is sent once per worker rather than pickled with the arguments of every task.
+    :return: a dict that maps each task key to the result of its task, in the order of the tasks.
+    """
+    results = {}
+    checkpoint_seed = None
+    if checkpoint_file is not None:
+        (checkpoint_seed, results) = load_checkpoint(checkpoint_file, checkpoint_parameters)
+    if checkpoint_seed is not None:
+        base_seed = checkpoint_seed
+    elif base_seed is None:
+        base_seed = random.getrandbits(64)
+    pending_tasks = [(key, args) for (key, args) in tasks if key not in results]
+
+    checkpoint = open(checkpoint_file, "a") if checkpoint_file is not None else None
+    try:
+        if checkpoint is not None and checkpoint_seed is None:
+            _append_record(checkpoint, {"base_seed": base_seed, "parameters": checkpoint_parameters})
+        def task_finished(key, result):
+            results[key] = result
+            if checkpoint is not None:
+                _append_record(checkpoint, {"key": key, "result": result})
+        if num_of_workers is not None and num_of_workers <= 1:
+            random_state = random.getstate()   # the tasks re-seed `random`; the caller's stream is restored afterwards
+            try:
+                if initializer is not None and len(pending_tasks) > 0:
+                    initializer(*initargs)
+                for (key, args) in pending_tasks:
+                    task_finished(key, _run_task(task_function, base_seed, key, args))
+            finally:
+                random.setstate(random_state)
+        elif len(pending_tasks) > 0:
+            with ProcessPoolExecutor(max_workers=num_of_workers, initializer=initializer, initargs=initargs) as executor:
+                futures = {executor.submit(_run_task, task_function, base_seed, key, args): key for (key, args) in pending_tasks}
+                for future in as_completed(futures):
+                    task_finished(futures[future], future.result())
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    return {key: results[key] for (key, _) in tasks}
+
+
+def load_checkpoint(checkpoint_file:str, parameters:dict=None)->Tuple[Optional[int],Dict[Hashable,Any]]:
+    """
+    Reads a checkpoint file written by run_tasks.
+    The file is append-only, with one JSON record per line: the base seed and the parameters of the experiment,
+    and then one record (key, result) per finished task.
+    A partially-written last line (e.g. of a run that was killed) is dropped from the file.
+
+    :param parameters: the parameters of the current experiment. If they differ from those in the file,
+                       the results in the file are stale, so the file is removed.
+    :return: (base seed, dict of task results); (None, {}) if the file does not exist or was removed.
+    """
+    if not os.path.isfile(checkpoint_file):
+        return (None, {})
+    base_seed = None
+    results = {}
+    with open(checkpoint_file) as file:
+        lines = file.readlines()
+    for (line_index, line) in enumerate(lines):
+        try:
+            record = json.loads(line) if line.endswith("\n") else None
+        except json.JSONDecodeError:
+            record = None
+        if record is None:
+            with open(checkpoint_file, "w") as file:
+                file.writelines(lines[:line_index])
+            break
+        if "base_seed" in record:
+            if record.get("parameters") != json.loads(json.dumps(parameters)):   # compared as read back from JSON
+                os.remove(checkpoint_file)
+                return (None, {})
+            base_seed = record["base_seed"]
+        else:
+            results[_to_tuple(record["key"])] = record["result"]
+    return (base_seed, results)
+
+
+def _append_record(file, record:dict):
+    file.write(json.dumps(record) + "\n")
+    file.flush()
+
+
+def _to_tuple(key):
+    """ Restores a task key that was written to JSON (where tuples become lists). """
+    return tuple(_to_tuple(element) for element in key) if isinstance(key, list) else key
+
+
+def add_partial_sums(total:Optional[list], partial:list)->list:
+    """
+    Adds two lists of partial sums elementwise. `total` may be None.
+
+    >>> add_partial_sums(add_partial_sums(None, [1, 2.5]), [3, 4])
+    [4, 6.5]
+    """
+    if total is None:
+        return list(partial)
+    return [x + y for (x, y) in zip(total, partial)]
+
+
+def sum_blocks(results:Dict[Tuple[Hashable,int],list])->Dict[Hashable,list]:
+    """
+    Adds up the partial sums of the blocks of each configuration.
+    :param results: maps (configuration, block index) to the partial sums of that block, as returned by run_tasks.
+    :return: maps each configuration to its total sums.
+    """
+    totals = {}
+    for ((configuration, block), partial) in results.items():
+        totals[configuration] = add_partial_sums(totals.get(configuration), partial)
+    return totals
+
+
+def _random_sums(n:int, start:int, stop:int)->list:
+    values = [random.randint(0, n) for _ in range(start, stop)]
+    return [len(values), sum(values)]
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
@@ -3,111 +3,227 @@
 """
 Imports stock prices from csv files downloaded from Yahoo.
 The CSV files are stored in stocks directory.
+The parsed prices of each file are cached in binary form (see load_prices), so each CSV file is parsed only once.
+The cached prices are not scaled; like the original CSV parser, the splitting functions multiply the values by 1000
+and truncate them to integers only after adding or multiplying prices, so the values are the same as those of the original parser.
+
+The stocks of a directory are read through a StockData object, which loads them lazily, one at a time:
+
+>>> stocks = StockData(tickers=["AMZN", "A"], rows=(0, 3))
+>>> stocks.names()
+['A', 'AMZN']
+>>> [(name, prices.shape) for (name, prices) in stocks]
+[('A', (4, 3)), ('AMZN', (4, 3))]
 
 Author: Dvir Gilor
 Since:  2020-08
 """
 import pandas as pd
-from os import listdir
-from os.path import isfile, join
-import random
-STOCKS = join('stock', 'stocks')
+import numpy
+from os import getpid, listdir, makedirs, remove, replace, stat
+from os.path import abspath, dirname, isfile, join, split, splitext
+import random, re
+from typing import *
+STOCKS = join(dirname(abspath(__file__)), 'stock', 'stocks')   # the default stocks directory
 POSITIVE_TYPES = ['High', 'Close']
 NEGATIVE_TYPES = ['Open', 'Low']
 TYPES = [*POSITIVE_TYPES, *NEGATIVE_TYPES]
 keep_all_prices = {}
-STOCKS = 'C:\\Users\\dg1813\\Documents\\GitHub\\auctions\\stock\\stocks'
+CACHE_DIRECTORY = '__cache__'   # a sub-directory of the stocks directory, for the binary caches of the CSV files.
+
+def load_prices(stockFile:str)->numpy.ndarray:
+    """
+    Returns the prices in the given stock file, as they are in the file (not scaled),
+    as a float64 array with one row per price type, in the order of TYPES.
+
+    The array is kept in a .npy cache file, which is created on first use and re-created when the CSV file is modified
+    (the cache file name contains the modification time of the CSV file; caches of older versions and formats are removed).
+    The cache is memory-mapped, so rows and slices of the returned array are views that do not copy the data.
+    """
+    (directory, file_name) = split(stockFile)
+    stock_name = splitext(file_name)[0]
+    cache_directory = join(directory, CACHE_DIRECTORY)
+    cache_file = join(cache_directory, "{}.{}.raw.npy".format(stock_name, stat(stockFile).st_mtime_ns))
+    if not isfile(cache_file):
+        df = pd.read_csv(stockFile, usecols=TYPES)
+        prices = numpy.ascontiguousarray(df[TYPES].to_numpy(dtype=float).T)
+        makedirs(cache_directory, exist_ok=True)
+        old_cache_pattern = re.compile(re.escape(stock_name) + r"\.\d+(\.raw)?\.npy")   # with or without the format tag
+        for old_cache_file in listdir(cache_directory):   # caches of older versions of the CSV file
+            if old_cache_pattern.fullmatch(old_cache_file):
+                remove(join(cache_directory, old_cache_file))
+        temp_file = "{}.{}.tmp.npy".format(cache_file[:-4], getpid())
+        numpy.save(temp_file, prices)
+        replace(temp_file, cache_file)   # atomic, in case several processes create the same cache
+    return numpy.load(cache_file, mmap_mode='r')
+
+def scale_prices(prices:numpy.ndarray)->numpy.ndarray:
+    """
+    Multiplies the given prices by 1000 and truncates them to integers, like int(price*1000).
+
+    >>> scale_prices(numpy.array([1.0019, -2.5]) + numpy.array([0.0019, 0.])).tolist()
+    [1003, -2500]
+    """
+    return numpy.trunc(numpy.asarray(prices) * 1000).astype(numpy.int64)
+
+def getPrices(stockFile:str, recipe:tuple)->List[numpy.ndarray]:
+    """
+    Splits the prices of the given stock into categories for the given recipe.
+    :return: a list with an int64 array of values per category, that can be given directly to AgentCategory.
+    """
+    return split_prices(load_prices(stockFile), recipe)
 
-def getPrices(stockFile:str, recipe:tuple):
-    df = pd.read_csv(stockFile)
-    data = [*[df[type].to_numpy() for type in POSITIVE_TYPES], *[-1*df[type].to_numpy() for type in NEGATIVE_TYPES]]
+def split_prices(prices:numpy.ndarray, recipe:tuple)->List[numpy.ndarray]:
+    """
+    Splits price columns, as returned by load_prices, into categories for the given recipe. See getPrices.
+    The prices are added (or multiplied) before they are scaled by scale_prices.
+    """
+    data = [prices[0], prices[1], -prices[2], -prices[3]]   # POSITIVE_TYPES, then NEGATIVE_TYPES
     if recipe == (1, 1):
-        data = [[*data[0], *data[1]], [*data[2], *data[3]]]
+        data = [numpy.concatenate(data[0:2]), numpy.concatenate(data[2:4])]
     elif recipe == (2, 1):
-        data = [[*data[0], *data[1]], data[2] + data[3]]
+        data = [numpy.concatenate(data[0:2]), data[2] + data[3]]
     elif recipe == (1, 2):
-        data = [data[0] + data[1], [*data[2], *data[3]]]
+        data = [data[0] + data[1], numpy.concatenate(data[2:4])]
     elif recipe == (2, 1, 1):
-        data = [[*data[0], *data[1]], data[2], data[3]]
+        data = [numpy.concatenate(data[0:2]), data[2], data[3]]
     elif recipe == (1, 1, 1):
         data = [data[0] + data[1], data[2], data[3]]
     elif len(recipe) == 3 and recipe[1:] == recipe[:-1]:
         data = [data[0] + data[1], data[2], data[3]]
     else: # recipe[1:] == recipe[:-1]: #all numbers in recipe are identical
-        buyers = [*data[0], *data[1]]
-        sellers = [*data[2], *data[3]]
-        size = len(recipe)
+        buyers = numpy.concatenate(data[0:2])
+        sellers = numpy.concatenate(data[2:4])
+        num_of_seller_categories = len(recipe) - 1
         sum_sellers = sum(recipe) - recipe[0]
-        multiple = 1
-        for v in recipe:
-            multiple *= v
-        split_data = [[] for i in range(size)]
-        print(split_data)
-        split_data[0] += [buyer*sum_sellers for buyer in buyers for _ in range(recipe[0])]
-        for i in range(len(sellers)*(len(recipe)-1)):
-            split_data[(i % (size-1))+1] += [sellers[i % len(sellers)] for _ in range(recipe[(i % (size-1))+1])]
+        # Each buyer appears recipe[0] times, with a value multiplied by the number of sellers in a PS.
+        split_data = [numpy.repeat(buyers*sum_sellers, recipe[0])]
+        # The sellers are dealt to the seller categories in turn, starting from the next seller each time;
+        # category c gets each of its sellers recipe[c] times.
+        seller_turns = numpy.arange(len(sellers)) * num_of_seller_categories
+        for category in range(1, num_of_seller_categories+1):
+            category_sellers = sellers[(seller_turns + category - 1) % len(sellers)]
+            split_data.append(numpy.repeat(category_sellers, recipe[category]))
         data = split_data
     print([len(category) for category in data])
-    long_data = []
-    for i in range(len(data)):
-        long_data.append([])
-        for j in range(len(data[i])):
-            long_data[i].append(int(data[i][j]*1000))
-            # if data[i][j] <= 0.0001 and i == 0:
-            #     data[i][j] = 0.0001
-            # elif data[i][j] >= -0.0001 and i > 0:
-            #     data[i][j] = -0.0001
-            # else:
-            #     data[i][j] = (int(data[i][j]*10000))/10000
-    return long_data
+    return [scale_prices(category) for category in data]
 
 def getAllPricesShuffled(stockFile:str, stockName):
     if stockName in keep_all_prices:
         return keep_all_prices[stockName]
-    df = pd.read_csv(stockFile)
-    data = [df[type].to_numpy() for type in TYPES]
-    long_data = []
-    for i in range(len(data)):
-        for j in range(len(data[i])):
-            long_data.append(int(data[i][j]*1000))
-    random.shuffle(long_data)
+    long_data = shuffle_prices(load_prices(stockFile))
     keep_all_prices[stockName] = long_data
     random.shuffle(long_data)
     return long_data
 
+def shuffle_prices(prices:numpy.ndarray)->list:
+    """
+    Returns all the prices in the given price columns, in random order.
+    """
+    long_data = scale_prices(prices).ravel().tolist()
+    random.shuffle(long_data)
+    return long_data
+
 #print(getAllPricesShuffled(join('stocks\\A.csv')))
 
 def getStocksPricesShuffled():
-    onlyfiles = [f for f in listdir(STOCKS) if isfile(join(STOCKS, f))]
-    return [getAllPricesShuffled(join(STOCKS, stockFile), stockFile[0:-4]) for stockFile in onlyfiles], [f[0:-4] for f in onlyfiles]
+    stock_names = StockData().names()
+    return [getAllPricesShuffled(join(STOCKS, name + ".csv"), name) for name in stock_names], stock_names
 #print(getStocksPricesShuffled())
 def getStocksPrices(recipe:tuple):
-    onlyfiles = [f for f in listdir(STOCKS) if isfile(join(STOCKS, f))]
-    return [getPrices(join(STOCKS, stockFile), recipe) for stockFile in onlyfiles], [f[0:-4] for f in onlyfiles]
+    stocks = list(StockData().prices(recipe))
+    return [prices for (_, prices) in stocks], [name for (name, _) in stocks]
 
 
 def getStocksTreePrices(recipe_tree: list, agents_counts: list, agents_values: list):
-    onlyfiles = [f for f in listdir(STOCKS) if isfile(join(STOCKS, f))]
-    return [get_prices_tree(join(STOCKS, stockFile), agents_counts, agents_values) for stockFile in onlyfiles], [f[0:-4] for f in onlyfiles]
-
-def get_prices_tree(stock_file: str, agents_counts: list, agents_values: list):
-    df = pd.read_csv(stock_file)
-    data = []
-    for t in TYPES:
-        for price in df[t].to_numpy():
-            data.append(int(price*1000))
+    stocks = list(StockData().tree_prices(agents_counts, agents_values))
+    return [prices for (_, prices) in stocks], [name for (name, _) in stocks]
+
+def get_prices_tree(stock_file: str, agents_counts: list, agents_values: list)->List[numpy.ndarray]:
+    """
+    Shuffles the prices of the given stock, and splits them into consecutive parts, one per category,
+    with sizes proportional to agents_counts. The values of each category are multiplied by its agents_values
+    (and negated for the seller categories).
+    :return: a list with an array of values per category.
+    """
+    return split_prices_tree(load_prices(stock_file), agents_counts, agents_values)
+
+def split_prices_tree(prices:numpy.ndarray, agents_counts: list, agents_values: list)->List[numpy.ndarray]:
+    """
+    Splits price columns, as returned by load_prices, into categories of a recipe tree. See get_prices_tree.
+    """
+    data = scale_prices(prices).ravel().tolist()
     random.shuffle(data)
+    data = numpy.array(data)
     print(len(data))
-    split_data = [[] for _ in range(len(agents_counts))]
     recipe_size = sum(agents_counts)
+    split_data = []
     data_index = 0
     for agent_index in range(len(agents_counts)):
-        for i in range(int(len(data) / recipe_size * agents_counts[agent_index])):
-            sign = -1 if agent_index > 0 else 1
-            split_data[agent_index].append(sign * data[data_index] * agents_values[agent_index])
-            data_index += 1
+        category_size = int(len(data) / recipe_size * agents_counts[agent_index])
+        sign = -1 if agent_index > 0 else 1
+        split_data.append(sign * data[data_index:data_index+category_size] * agents_values[agent_index])
+        data_index += category_size
     return split_data
 
 
 #print(getPricesTree('stocks\\T.csv', (1,1)))
 
+
+class StockData:
+    """
+    The stock prices in a directory of CSV files (one file per stock, named by its ticker).
+    Iterating over it yields (stock name, price columns) pairs, loading one stock at a time,
+    so that only the current stock is in memory.
+    """
+
+    def __init__(self, directory:str=STOCKS, tickers:Iterable[str]=None, rows:Tuple[int,int]=None):
+        """
+        :param directory: the directory of the CSV files; default is the stock/stocks directory of this repository.
+        :param tickers:   if given, only the stocks with these names are used.
+        :param rows:      if given, a pair (start, stop) - only these rows of each file are used.
+        """
+        self.directory = directory
+        self.tickers = None if tickers is None else set(tickers)
+        self.rows = rows
+
+    def names(self)->List[str]:
+        """
+        :return: the names of the stocks in the directory (that pass the ticker filter), in sorted order.
+        """
+        file_names = [f for f in listdir(self.directory) if f.endswith(".csv") and isfile(join(self.directory, f))]
+        names = sorted(splitext(f)[0] for f in file_names)
+        return names if self.tickers is None else [name for name in names if name in self.tickers]
+
+    def load(self, name:str)->numpy.ndarray:
+        """
+        :return: the price columns of the given stock (see load_prices), restricted to the row range.
+        """
+        prices = load_prices(join(self.directory, name + ".csv"))
+        return prices if self.rows is None else prices[:, self.rows[0]:self.rows[1]]
+
+    def __iter__(self)->Iterator[Tuple[str,numpy.ndarray]]:
+        for name in self.names():
+            yield (name, self.load(name))
+
+    def prices(self, recipe:tuple)->Iterator[Tuple[str,List[numpy.ndarray]]]:
+        """ Yields (name, prices split into categories by the recipe) for each stock. See getPrices. """
+        for (name, prices) in self:
+            yield (name, split_prices(prices, recipe))
+
+    def prices_shuffled(self)->Iterator[Tuple[str,list]]:
+        """ Yields (name, all prices in random order) for each stock. See getAllPricesShuffled. """
+        for (name, prices) in self:
+            yield (name, shuffle_prices(prices))
+
+    def tree_prices(self, agents_counts:list, agents_values:list)->Iterator[Tuple[str,List[numpy.ndarray]]]:
+        """ Yields (name, prices split into the categories of a recipe tree) for each stock. See get_prices_tree. """
+        for (name, prices) in self:
+            yield (name, split_prices_tree(prices, agents_counts, agents_values))
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
+
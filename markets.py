@@ -13,6 +13,7 @@ Since: 2019-08
 
 from agents import AgentCategory
 from trade import TradeWithMaterialBalance
+import numpy
 
 class Market:
     """
@@ -110,13 +111,14 @@ class Market:
         """
         categories = [None] * self.num_categories
         for i in range(self.num_categories):
-            categories[i] = AgentCategory(self.categories[i].name, [])
+            categories[i] = AgentCategory.from_sorted(self.categories[i].name, [])
         return categories
 
-    def optimal_trade(self, ps_recipe:list, max_iterations:int=2000000, include_zero_gft_ps:bool=True)->tuple:
+    def optimal_trade(self, ps_recipe:list, max_iterations:int=None, include_zero_gft_ps:bool=True)->tuple:
         """
         :param ps_recipe: a list that indicates the number of agents from each category that should be in each PS.
         For example: [1,2] means 1 agent from first category (e.g. one buyer) and 2 agents from second category (e.g. two sellers).
+        :param max_iterations: if given, an upper bound on the number of procurement-sets in the trade.
         :param include_zero_gft_ps: whether or not to include in the optimal trade procurement-sets with GFT = 0.
 
         :return: a list of procurement-sets, and a remaining market.
@@ -160,20 +162,58 @@ class Market:
                 "There are {} categories but {} elements in the PS recipe".
                     format(num_categories, len(ps_recipe)))
 
-        trade = []
+        num_of_deals = self.optimal_num_of_deals(ps_recipe, include_zero_gft_ps)
+        if max_iterations is not None:
+            num_of_deals = min(num_of_deals, max_iterations)
+
+        highest_values = [category.highest_agent_values_array(num_of_deals*recipe_i) if category.storage == "array"
+                          else category.highest_agent_values(num_of_deals*recipe_i)
+                          for (category, recipe_i) in zip(self.categories, ps_recipe)]
+        trade = TradeWithMaterialBalance.from_highest_values(highest_values, ps_recipe, num_of_deals)
+
         remaining_market = self.clone()
-        for iteration in range(max_iterations):
-            ps = remaining_market.get_highest_agents(ps_recipe)
-            if ps is None:
-                break      # Either there are not enough traders in one of the categories, or the GFT is negative, so we cannot create any more positive procurement-sets.
-            gft = sum(ps)
-            if gft < 0 or (gft == 0 and not include_zero_gft_ps):
-                break
+        for (category, recipe_i) in zip(remaining_market.categories, ps_recipe):
+            category.remove_highest_agents(num_of_deals*recipe_i)
+        return (trade, remaining_market)
+
+
+    def optimal_num_of_deals(self, ps_recipe:list, include_zero_gft_ps:bool=True)->int:
+        """
+        Calculate the number of procurement-sets in the optimal trade, without constructing them.
+        Since every category is sorted, the j-th PS takes the j-th block of ps_recipe[i] agents from each category i,
+        and the GFT of the PS-s is non-increasing in j. So the optimal number of deals is the number of
+        leading blocks whose summed values are positive (or zero, if include_zero_gft_ps), found by binary search.
 
-            trade.append(tuple(ps))
-            remaining_market.remove_highest_agents(ps_recipe)
-        trade.sort(key=lambda ps: sum(ps)) # sort in increasing order of GFT
-        return (TradeWithMaterialBalance(trade), remaining_market)
+        >>> market = Market([AgentCategory("buyer", [9, 7, 11, 5]), AgentCategory("seller",[-4,-6,-8,-2])])
+        >>> market.optimal_num_of_deals([1,1]), market.optimal_num_of_deals([1,2]), market.optimal_num_of_deals([2,1])
+        (3, 1, 2)
+        >>> market = Market([AgentCategory("buyer", [6, 5, 4]), AgentCategory("seller",[-4,-5,-6])])
+        >>> market.optimal_num_of_deals([1,1]), market.optimal_num_of_deals([1,1], include_zero_gft_ps=False)
+        (2, 1)
+        """
+        relevant = [(category, recipe_i) for (category, recipe_i) in zip(self.categories, ps_recipe) if recipe_i > 0]
+        if len(relevant) == 0:
+            return 0
+        max_num_of_deals = min(len(category) // recipe_i for (category, recipe_i) in relevant)
+        if max_num_of_deals == 0:
+            return 0
+
+        # The GFT of every potential PS, in descending order:
+        blocks = [category.highest_agent_values_array(max_num_of_deals*recipe_i).reshape(max_num_of_deals, recipe_i)
+                  for (category, recipe_i) in relevant]
+        gft = sum(block.sum(axis=1) for block in blocks)
+        num_of_deals = int(numpy.searchsorted(-gft, 0, side="right" if include_zero_gft_ps else "left"))
+
+        # Summing floats in a different order may move a GFT that is very close to 0 across 0,
+        # so decide the boundary PS-s with the same left-to-right sum used by the PS tuples.
+        def is_in_trade(deal:int)->bool:
+            ps_gft = sum(value for block in blocks for value in block[deal].tolist())
+            return ps_gft > 0 or (ps_gft == 0 and include_zero_gft_ps)
+        while num_of_deals > 0 and not is_in_trade(num_of_deals-1):
+            num_of_deals -= 1
+        while num_of_deals < max_num_of_deals and is_in_trade(num_of_deals):
+            num_of_deals += 1
+        return num_of_deals
 
 
     def best_containing_PS(self, category_index:int, value:float):
@@ -229,6 +269,71 @@ class Market:
 
 
 
+# Batches of markets
+# ------------------
+# The batch versions of the auction protocols run on many markets with the same shape at once.
+# A batch is given as a list with one array per category, of shape (num_of_markets, n_i),
+# where row m contains the values of the agents of category i in market m, sorted in descending order.
+
+def batch_categories(values, ps_recipe:list)->list:
+    """
+    :param values: a list of per-category arrays as above, or an array of shape (num_of_markets, num_of_categories, n).
+    :return: the list of per-category arrays.
+
+    >>> [category.shape for category in batch_categories(numpy.zeros((5, 2, 3)), [1, 1])]
+    [(5, 3), (5, 3)]
+    >>> batch_categories([numpy.zeros((5, 3))], [1, 1])
+    Traceback (most recent call last):
+    ...
+    ValueError: There are 1 categories but 2 elements in the PS recipe
+    """
+    if isinstance(values, numpy.ndarray):
+        if values.ndim != 3:
+            raise ValueError("values should have shape (num_of_markets, num_of_categories, n); {} was given".format(values.shape))
+        categories = [values[:, i, :] for i in range(values.shape[1])]
+    else:
+        categories = [numpy.asarray(category) for category in values]
+    if len(ps_recipe) != len(categories):
+        raise ValueError(
+            "There are {} categories but {} elements in the PS recipe".
+                format(len(categories), len(ps_recipe)))
+    if len(set(category.shape[0] for category in categories)) > 1:
+        raise ValueError("All categories should have the same number of markets")
+    return categories
+
+
+def batch_optimal_trade(categories:list, ps_recipe:list, include_zero_gft_ps:bool=True)->tuple:
+    """
+    The batch version of Market.optimal_trade.
+    :return: a tuple (ps_gft, optimal_count, optimal_gft):
+             ps_gft[m,j] is the GFT of the j-th potential PS of market m, summed in the order of the PS tuple (so it is non-increasing in j);
+             optimal_count[m] and optimal_gft[m] are the number of deals and the GFT of the optimal trade of market m.
+
+    >>> categories = [numpy.array([[11, 9, 7, 5], [6, 5, 4, 3]]), numpy.array([[-2, -4, -6, -8], [-4, -5, -6, -7]])]
+    >>> (ps_gft, optimal_count, optimal_gft) = batch_optimal_trade(categories, [1,1])
+    >>> ps_gft.tolist(), optimal_count.tolist(), optimal_gft.tolist()
+    ([[9, 5, 1, -3], [2, 0, -2, -4]], [3, 2], [15, 2])
+    >>> batch_optimal_trade(categories, [1,2])[1].tolist(), batch_optimal_trade(categories, [1,1], include_zero_gft_ps=False)[1].tolist()
+    ([1, 0], [3, 1])
+    """
+    num_of_markets = categories[0].shape[0]
+    max_num_of_deals = min(category.shape[1] // recipe_i for (category, recipe_i) in zip(categories, ps_recipe) if recipe_i > 0)
+    ps_gft = None
+    for (category, recipe_i) in zip(categories, ps_recipe):
+        for offset in range(recipe_i):
+            values = category[:, offset:max_num_of_deals*recipe_i:recipe_i]
+            ps_gft = values if ps_gft is None else ps_gft + values
+    if ps_gft is None:
+        ps_gft = numpy.zeros((num_of_markets, 0))
+    # Since the categories are sorted, ps_gft is non-increasing (also when rounding floats), so the optimal PS-s are a prefix:
+    in_optimal_trade = (ps_gft >= 0) if include_zero_gft_ps else (ps_gft > 0)
+    optimal_count = in_optimal_trade.sum(axis=1)
+    optimal_gft = numpy.cumsum(numpy.where(in_optimal_trade, ps_gft, 0)[:, ::-1], axis=1)[:, -1] if max_num_of_deals > 0 \
+        else numpy.zeros(num_of_markets, dtype=ps_gft.dtype)   # summed in increasing order of GFT, like TradeWithMaterialBalance
+    return (ps_gft, optimal_count, optimal_gft)
+
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
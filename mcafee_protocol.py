@@ -10,10 +10,10 @@ Since:  2019-11
 
 
 from agents import AgentCategory
-from markets import Market
-from trade import TradeWithSinglePrice
+from markets import Market, batch_categories, batch_optimal_trade
+from trade import TradeWithSinglePrice, BatchTradeWithSinglePrice
 
-import logging, sys
+import logging, numpy, sys
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 # To enable tracing, set logger.setLevel(logging.INFO)
@@ -154,11 +154,11 @@ def mcafee_trade_reduction(market:Market, ps_recipe:list, price_heuristic=True):
     for category in remaining_market.categories:
         if len(category)==0:
             category.append(-MAX_VALUE)
-    logger.info("Optimal trade, by increasing GFT: {}".format(optimal_trade))
+    logger.info("Optimal trade, by increasing GFT: %s", optimal_trade)
     first_negative_ps = remaining_market.get_highest_agents(ps_recipe)
     if price_heuristic:
         price_candidate = sum([abs(x) for x in first_negative_ps]) / len(first_negative_ps)
-        logger.info("First negative PS: {}, candidate price: {}".format(first_negative_ps, price_candidate))
+        logger.info("First negative PS: %s, candidate price: %s", first_negative_ps, price_candidate)
     actual_traders = market.empty_agent_categories()
 
     if optimal_trade.num_of_deals()>0:
@@ -174,10 +174,8 @@ def mcafee_trade_reduction(market:Market, ps_recipe:list, price_heuristic=True):
             del optimal_trade.procurement_sets[0]
             prices = last_positive_ps
 
-        for ps in optimal_trade.procurement_sets:
-            for i in range(market.num_categories):
-                if ps[i] is not None:
-                    actual_traders[i].append(ps[i])
+        for i in range(market.num_categories):
+            actual_traders[i].append([ps[i] for ps in optimal_trade.procurement_sets if ps[i] is not None])
     else:
         prices = [0 for i in range(market.num_categories)]
 
@@ -185,6 +183,82 @@ def mcafee_trade_reduction(market:Market, ps_recipe:list, price_heuristic=True):
     return TradeWithSinglePrice(actual_traders, ps_recipe, prices)
 
 
+def mcafee_trade_reduction_batch(values, ps_recipe:list, price_heuristic=True)->BatchTradeWithSinglePrice:
+    """
+    Runs mcafee_trade_reduction on many markets of the same shape at once.
+    :param values: the values of the markets - a list with an array of shape (num_of_markets, n_i) per category,
+                   or an array of shape (num_of_markets, num_of_categories, n); see markets.batch_categories.
+                   The values of each category in each market should be sorted in descending order.
+    :param ps_recipe: a list of ones, as in mcafee_trade_reduction.
+    :param price_heuristic: as in mcafee_trade_reduction.
+    :return: a BatchTradeWithSinglePrice, whose entry m is equal to the result of mcafee_trade_reduction on market m,
+             with the optimal count and GFT of each market.
+
+    >>> values = [[[9.,8.], [-3.,-4.]], [[9.,4.], [-3.,-8.]], [[9.,8.], [-4.,-4.]], [[9.,8.], [-10.,-11.]]]
+    >>> trade = mcafee_trade_reduction_batch(numpy.array(values), [1,1])
+    >>> trade.num_of_deals().tolist(), trade.prices.tolist()
+    ([1, 1, 1, 0], [[8.0, -4.0], [6.0, -6.0], [8.0, -4.0], [0.0, 0.0]])
+    >>> trade.gain_from_trade().tolist(), trade.gain_from_trade(including_auctioneer=False).tolist()
+    ([6.0, 6.0, 5.0, 0.0], [2.0, 6.0, 1.0, 0.0])
+    >>> trade.optimal_count.tolist(), trade.optimal_gft.tolist()
+    ([2, 1, 2, 0], [10.0, 6.0, 9.0, 0.0])
+
+    The results are the same as those of mcafee_trade_reduction on each market:
+
+    >>> generator = numpy.random.default_rng(1)
+    >>> values = [-numpy.sort(-generator.integers(0, 100, (200, 10))), -numpy.sort(-generator.integers(-100, 0, (200, 10)))]
+    >>> trade = mcafee_trade_reduction_batch(values, [1,1])
+    >>> single_trades = [mcafee_trade_reduction(Market([AgentCategory("buyer", values[0][m]), AgentCategory("seller", values[1][m])]), [1,1]) for m in range(200)]
+    >>> all(single.num_of_deals() == trade.num_of_deals()[m] and single.gain_from_trade() == trade.gain_from_trade()[m]
+    ...     and single.gain_from_trade(including_auctioneer=False) == trade.gain_from_trade(including_auctioneer=False)[m]
+    ...     for (m, single) in enumerate(single_trades))
+    True
+    """
+    categories = batch_categories(values, ps_recipe)
+    if any(r!=1 for r in ps_recipe):
+        raise ValueError("Currently, the trade-reduction protocol supports only recipes of ones; {} was given".format(ps_recipe))
+    num_of_markets = categories[0].shape[0]
+    (ps_gft, optimal_count, optimal_gft) = batch_optimal_trade(categories, ps_recipe)
+    has_trade = optimal_count > 0
+
+    # An extra agent with value -MAX_VALUE at the end of each category, like the agent added to an empty remaining category:
+    padded_categories = [numpy.concatenate((category, numpy.full((num_of_markets, 1), -MAX_VALUE, dtype=category.dtype)), axis=1)
+                         for category in categories]
+    def procurement_set(deal_indices):
+        return numpy.stack([numpy.take_along_axis(category, deal_indices[:, None], axis=1)[:, 0] for category in padded_categories], axis=1)
+    first_negative_ps = procurement_set(optimal_count)
+    # The optimal trade is sorted stably in increasing order of GFT, so its first PS is
+    # the first PS whose GFT equals the GFT of the last PS.
+    if ps_gft.shape[1] > 0:
+        last_gft = numpy.take_along_axis(ps_gft, numpy.maximum(optimal_count-1, 0)[:, None], axis=1)
+        lowest_ps_index = numpy.argmax(ps_gft == last_gft, axis=1)
+    else:
+        lowest_ps_index = optimal_count
+    last_positive_ps = procurement_set(lowest_ps_index)
+
+    if price_heuristic:
+        price_candidate = abs(first_negative_ps[:, 0])
+        for i in range(1, len(categories)):
+            price_candidate = price_candidate + abs(first_negative_ps[:, i])
+        price_candidate = price_candidate / len(categories)
+        candidate = price_candidate[:, None]
+        is_price_bad = ((last_positive_ps >= 0) & (candidate > last_positive_ps)) | ((last_positive_ps <= 0) & (-candidate > last_positive_ps))
+        no_reduction = has_trade & ~is_price_bad.any(axis=1)
+        candidate_prices = numpy.where(last_positive_ps < 0, -candidate, candidate)
+    else:
+        no_reduction = numpy.zeros(num_of_markets, dtype=bool)
+        candidate_prices = last_positive_ps
+    reduction = has_trade & ~no_reduction
+    prices = numpy.where(no_reduction[:, None], candidate_prices, numpy.where(reduction[:, None], last_positive_ps, 0))
+
+    # The traders are the agents of the optimal trade, except those of the reduced PS:
+    is_trading = []
+    for category in categories:
+        deals = numpy.arange(category.shape[1])
+        is_trading.append((deals < optimal_count[:, None]) & ~(reduction[:, None] & (deals == lowest_ps_index[:, None])))
+    return BatchTradeWithSinglePrice.from_traders(categories, is_trading, ps_recipe, prices, optimal_count, optimal_gft)
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
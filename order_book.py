@@ -0,0 +1,208 @@
+#!python3
+
+"""
+class OrderBook
+
+The state of a long-lived market, in which traders continuously add and cancel their bids,
+and which is cleared on demand by any of the auction protocols.
+
+Each category keeps a persistent sorted AgentCategory, so adding or cancelling a bid takes O(log n) comparisons
+(plus the shift of the list), and the values are never re-sorted.
+Clearing gives the protocol a snapshot made of clones of these categories, which share their sorted lists (copy-on-write),
+so taking a snapshot takes O(1) time per category. Since the trade returned by the protocol may keep referring to the snapshot,
+the first bid that is added to (or cancelled from) a category after a clearing copies the list of that category once.
+
+Clearing is not incremental: after any bid was added or cancelled, the protocol runs again on the whole snapshot,
+since its trade contains all the remaining agents of each category. The savings, compared to building a new Market
+for every clearing, are in not sorting or copying the bids; the trade of each (protocol, recipe) is reused only
+while no category changes.
+The prefix sums of the values of each category, which give the optimal trade (see optimal_gain_from_trade),
+are recomputed only from the highest changed value downwards.
+
+>>> from ascending_auction_protocol import budget_balanced_ascending_auction
+>>> book = OrderBook(["buyer", "seller"])
+>>> orders = [book.add(0, value) for value in [9, 8, 7]] + [book.add(1, value) for value in [-2, -4, -6]]
+>>> book.clear(budget_balanced_ascending_auction, [1,1])
+buyer: [9, 8]: all 2 agents trade and pay 7
+seller: [-2, -4, -6]: random 2 out of 3 agents trade and pay -7.0
+>>> book.cancel(orders[0]); _ = book.add(1, -3)
+>>> str(book.market())
+'Traders: [buyer: [8, 7], seller: [-2, -3, -4, -6]]'
+>>> book.clear(budget_balanced_ascending_auction, [1,1])
+buyer: [8, 7]: all 2 agents trade and pay 4.0
+seller: [-2, -3]: all 2 agents trade and pay -4
+>>> book.optimal_num_of_deals([1,1]), book.optimal_gain_from_trade([1,1])
+(2, 10)
+"""
+
+from agents import AgentCategory
+from markets import Market
+import bisect, itertools, numpy
+from typing import *
+
+
+class OrderBook:
+    """
+    A sorted order book per category, with bids that can be added and cancelled, and an on-demand clearing.
+
+    >>> from trade_reduction_protocol import budget_balanced_trade_reduction
+    >>> book = OrderBook(["buyer", "seller"])
+    >>> for value in [9, 8, 7, 6]: _ = book.add(0, value)
+    >>> for value in [-1, -2, -3, -10]: _ = book.add(1, value)
+    >>> trade = book.clear(budget_balanced_trade_reduction, [1,1])
+    >>> book.clear(budget_balanced_trade_reduction, [1,1]) is trade    # nothing changed - the trade is reused
+    True
+    >>> _ = book.add(0, 10)
+    >>> book.clear(budget_balanced_trade_reduction, [1,1]) is trade
+    False
+    >>> book.cancel(17)
+    Traceback (most recent call last):
+    ...
+    KeyError: 'There is no order with id 17'
+    """
+
+    def __init__(self, category_names:List[str]):
+        """
+        :param category_names: the names of the categories, e.g. ["buyer", "seller"]. All categories start empty.
+        """
+        self.categories = [AgentCategory.from_sorted(name, []) for name in category_names]
+        self.num_categories = len(self.categories)
+        self.orders = {}                       # maps an order id to (category index, value)
+        self.order_ids = itertools.count()
+        self.trades_cache = {}                 # maps (protocol, recipe) to (category versions, trade)
+        self.prefix_sums_cache = [None] * self.num_categories   # (category version, values array, prefix sums) per category
+        self.highest_changed_values = [None] * self.num_categories   # the highest value added or cancelled since the prefix sums were computed
+
+    def add(self, category_index:int, value:float)->int:
+        """
+        Adds a bid of a new agent to the given category.
+        :return: the id of the new order, for cancelling it.
+        """
+        self.categories[category_index].append(value)
+        self._value_changed(category_index, value)
+        order_id = next(self.order_ids)
+        self.orders[order_id] = (category_index, value)
+        return order_id
+
+    def cancel(self, order_id:int):
+        """
+        Removes the bid with the given order id.
+        """
+        if order_id not in self.orders:
+            raise KeyError("There is no order with id {}".format(order_id))
+        (category_index, value) = self.orders.pop(order_id)
+        self.categories[category_index].remove(value)
+        self._value_changed(category_index, value)
+
+    def _value_changed(self, category_index:int, value:float):
+        highest_changed_value = self.highest_changed_values[category_index]
+        if highest_changed_value is None or value > highest_changed_value:
+            self.highest_changed_values[category_index] = value
+
+    def versions(self)->tuple:
+        return tuple(category.version for category in self.categories)
+
+    def market(self)->Market:
+        """
+        :return: a snapshot of the current bids, as a Market.
+        The categories of the snapshot are clones of the categories of the book, so changing one does not change the other.
+        """
+        return Market([category.clone() for category in self.categories])
+
+    def clear(self, protocol:Callable, ps_recipe:list):
+        """
+        Clears the current market with the given protocol.
+        :param protocol:  an auction protocol that takes a Market and a recipe, e.g. budget_balanced_ascending_auction.
+        :param ps_recipe: a list of integers, one integer per category.
+        :return: the trade returned by the protocol.
+                 If no bid was added or cancelled since the previous clearing with the same protocol and recipe,
+                 the trade of that clearing is returned; otherwise, the protocol runs on a snapshot of all current bids.
+        """
+        key = (protocol, tuple(ps_recipe))
+        versions = self.versions()
+        cached = self.trades_cache.get(key)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+        trade = protocol(self.market(), ps_recipe)
+        self.trades_cache[key] = (versions, trade)
+        return trade
+
+    def prefix_sums(self, category_index:int)->tuple:
+        """
+        :return: (values, prefix sums) of the given category, as NumPy arrays,
+                 where values is sorted in descending order and prefix_sums[j] is the sum of the j highest values.
+        The prefix sums of the values above the highest value changed since the previous call are reused.
+
+        >>> book = OrderBook(["buyer"])
+        >>> orders = [book.add(0, value) for value in [5, 9, 7]]
+        >>> book.prefix_sums(0)[1].tolist()
+        [0, 9, 16, 21]
+        >>> book.cancel(orders[0]); _ = book.add(0, 8)
+        >>> book.prefix_sums(0)[1].tolist()
+        [0, 9, 17, 24]
+        """
+        category = self.categories[category_index]
+        cached = self.prefix_sums_cache[category_index]
+        if cached is not None and cached[0] == category.version:
+            return cached[1:]
+        values = category.highest_agent_values_array(category.size())
+        highest_changed_value = self.highest_changed_values[category_index]
+        if cached is None or highest_changed_value is None:
+            unchanged_count = 0
+        else:
+            # The values above the highest changed value, and their prefix sums, are the same as before:
+            unchanged_count = len(values) - int(numpy.searchsorted(values[::-1], highest_changed_value, side="right"))
+            unchanged_count = min(unchanged_count, len(cached[2]) - 1)
+        if unchanged_count == 0:
+            prefix_sums = numpy.concatenate(([0], numpy.cumsum(values)))
+        else:
+            old_prefix_sums = cached[2]
+            # cumsum adds the values one by one, so the prefix sums are the same as when computing them from scratch:
+            new_prefix_sums = numpy.cumsum(numpy.concatenate((old_prefix_sums[unchanged_count:unchanged_count+1], values[unchanged_count:])))
+            prefix_sums = numpy.concatenate((old_prefix_sums[:unchanged_count], new_prefix_sums))
+        self.prefix_sums_cache[category_index] = (category.version, values, prefix_sums)
+        self.highest_changed_values[category_index] = None
+        return (values, prefix_sums)
+
+    def optimal_num_of_deals(self, ps_recipe:list, include_zero_gft_ps:bool=True)->int:
+        """
+        The number of procurement-sets in the optimal trade of the current market (as in Market.optimal_num_of_deals),
+        found by a binary search on the cached values, in O(k log n) time.
+
+        >>> book = OrderBook(["buyer", "seller"])
+        >>> for value in [9, 7, 11, 5]: _ = book.add(0, value)
+        >>> for value in [-4, -6, -8, -2]: _ = book.add(1, value)
+        >>> book.optimal_num_of_deals([1,1]), book.optimal_num_of_deals([1,2]), book.optimal_num_of_deals([2,1])
+        (3, 1, 2)
+        """
+        relevant = [(self.prefix_sums(i)[0], recipe_i) for (i, recipe_i) in enumerate(ps_recipe) if recipe_i > 0]
+        if len(relevant) == 0:
+            return 0
+        max_num_of_deals = min(len(values) // recipe_i for (values, recipe_i) in relevant)
+
+        # The GFT of each PS is summed left-to-right, like the PS tuples, so it is non-increasing also for floats:
+        def is_in_trade(deal:int)->bool:
+            ps_gft = sum(value for (values, recipe_i) in relevant for value in values[deal*recipe_i:(deal+1)*recipe_i].tolist())
+            return ps_gft > 0 or (ps_gft == 0 and include_zero_gft_ps)
+        return bisect.bisect_left(range(max_num_of_deals), True, key=lambda deal: not is_in_trade(deal))
+
+    def optimal_gain_from_trade(self, ps_recipe:list, include_zero_gft_ps:bool=True)->float:
+        """
+        The GFT of the optimal trade of the current market, calculated from the prefix sums of the categories.
+        Note: for float values, it may differ by rounding from the GFT of Market.optimal_trade,
+        since the values are summed per category rather than per PS.
+
+        >>> book = OrderBook(["buyer", "seller"])
+        >>> for value in [9, 7, 11, 5]: _ = book.add(0, value)
+        >>> for value in [-4, -6, -8, -2]: _ = book.add(1, value)
+        >>> book.optimal_gain_from_trade([1,1]), book.optimal_gain_from_trade([1,2])
+        (15, 5)
+        """
+        num_of_deals = self.optimal_num_of_deals(ps_recipe, include_zero_gft_ps)
+        return sum(self.prefix_sums(i)[1][num_of_deals*recipe_i].item() for (i, recipe_i) in enumerate(ps_recipe) if recipe_i > 0)
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
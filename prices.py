@@ -7,7 +7,8 @@ Author: Erel Segal-Halevi
 Since:  2019-12
 """
 
-import logging, sys
+import functools, logging, sys
+from fractions import Fraction
 from typing import *
 
 logger = logging.getLogger(__name__)
@@ -34,23 +35,59 @@ class AscendingPriceVector:
     Represents a vector of prices - one price for each category of agents.
     The vector is used in ascending-prices auctions: the price can be increased until the price-sum hits zero.
     """
-    def __init__(self, ps_recipe:list, initial_price):
+    def __init__(self, ps_recipe:list, initial_price, exact:bool=False):
+        """
+        :param exact: if True, the prices are kept as Fractions, so the price-sum is maintained without rounding errors.
+        """
         self.num_categories = len(ps_recipe)
         self.ps_recipe = ps_recipe
         self.prices = initial_price if isinstance(initial_price,list) else [initial_price] * self.num_categories
+        self.exact = exact
+        if exact:
+            self.prices = [Fraction(price) for price in self.prices]
+        self.price_sum_cache = 0   # updated on every price change
+        self.price_sum_error = 0   # the rounding error accumulated in price_sum_cache
+        for (weight, price) in zip(self.ps_recipe, self.prices):
+            self._add_to_price_sum(weight*price)
         self.status = None  # status of the latest price-increase operation. Of type PriceStatus.
 
     def __getitem__(self, category_index:int):
         return self.prices[category_index]
 
     def __setitem__(self, category_index:int, new_price:float):
+        if self.exact:
+            new_price = Fraction(new_price)
+        self._add_to_price_sum(-self.ps_recipe[category_index]*self.prices[category_index])
+        self._add_to_price_sum(self.ps_recipe[category_index]*new_price)
         self.prices[category_index] = new_price
 
+    def _add_to_price_sum(self, amount:float):
+        # Neumaier's compensated summation: the rounding error of the running sum is kept in a separate term,
+        # so that large prices (such as the initial -MAX_VALUE) do not swamp the small ones.
+        # With integer or Fraction prices, the error term remains 0.
+        new_sum = self.price_sum_cache + amount
+        if abs(self.price_sum_cache) >= abs(amount):
+            self.price_sum_error += (self.price_sum_cache - new_sum) + amount
+        else:
+            self.price_sum_error += (amount - new_sum) + self.price_sum_cache
+        self.price_sum_cache = new_sum
+
     def price_sum(self):
-        return dot(self.prices, self.ps_recipe)
+        """
+        :return: the sum of prices. Takes O(1) time, since it is updated whenever a price changes.
+
+        >>> p = AscendingPriceVector([1, 2, 0], -10)
+        >>> p[1] = 4; p[2] = 5
+        >>> p.price_sum(), p.price_sum() == dot(p.prices, p.ps_recipe)
+        (-2, True)
+        >>> p = AscendingPriceVector([1, 1], 0.1, exact=True)
+        >>> p[0] = 0.2; p.price_sum() == Fraction(0.1) + Fraction(0.2)
+        True
+        """
+        return self.price_sum_cache + self.price_sum_error
 
     def price_sum_without_category(self, category_index:int):
-        return self.price_sum() - self.ps_recipe[category_index]*self.prices[category_index]
+        return (self.price_sum_cache - self.ps_recipe[category_index]*self.prices[category_index]) + self.price_sum_error
 
     def price_sum_after_increase(self, category_index:int, new_price:float):
         """
@@ -110,12 +147,12 @@ class AscendingPriceVector:
         new_sum = sum_without_category + category_count_in_recipe*new_price
         if new_sum >= sum_upper_bound:
             fixed_new_price = (sum_upper_bound - sum_without_category) / category_count_in_recipe
-            logger.info("{}: while increasing price towards {}, stopped at {} where the price-sum crossed {}".format(description, new_price, fixed_new_price, sum_upper_bound))
-            self.prices[category_index] = fixed_new_price
+            logger.info("%s: while increasing price towards %s, stopped at %s where the price-sum crossed %s", description, new_price, fixed_new_price, sum_upper_bound)
+            self[category_index] = fixed_new_price
             self.status = PriceStatus.STOPPED_AT_ZERO_SUM
         else:
-            logger.info("{}: price increases to {}".format(description, new_price))
-            self.prices[category_index] = new_price
+            logger.info("%s: price increases to %s", description, new_price)
+            self[category_index] = new_price
             self.status = PriceStatus.STOPPED_AT_AGENT_VALUE
 
     def __str__(self):
@@ -196,7 +233,8 @@ class SimultaneousAscendingPriceVectors:
         >>> str(pv)
         '[100.0, -100.0, -80.0, -20.0] PriceStatus.STOPPED_AT_ZERO_SUM'
         """
-        logger.info("  Prices before increase: %s", self.map_category_index_to_price())
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("  Prices before increase: %s", self.map_category_index_to_price())
         logger.info("  Planned increase: %s", increases)
 
         # Verify that there is exactly one increase per recipe
@@ -218,7 +256,7 @@ class SimultaneousAscendingPriceVectors:
             self.status = PriceStatus.STOPPED_AT_ZERO_SUM
             for (category_index, new_price, description) in increases:
                 fixed_new_price = self.vector[category_index] + min_increase
-                logger.info("{}: while increasing price towards {}, stopped at {} where the price-sum crossed {}".format(description, new_price, fixed_new_price, sum_upper_bound))
+                logger.info("%s: while increasing price towards %s, stopped at %s where the price-sum crossed %s", description, new_price, fixed_new_price, sum_upper_bound)
                 self.vector[category_index] = fixed_new_price
 
         else: # min_increase == min_increase_to_new_price:
@@ -226,9 +264,9 @@ class SimultaneousAscendingPriceVectors:
             for (category_index, new_price, description) in increases:
                 fixed_new_price = self.vector[category_index] + min_increase
                 if fixed_new_price == new_price:
-                    logger.info("{}: price increases to {}".format(description, new_price))
+                    logger.info("%s: price increases to %s", description, new_price)
                 else:
-                    logger.info("{}: while increasing price towards {}, stopped at {} where an agent from another category left".format(description, new_price, fixed_new_price, sum_upper_bound))
+                    logger.info("%s: while increasing price towards %s, stopped at %s where an agent from another category left", description, new_price, fixed_new_price)
                 self.vector[category_index] = fixed_new_price
 
 
@@ -237,7 +275,7 @@ class SimultaneousAscendingPriceVectors:
 
 
 
-def calculate_initial_prices(ps_recipes:List[int], max_price_per_category:float)->List[float]:
+def calculate_initial_prices(ps_recipes:List[List[int]], max_price_per_category:float)->List[float]:
     """
     Calculate a vector of initial prices such that
        (a) the sum of prices in all recipes is the same
@@ -246,6 +284,7 @@ def calculate_initial_prices(ps_recipes:List[int], max_price_per_category:float)
     :param max_price_per_category: a negative number indicating the maximum price per category
            (should be smaller than all valuations of traders in this category).
     :return: A vector of initial prices.
+    The result is cached, since many auctions are run with the same recipes.
 
     >>> p = calculate_initial_prices([[1,1,0,0],[1,0,1,1]], -100)
     >>> p[0]
@@ -256,7 +295,50 @@ def calculate_initial_prices(ps_recipes:List[int], max_price_per_category:float)
     -100.0
     >>> p[3]
     -100.0
+    >>> calculate_initial_prices([[1,1,0,0,0],[1,0,1,1,0],[1,0,1,0,1]], -100)
+    [-100.0, -200.0, -100.0, -100.0, -100.0]
     """
+    return list(_calculate_initial_prices(tuple(map(tuple, ps_recipes)), max_price_per_category))
+
+
+@functools.lru_cache(maxsize=None)
+def _calculate_initial_prices(ps_recipes:Tuple[Tuple[int]], max_price_per_category:float)->Tuple[float]:
+    """
+    When every recipe has a category that appears in no other recipe (as in a recipe-tree, where it is the leaf),
+    the prices are determined combinatorially: all prices are max_price_per_category,
+    except that the price of the last such category of each recipe is lowered,
+    so that the price-sum of the recipe equals the price-sum of the deepest recipe.
+    Otherwise, the prices are determined by a linear program.
+
+    Note: when a recipe has several exclusive categories, the optimum is not unique,
+    and the whole adjustment is put on the last of them. This may be a different optimal vertex
+    than the one returned by the linear program, which was used for all recipe sets before:
+
+    >>> _calculate_initial_prices(((1,1,1,1,0,0),(1,0,0,0,1,1)), -100)
+    (-100.0, -100.0, -100.0, -100.0, -100.0, -200.0)
+    >>> _calculate_initial_prices(((1,1,0),(0,1,1)), -100)
+    (-100.0, -100.0, -100.0)
+    >>> _calculate_initial_prices(((1,1,0),(1,0,1),(0,1,1)), -100)   # no category is exclusive to a recipe
+    (-100.0, -100.0, -100.0)
+    """
+    num_categories = len(ps_recipes[0])
+    recipe_counts = [sum(1 for recipe in ps_recipes if recipe[j] > 0) for j in range(num_categories)]
+    exclusive_categories = []
+    for recipe in ps_recipes:
+        exclusive = [j for j in range(num_categories) if recipe[j] > 0 and recipe_counts[j] == 1]
+        if not exclusive:
+            return tuple(_calculate_initial_prices_by_linprog(ps_recipes, max_price_per_category))
+        exclusive_categories.append(exclusive[-1])
+
+    max_price_per_category = float(max_price_per_category)
+    max_depth = max(sum(recipe) for recipe in ps_recipes)
+    prices = [max_price_per_category] * num_categories
+    for (recipe, j) in zip(ps_recipes, exclusive_categories):
+        prices[j] = max_price_per_category * (max_depth - sum(recipe) + recipe[j]) / recipe[j]
+    return tuple(prices)
+
+
+def _calculate_initial_prices_by_linprog(ps_recipes:Tuple[Tuple[int]], max_price_per_category:float)->List[float]:
     num_recipes = len(ps_recipes)
     num_categories = len(ps_recipes[0])
 
@@ -264,18 +346,17 @@ def calculate_initial_prices(ps_recipes:List[int], max_price_per_category:float)
     # variables: 0 (the sum);  1, ..., num_categories-1 [the prices)
     result = linprog(
         [-1] + [0]*num_categories,  # Maximize the (negative) sum of prices
-        A_eq=[ [-1] + recipe for recipe in ps_recipes],  # The sum of prices should equal the sum in each recipe
+        A_eq=[ [-1] + list(recipe) for recipe in ps_recipes],  # The sum of prices should equal the sum in each recipe
         b_eq=[0]*num_recipes,  # The sum of every recipe minus the sum-variable must be 0
         bounds=[(None, max_price_per_category)]*(num_categories+1),
         method="revised simplex"
     )
     if result.status==0:
-        return list(result.x[1:])
+        return [float(price) for price in result.x[1:]]
     else:
         raise ValueError("Cannot determine initial prices: "+result.message)
 
 
-
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
@@ -7,7 +7,8 @@ Author: Erel Segal-Halevi
 Since:  2019-12
 """
 
-import logging, sys
+import functools, logging, sys
+from fractions import Fraction
 from typing import *
 
 logger = logging.getLogger(__name__)
@@ -35,24 +36,61 @@ class AscendingPriceVector:
     Represents a vector of prices - one price for each category of agents.
     The vector is used in ascending-prices auctions: the price can be increased until the price-sum hits zero.
     """
-    def __init__(self, ps_recipe:list, initial_price, agent_counts:list[int]=None):
+    def __init__(self, ps_recipe:list, initial_price, agent_counts:list[int]=None, exact:bool=False):
+        """
+        :param exact: if True, the prices are kept as Fractions, so the price-sum is maintained without rounding errors.
+        """
         self.num_categories = len(ps_recipe)
         self.ps_recipe = ps_recipe
         self.agent_counts = agent_counts if agent_counts else [1] * len(ps_recipe)
         self.prices = initial_price if isinstance(initial_price,list) else [initial_price] * self.num_categories
+        self.exact = exact
+        if exact:
+            self.prices = [Fraction(price) for price in self.prices]
+        self.weights = [count*agent_count for (count, agent_count) in zip(self.ps_recipe, self.agent_counts)]
+        self.price_sum_cache = 0   # updated on every price change
+        self.price_sum_error = 0   # the rounding error accumulated in price_sum_cache
+        for (weight, price) in zip(self.weights, self.prices):
+            self._add_to_price_sum(weight*price)
         self.status = None  # status of the latest price-increase operation. Of type PriceStatus.
 
     def __getitem__(self, category_index:int):
         return self.prices[category_index]
 
     def __setitem__(self, category_index:int, new_price:float):
+        if self.exact:
+            new_price = Fraction(new_price)
+        self._add_to_price_sum(-self.weights[category_index]*self.prices[category_index])
+        self._add_to_price_sum(self.weights[category_index]*new_price)
         self.prices[category_index] = new_price
 
+    def _add_to_price_sum(self, amount:float):
+        # Neumaier's compensated summation: the rounding error of the running sum is kept in a separate term,
+        # so that large prices (such as the initial -MAX_VALUE) do not swamp the small ones.
+        # With integer or Fraction prices, the error term remains 0.
+        new_sum = self.price_sum_cache + amount
+        if abs(self.price_sum_cache) >= abs(amount):
+            self.price_sum_error += (self.price_sum_cache - new_sum) + amount
+        else:
+            self.price_sum_error += (amount - new_sum) + self.price_sum_cache
+        self.price_sum_cache = new_sum
+
     def price_sum(self):
-        return dot(self.prices, self.ps_recipe, self.agent_counts)
+        """
+        :return: the weighted sum of prices. Takes O(1) time, since it is updated whenever a price changes.
+
+        >>> p = AscendingPriceVector([1, 2, 0], -10, [1, 1, 3])
+        >>> p[1] = 4; p[2] = 5
+        >>> p.price_sum(), p.price_sum() == dot(p.prices, p.ps_recipe, p.agent_counts)
+        (-2, True)
+        >>> p = AscendingPriceVector([1, 1], 0.1, exact=True)
+        >>> p[0] = 0.2; p.price_sum() == Fraction(0.1) + Fraction(0.2)
+        True
+        """
+        return self.price_sum_cache + self.price_sum_error
 
     def price_sum_without_category(self, category_index:int):
-        return self.price_sum() - self.ps_recipe[category_index]*self.prices[category_index] * self.agent_counts[category_index]
+        return (self.price_sum_cache - self.weights[category_index]*self.prices[category_index]) + self.price_sum_error
 
     def price_sum_after_increase(self, category_index:int, new_price:float):
         """
@@ -118,12 +156,12 @@ class AscendingPriceVector:
         new_sum = sum_without_category + category_count_in_recipe*new_price
         if new_sum >= sum_upper_bound:
             fixed_new_price = (sum_upper_bound - sum_without_category) / category_count_in_recipe
-            logger.info("{}: while increasing price towards {}, stopped at {} where the price-sum crossed {}".format(description, new_price, fixed_new_price, sum_upper_bound))
-            self.prices[category_index] = fixed_new_price
+            logger.info("%s: while increasing price towards %s, stopped at %s where the price-sum crossed %s", description, new_price, fixed_new_price, sum_upper_bound)
+            self[category_index] = fixed_new_price
             self.status = PriceStatus.STOPPED_AT_ZERO_SUM
         else:
-            logger.info("{}: price increases to {}".format(description, new_price))
-            self.prices[category_index] = new_price
+            logger.info("%s: price increases to %s", description, new_price)
+            self[category_index] = new_price
             self.status = PriceStatus.STOPPED_AT_AGENT_VALUE
 
     def __str__(self):
@@ -206,7 +244,8 @@ class SimultaneousAscendingPriceVectors:
         >>> str(pv)
         '[100.0, -100.0, -80.0, -20.0] PriceStatus.STOPPED_AT_ZERO_SUM'
         """
-        logger.info("  Prices before increase: %s", self.map_category_index_to_price())
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("  Prices before increase: %s", self.map_category_index_to_price())
         logger.info("  Planned increase: %s", increases)
 
         # Verify that there is exactly one increase per recipe
@@ -228,7 +267,7 @@ class SimultaneousAscendingPriceVectors:
             self.status = PriceStatus.STOPPED_AT_ZERO_SUM
             for (category_index, new_price, description) in increases:
                 fixed_new_price = self.vector[category_index] + min_increase * self.agent_counts[category_index]
-                logger.info("{}: while increasing price towards {}, stopped at {} where the price-sum crossed {}".format(description, new_price, fixed_new_price, sum_upper_bound))
+                logger.info("%s: while increasing price towards %s, stopped at %s where the price-sum crossed %s", description, new_price, fixed_new_price, sum_upper_bound)
                 self.vector[category_index] = fixed_new_price
 
         else: # min_increase == min_increase_to_new_price:
@@ -236,9 +275,9 @@ class SimultaneousAscendingPriceVectors:
             for (category_index, new_price, description) in increases:
                 fixed_new_price = self.vector[category_index] + min_increase * self.agent_counts[category_index]
                 if fixed_new_price == new_price:
-                    logger.info("{}: price increases to {}".format(description, new_price))
+                    logger.info("%s: price increases to %s", description, new_price)
                 else:
-                    logger.info("{}: while increasing price towards {}, stopped at {} where an agent from another category left".format(description, new_price, fixed_new_price, sum_upper_bound))
+                    logger.info("%s: while increasing price towards %s, stopped at %s where an agent from another category left", description, new_price, fixed_new_price)
                 self.vector[category_index] = fixed_new_price
 
 
@@ -256,6 +295,7 @@ def calculate_initial_prices(ps_recipes:List[List[int]], max_price_per_category:
     :param max_price_per_category: a negative number indicating the maximum price per category
            (should be smaller than all valuations of traders in this category).
     :return: A vector of initial prices.
+    The result is cached, since many auctions are run with the same recipes.
 
     >>> calculate_initial_prices([[1,1,0,0],[1,0,1,1]], -100)
     [-100.0, -200.0, -100.0, -100.0]
@@ -266,26 +306,42 @@ def calculate_initial_prices(ps_recipes:List[List[int]], max_price_per_category:
     >>> calculate_initial_prices([[2,2,0,0],[1,0,1,3]], -100)
     [-100.0, -200.0, -100.0, -100.0]
     """
-    num_recipes = len(ps_recipes)
-    num_categories = len(ps_recipes[0])
+    return list(_calculate_initial_prices(tuple(map(tuple, ps_recipes)), max_price_per_category))
+
 
-    from scipy.optimize import linprog
-    # variables: 0 (the sum);  1, ..., num_categories-1 [the prices)
-    weighted_depths = []
-    price_vector = [float(max_price_per_category)] * num_categories
+@functools.lru_cache(maxsize=None)
+def _calculate_initial_prices(ps_recipes:Tuple[Tuple[int]], max_price_per_category:float)->Tuple[float]:
+    """
+    The prices are determined combinatorially: all prices are max_price_per_category,
+    except that the price of the last category of each recipe that appears in no other recipe
+    (as in a recipe-tree, where it is the leaf) is lowered,
+    so that the price-sum of the recipe equals the price-sum of the recipe with the largest weighted depth.
+    When some recipe has no such category, the initial prices cannot be determined this way, and a ValueError is raised.
+
+    >>> _calculate_initial_prices(((1,2,0),(0,1,1)), -100)
+    (-100.0, -100.0, -200.0)
+    >>> _calculate_initial_prices(((1,1,0),(1,0,1),(0,1,1)), -100)
+    Traceback (most recent call last):
+    ...
+    ValueError: Cannot determine initial prices: recipe (1, 1, 0) has no category that is not in another recipe
+    """
+    num_categories = len(ps_recipes[0])
+    recipe_counts = [sum(1 for recipe in ps_recipes if recipe[j] > 0) for j in range(num_categories)]
+    exclusive_categories = []
     for recipe in ps_recipes:
-        weighted_depths.append(sum(recipe))
+        exclusive = [j for j in range(num_categories) if recipe[j] > 0 and recipe_counts[j] == 1]
+        if not exclusive:
+            raise ValueError("Cannot determine initial prices: recipe {} has no category that is not in another recipe".format(recipe))
+        exclusive_categories.append(exclusive[-1])
+
+    max_price_per_category = float(max_price_per_category)
+    weighted_depths = [sum(recipe) for recipe in ps_recipes]
     max_weighted_depth = max(weighted_depths)
+    prices = [max_price_per_category] * num_categories
+    for (recipe, weighted_depth, j) in zip(ps_recipes, weighted_depths, exclusive_categories):
+        prices[j] = max_price_per_category * (max_weighted_depth - weighted_depth + recipe[j]) / recipe[j]
+    return tuple(prices)
 
-    for i in range(len(ps_recipes)):
-        recipe = ps_recipes[i]
-        for j in range(num_categories - 1, -1, -1):
-            if recipe[j] > 0:
-                if price_vector[j] != max_price_per_category:
-                    raise ValueError("Cannot determine initial prices: "+str(price_vector))
-                price_vector[j] = float(max_price_per_category * (max_weighted_depth - weighted_depths[i] + recipe[j])/recipe[j])
-                break
-    return price_vector
 
 if __name__ == "__main__":
     import doctest
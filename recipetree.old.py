@@ -319,19 +319,19 @@ class RecipeTree (NodeMixin):
         >>> tree = RecipeTree(categories, [0, [1, [2, [3, [4, None]]]]])
         >>> tree.largest_categories(indices=True)[-1]
         [4]
-        >>> x=categories[4].values.pop()
+        >>> x=categories[4].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [0]
-        >>> x=categories[0].values.pop()
+        >>> x=categories[0].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [1]
-        >>> x=categories[1].values.pop()
+        >>> x=categories[1].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [2]
-        >>> x=categories[2].values.pop()
+        >>> x=categories[2].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [3]
-        >>> x=categories[3].values.pop()
+        >>> x=categories[3].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [4]
         """
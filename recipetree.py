@@ -12,6 +12,7 @@ from typing import *
 from anytree import Node, NodeMixin, RenderTree
 from agents import AgentCategory
 import logging, sys, collections
+import numpy
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +26,239 @@ def flatten(l):
             yield el
 
 
+# The combined values of a subtree, with one element per deal, in descending order of the deal value:
+#   sums:      the combined values (the sum of the values of all agents in the deal);
+#   values:    the value of the agent of the subtree root in each deal;
+#   children:  the index of the child subtree in which each deal continues (None in a leaf);
+#   positions: the position of each deal in the combined values of that child (None in a leaf);
+#   leaves:    the index of the leaf (among the leaves of the subtree) in which each deal ends;
+#   num_of_leaves: the number of leaves in the subtree.
+CombinedValues = collections.namedtuple("CombinedValues", ["sums", "values", "children", "positions", "leaves", "num_of_leaves"])
+
+
+def values_array(category:AgentCategory)->numpy.ndarray:
+    """
+    :return: the values of the agents in the given category, in descending order, as a NumPy array.
+    Values of different types (e.g. ints and floats) are kept as Python objects,
+    so that their sums have the same types as in plain Python.
+
+    >>> values_array(AgentCategory("buyer", [1, 3, 2]))
+    array([3, 2, 1])
+    >>> values_array(AgentCategory("buyer", [1, 3.5]))
+    array([3.5, 1], dtype=object)
+    """
+    if category.storage == "array":
+        values = category.highest_agent_values_array(category.size())
+        return values if values.dtype.kind in "iuf" else values.astype(object)
+    values_list = category.highest_agent_values(category.size())
+    values = numpy.array(values_list)
+    if values.dtype.kind not in "iuf" or (values.dtype.kind == "f" and len(set(map(type, values_list))) > 1):
+        values = numpy.array(values_list, dtype=object)
+    return values
+
+
+def common_type(arrays:List[numpy.ndarray]):
+    """
+    :return: a dtype to which all the given arrays can be converted without changing the result of adding their elements:
+    their common numeric type if all non-empty arrays are of the same kind, or 'object' otherwise.
+    """
+    non_empty = [a for a in arrays if len(a) > 0]
+    if len(non_empty) == 0:
+        return arrays[0].dtype
+    if len(set(a.dtype.kind for a in non_empty)) > 1:
+        return numpy.dtype(object)
+    return numpy.result_type(*non_empty)
+
+
+
+class FlatRecipeTree:
+    """
+    A compiled form of a recipe-tree, for traversals that run in the inner loops of the auctions.
+    The nodes are numbered in pre-order (each node comes before its descendants, and the children of a node are in order),
+    and the tree is kept in flat lists, indexed by node number:
+
+    * category_indices[i]: the index of the category of node i; categories[i]: the category itself; names[i]: its name.
+    * parents[i]: the parent of node i (-1 for the root).
+    * first_children[i], next_siblings[i]: the first child and the next sibling of node i (-1 if none).
+    * subtree_ends[i]: the node after the last descendant of node i, so that the subtree of i is the range [i, subtree_ends[i]).
+
+    >>> categories = [AgentCategory(name, [1]*size) for (name,size) in [("buyer",4), ("seller",3), ("producerA",2), ("producerB",5)]]
+    >>> tree = FlatRecipeTree(categories, [0, [1, None, 2, [3, None]]])
+    >>> tree.category_indices, tree.parents, tree.first_children, tree.next_siblings, tree.subtree_ends
+    ([0, 1, 2, 3], [-1, 0, 0, 2], [1, -1, 3, -1], [-1, 2, -1, -1], [4, 2, 4, 4])
+    >>> list(tree.children(0))
+    [1, 2]
+    >>> tree.num_of_deals()
+    4
+    >>> tree.largest_categories()
+    (5, 4, ['seller', 'producerB'])
+
+    Removing agents through the tree keeps the category sizes up to date incrementally:
+
+    >>> for _ in range(4): tree.remove_lowest_agent(3)
+    >>> tree.sizes, tree.children_sizes
+    ([4, 3, 2, 1], [5, 0, 1, 0])
+    >>> tree.largest_categories()
+    (3, 4, ['seller', 'producerA'])
+
+    Changing a category directly (not through the tree) is noticed by its version:
+
+    >>> categories[1].remove_highest_agents(2); categories[2].append([1]*3)
+    >>> tree.largest_categories()
+    (5, 4, ['seller', 'producerA'])
+    >>> tree.sizes, tree.children_sizes
+    ([4, 1, 5, 1], [6, 0, 1, 0])
+    """
+
+    def __init__(self, categories:List[AgentCategory], ps_recipe_struct:List[Any]):
+        """
+        :param categories: the agent categories of the market.
+        :param ps_recipe_struct: a nested list of category indices and their children, as in the RecipeTree constructor.
+        """
+        self.category_indices = []
+        self.parents = []
+        stack = [(ps_recipe_struct[0], ps_recipe_struct[1], -1)]   # (category index, children struct, parent node)
+        while len(stack) > 0:
+            (category_index, children_struct, parent) = stack.pop()
+            node = len(self.category_indices)
+            self.category_indices.append(category_index)
+            self.parents.append(parent)
+            if children_struct is not None:
+                for child in range(len(children_struct)-2, -1, -2):   # pushed in reverse, so that they are numbered in order
+                    stack.append((children_struct[child], children_struct[child+1], node))
+        self.num_nodes = num_nodes = len(self.category_indices)
+        self.categories = [categories[category_index] for category_index in self.category_indices]
+        self.names = [category.name if isinstance(category, AgentCategory) else category for category in self.categories]
+
+        self.first_children = [-1] * num_nodes
+        self.next_siblings = [-1] * num_nodes
+        last_children = [-1] * num_nodes
+        for node in range(1, num_nodes):
+            parent = self.parents[node]
+            if self.first_children[parent] == -1:
+                self.first_children[parent] = node
+            else:
+                self.next_siblings[last_children[parent]] = node
+            last_children[parent] = node
+
+        self.subtree_ends = list(range(1, num_nodes+1))
+        for node in range(num_nodes-1, 0, -1):   # descendants before ancestors
+            parent = self.parents[node]
+            self.subtree_ends[parent] = max(self.subtree_ends[parent], self.subtree_ends[node])
+
+        self.market_categories = categories
+        self.nodes_of_category = {}
+        for node in range(num_nodes):
+            self.nodes_of_category.setdefault(self.category_indices[node], []).append(node)
+        self.sizes = None            # sizes[i] = the size of the category of node i; maintained once agents are removed through the tree.
+        self.children_sizes = None   # children_sizes[i] = the combined size of the categories of the children of node i.
+        self.versions = None         # versions[i] = the version of the category of node i for which sizes[i] is correct.
+
+    def track_sizes(self):
+        """
+        Computes the size aggregates from the current categories.
+        From now on, they are updated by remove_lowest_agent.
+        They are computed again when a category is changed in any other way (as indicated by its version).
+        """
+        self.sizes = [category.size() for category in self.categories]
+        self.versions = [category.version for category in self.categories]
+        self.children_sizes = [0] * self.num_nodes
+        for node in range(1, self.num_nodes):
+            self.children_sizes[self.parents[node]] += self.sizes[node]
+
+    def sizes_are_tracked(self)->bool:
+        """
+        :return: whether the size aggregates are correct for the current categories.
+        """
+        return self.versions is not None and all(category.version == version for (category, version) in zip(self.categories, self.versions))
+
+    def remove_lowest_agent(self, category_index:int):
+        """
+        Removes the lowest agent of the given category, and updates the size aggregates of its nodes and their parents.
+        """
+        if not self.sizes_are_tracked():
+            self.track_sizes()
+        category = self.market_categories[category_index]
+        category.remove_lowest_agent()
+        for node in self.nodes_of_category.get(category_index, ()):
+            self.sizes[node] -= 1
+            self.versions[node] = category.version
+            parent = self.parents[node]
+            if parent >= 0:
+                self.children_sizes[parent] -= 1
+
+    def children(self, node:int):
+        child = self.first_children[node]
+        while child != -1:
+            yield child
+            child = self.next_siblings[child]
+
+    def num_of_deals(self)->int:
+        """
+        Calculates the maximum number of deals that can be done using the recipes in this recipe-tree.
+        """
+        num_of_deals = [category.size() for category in self.categories]
+        children_num_of_deals = [0] * self.num_nodes
+        for node in range(self.num_nodes-1, -1, -1):   # descendants before ancestors
+            if self.first_children[node] != -1:
+                num_of_deals[node] = min(children_num_of_deals[node], num_of_deals[node])
+            if node > 0:
+                children_num_of_deals[self.parents[node]] += num_of_deals[node]
+        return num_of_deals[0]
+
+    def num_of_deals_with_bounds(self)->(int,int,int):
+        """
+        :return: (num_of_deals, kmin, kmax), as in RecipeTree.num_of_deals_explained, without the explanation.
+        kmin and kmax are the smallest and largest leaf categories.
+
+        >>> categories = [AgentCategory(name, [1]*size) for (name,size) in [("buyer",4), ("seller",3), ("producerA",2), ("producerB",5)]]
+        >>> FlatRecipeTree(categories, [0, [1, None, 2, [3, None]]]).num_of_deals_with_bounds()
+        (4, 3, 5)
+        """
+        num_of_deals = [category.size() for category in self.categories]
+        children_num_of_deals = [0] * self.num_nodes
+        kmins = list(num_of_deals)
+        kmaxs = list(num_of_deals)
+        for node in range(self.num_nodes-1, -1, -1):   # descendants before ancestors
+            if self.first_children[node] != -1:
+                num_of_deals[node] = min(children_num_of_deals[node], num_of_deals[node])
+                children = list(self.children(node))
+                kmins[node] = min(kmins[child] for child in children)
+                kmaxs[node] = max(kmaxs[child] for child in children)
+            if node > 0:
+                children_num_of_deals[self.parents[node]] += num_of_deals[node]
+        return (num_of_deals[0], kmins[0], kmaxs[0])
+
+    def largest_categories(self, indices=False) -> (int,int,list):
+        """
+        See RecipeTree.largest_categories.
+        A node is selected if its category is larger than the categories of all its children together
+        (or if its children are empty); otherwise, the selection continues in its children.
+        """
+        if self.sizes is not None and not self.sizes_are_tracked():
+            self.track_sizes()   # a category was changed not through the tree
+        if self.sizes is None:
+            sizes = [category.size() for category in self.categories]
+            children_sizes = [0] * self.num_nodes
+            for node in range(1, self.num_nodes):
+                children_sizes[self.parents[node]] += sizes[node]
+        else:
+            sizes = self.sizes
+            children_sizes = self.children_sizes
+        largest_category_size = 0
+        largest_categories = []
+        node = 0
+        while node < self.num_nodes:
+            children_category_size = children_sizes[node]
+            if sizes[node] > children_category_size or children_category_size == 0:
+                largest_category_size = max(largest_category_size, sizes[node])
+                largest_categories.append(self.category_indices[node] if indices else self.names[node])
+                node = self.subtree_ends[node]   # skip the descendants of the selected node
+            else:
+                node += 1                         # continue to the first child
+        return (largest_category_size, sizes[0], largest_categories)
+
+
 
 class RecipeTree (NodeMixin):
     """
@@ -161,6 +395,9 @@ class RecipeTree (NodeMixin):
         if len(category_indices)%2!=0:
             raise ValueError("RecipeTree must be initialized with an even-length list, containing indices and their children.")
         self.num_categories = len(categories)
+        self.categories = categories
+        self.ps_recipe_struct = category_indices
+        self.flat_tree = None   # a FlatRecipeTree of this subtree; built on first use
         if agent_counts is None:
             agent_counts = [1] * self.num_categories
         self_index = category_indices[0]
@@ -169,6 +406,7 @@ class RecipeTree (NodeMixin):
         self.category_index = self_index
         self.category = self_category = categories[self_index]
         self.name = self_category.name if isinstance(self_category, AgentCategory) else self_category
+        self.combined_values_cache = None   # (category version and size, combined values of the children, CombinedValues)
 
         if children_indices is not None:
             children = []
@@ -179,6 +417,15 @@ class RecipeTree (NodeMixin):
 
 
 
+    def flat(self)->FlatRecipeTree:
+        """
+        :return: the compiled form of the subtree rooted at this node, for fast traversals.
+        The anytree view (children, RenderTree etc.) remains available; the two should not be restructured after construction.
+        """
+        if self.flat_tree is None:
+            self.flat_tree = FlatRecipeTree(self.categories, self.ps_recipe_struct)
+        return self.flat_tree
+
     def paths_to_leaf(self, indices=False, prefix=[]) -> List[List[Any]]:
         """
         Get all paths from this node to a leaf.
@@ -226,20 +473,52 @@ class RecipeTree (NodeMixin):
 
 
 
+    def combined_values_arrays(self) -> CombinedValues:
+        """
+        Combine the values in all categories of the current subtree, in a single bottom-up pass.
+        Categories in siblings are combined by merging their (already sorted) combined values in descending order.
+        Categories in parent-child are combined by creating elementwise sums.
+        The result is memoized in each node, and recomputed only when the category of some node in the subtree has changed
+        (as indicated by its version).
+        Serves combined_values, combined_values_detailed and combined_values_detailed_with_counters.
+        """
+        children_combined = [child.combined_values_arrays() for child in self.children]
+        key = (self.category.version, self.category.size())
+        if self.combined_values_cache is not None:
+            (cached_key, cached_children_combined, cached_combined) = self.combined_values_cache
+            if cached_key == key and all(a is b for (a, b) in zip(cached_children_combined, children_combined)):
+                return cached_combined
+
+        self_values = values_array(self.category)
+        if len(children_combined) == 0:
+            combined = CombinedValues(sums=self_values, values=self_values, children=None, positions=None,
+                                      leaves=numpy.zeros(len(self_values), dtype=int), num_of_leaves=1)
+        else:
+            children_sums = [child_combined.sums for child_combined in children_combined]
+            dtype = common_type([self_values] + children_sums)
+            children_sums = numpy.concatenate([sums.astype(dtype, copy=False) for sums in children_sums])
+            # A stable sort of the concatenated (descending) runs is a k-way merge; ties are kept in the order of the children.
+            num_of_deals = min(len(self_values), len(children_sums))
+            order = numpy.argsort(-children_sums, kind="stable")[:num_of_deals]
+            children_sizes = [len(child_combined.sums) for child_combined in children_combined]
+            children = numpy.repeat(numpy.arange(len(children_combined)), children_sizes)
+            positions = numpy.concatenate([numpy.arange(size, dtype=int) for size in children_sizes])
+            leaf_offsets = numpy.cumsum([0] + [child_combined.num_of_leaves for child_combined in children_combined])
+            leaves = numpy.concatenate([child_combined.leaves + offset for (child_combined, offset) in zip(children_combined, leaf_offsets)])
+            values = self_values[:num_of_deals].astype(dtype, copy=False)
+            combined = CombinedValues(sums=values + children_sums[order], values=values,
+                                      children=children[order], positions=positions[order],
+                                      leaves=leaves[order], num_of_leaves=int(leaf_offsets[-1]))
+        self.combined_values_cache = (key, children_combined, combined)
+        return combined
+
     def combined_values(self) -> list:
         """
         Combine the values in all categories of the current subtree into a single value-list.
         Categories in siblings are combined by uniting the sets and sorting it in descending order.
         Categories in parent-child are combined by sorting each set in descending order and creating elementwise sums.
         """
-        self_values = self.category.values
-        if len(self.children) == 0:
-            values = self_values
-        else:
-            children_values = sum([child.combined_values() for child in self.children], [])
-            children_values.sort(reverse=True)
-            values = [a+b for (a,b) in zip(self_values, children_values)]
-        return values
+        return self.combined_values_arrays().sums.tolist()
 
 
     def combined_values_detailed_with_counters(self) -> list:
@@ -248,32 +527,16 @@ class RecipeTree (NodeMixin):
         Categories in siblings are combined by uniting the sets and sorting it in descending order.
         Categories in parent-child are combined by sorting each set in descending order and creating elementwise sums.
 
-        Similar to combined_values, but keeps all the summed-up values instead of just the sum.
+        Similar to combined_values, but pairs each sum with a counter object, which is shared by all deals of the same recipe
+        (= the same path from root to leaf), and can be used to count the deals of each recipe.
+
+        >>> buyer, seller = AgentCategory("buyer", [60, 40, 20]), AgentCategory("seller", [-10, -30, -50, -70])
+        >>> RecipeTree([buyer, seller], [0, [1, None]]).combined_values_detailed_with_counters()
+        [(50, {'counter': 0}), (10, {'counter': 0}), (-30, {'counter': 0})]
         """
-        self_values = self.category.values
-        if len(self.children) == 0:
-            deals_counter = {'counter': 0}
-            values = [(value, deals_counter) for value in self_values]
-        else:
-            #List of lists of tuples of children that each tuple has agent value and counter object to count the k for each path
-            children_combined_values_detailed_list = [child.combined_values_detailed_with_counters() for child in self.children]
-            #put all together:
-            children_values = []
-            for child in self.children:
-                children_values = children_values + child.combined_values_detailed_with_counters()
-            #Sort
-            children_values.sort(reverse=True, key=lambda x: x[0])
-            #Sort the parent
-            self_values.sort(reverse=True)
-            #Get the min size
-            min_len = min(len(self_values), len(children_values))
-            #sum the parent with its child value
-            for i in range(min_len):
-                children_values[i] = (children_values[i][0] + self_values[i], children_values[i][1])
-            values = children_values[0: min_len]
-
-            logger.debug("children_values: %s", values)
-        return values
+        combined = self.combined_values_arrays()
+        deals_counters = [{'counter': 0} for _ in range(combined.num_of_leaves)]
+        return [(value, deals_counters[leaf]) for (value, leaf) in zip(combined.sums.tolist(), combined.leaves.tolist())]
 
     def combined_values_detailed(self) -> list:
         """
@@ -283,15 +546,20 @@ class RecipeTree (NodeMixin):
 
         Similar to combined_values, but keeps all the summed-up values instead of just the sum.
         """
-        self_values = self.category.values
         if len(self.children) == 0:
-            values = self_values
-        else:
-            children_values = sum([child.combined_values_detailed() for child in self.children], [])
-            # logger.debug("children_values: %s",children_values)
-            children_values.sort(reverse=True, key=lambda x: sum(x) if (isinstance(x,list) or isinstance(x,tuple)) else x)
-            values = [tuple(flatten(t)) for t in zip(self_values, children_values)]
-        return values
+            return self.combined_values_arrays().values.tolist()
+        return self._deals_detailed()
+
+    def _deals_detailed(self) -> List[tuple]:
+        """
+        :return: for each deal in the combined values of the current subtree, the tuple of values of the agents in the deal.
+        """
+        combined = self.combined_values_arrays()
+        if len(self.children) == 0:
+            return [(value,) for value in combined.values.tolist()]
+        children_deals = [child._deals_detailed() for child in self.children]
+        return [(value,) + children_deals[child][position]
+                for (value, child, position) in zip(combined.values.tolist(), combined.children.tolist(), combined.positions.tolist())]
 
     def optimal_trade_with_counters(self)->(list,int,float, int, int):
         """
@@ -385,44 +653,30 @@ class RecipeTree (NodeMixin):
         >>> tree = RecipeTree(categories, [0, [1, [2, [3, [4, None]]]]])
         >>> tree.largest_categories(indices=True)[-1]
         [4]
-        >>> x=categories[4].values.pop()
+        >>> x=categories[4].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [3]
-        >>> x=categories[3].values.pop()
+        >>> x=categories[3].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [2]
-        >>> x=categories[2].values.pop()
+        >>> x=categories[2].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [1]
-        >>> x=categories[1].values.pop()
+        >>> x=categories[1].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [0]
-        >>> x=categories[0].values.pop()
+        >>> x=categories[0].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [4]
-        """
-        self_category_size = self.category.size()
-        self_category_index_or_name = self.category_index if indices else self.name
 
-        children_category_size = sum([child.category.size() for child in self.children], 0)
-        # print("self_category_size: ",self_category_size)
-        # print("children_category_size: ",children_category_size)
-        if self_category_size > children_category_size or children_category_size==0:
-            largest_category_size = combined_category_size = self_category_size
-            largest_categories = [self_category_index_or_name]
-        else:
-            children_combined_category_size = 0
-            children_largest_category_size = 0
-            children_largest_categories = []
-            for child in self.children:
-                (child_largest_category_size, child_combined_category_size, child_largest_categories) = child.largest_categories(indices=indices)
-                children_largest_category_size = max(children_largest_category_size,child_largest_category_size)
-                children_combined_category_size += child_combined_category_size
-                children_largest_categories += child_largest_categories
-            largest_category_size = children_largest_category_size
-            combined_category_size = self_category_size
-            largest_categories = children_largest_categories
-        return (largest_category_size, combined_category_size, largest_categories)
+        The sizes kept by removals through the tree are recomputed after a category is changed directly:
+
+        >>> tree.flat().remove_lowest_agent(4); tree.largest_categories(indices=True)[-1]
+        [3]
+        >>> categories[4].append([33, 44]); tree.largest_categories(indices=True)[-1]
+        [4]
+        """
+        return self.flat().largest_categories(indices=indices)
 
 
     def num_of_deals(self)->int:
@@ -430,13 +684,42 @@ class RecipeTree (NodeMixin):
         Calculates the maximum number of deals that can be done using the recipes in this recipe-tree.
         :return:
         """
-        self_num_of_deals = self.category.size()
-        if len(self.children) == 0:
-            num_of_deals = self_num_of_deals
-        else:
-            sum_children_num_of_deals = sum([child.num_of_deals() for child in self.children])
-            num_of_deals = min(sum_children_num_of_deals,self_num_of_deals)
-        return num_of_deals
+        return self.flat().num_of_deals()
+
+
+    def remove_lowest_agent(self, category_index:int):
+        """
+        Removes the lowest agent of the given category,
+        and updates the category sizes that largest_categories uses.
+
+        >>> categories = [AgentCategory(str(index), [22,11]) for index in range(3)]
+        >>> tree = RecipeTree(categories, [0, [1, None, 2, None]])
+        >>> tree.largest_categories(indices=True)
+        (2, 2, [1, 2])
+        >>> tree.remove_lowest_agent(1); tree.remove_lowest_agent(2)
+        >>> tree.largest_categories(indices=True)
+        (1, 2, [1, 2])
+        >>> tree.remove_lowest_agent(2)
+        >>> tree.largest_categories(indices=True)
+        (2, 2, [0])
+        >>> categories[1].size()
+        1
+        """
+        self.flat().remove_lowest_agent(category_index)
+
+
+    def num_of_deals_with_bounds(self)->(int,int,int):
+        """
+        :return: (num_of_deals, kmin, kmax) - the numeric part of num_of_deals_explained.
+
+        >>> categories = [AgentCategory("buyer", [9,8,7,6]), AgentCategory("seller", [-1,-2,-3]), AgentCategory("A", [-1,-2]), AgentCategory("B", [-1,-2,-3,-4,-5])]
+        >>> tree = RecipeTree(categories, [0, [1, None, 2, [3, None]]])
+        >>> tree.num_of_deals_with_bounds()
+        (4, 3, 5)
+        >>> (n, _, kmin, kmax) = tree.num_of_deals_explained(prices=[1,2,3,4]); (n, kmin, kmax)
+        (4, 3, 5)
+        """
+        return self.flat().num_of_deals_with_bounds()
 
 
     def num_of_deals_explained(self, prices:List[float], add_num_of_overall_deals=True)-> tuple[
@@ -374,8 +374,8 @@ class RecipeTree (NodeMixin):
         #values = self_values
         #else:
         if len(self.children) > 0:
-            #the sum of lists of lists opens the lists to one list.
-            children_values = sum([child.combined_values() for child in self.children],[])
+            #concatenate the lists of value-sets of all children (in linear time).
+            children_values = [value_set for child in self.children for value_set in child.combined_values()]
             children_values.sort(key=sum, reverse=True)
             value_sets = [[*a , *b] for (a,b) in zip(value_sets, children_values)]
         return value_sets
@@ -432,7 +432,7 @@ class RecipeTree (NodeMixin):
                 current_set = []
 
         if len(self.children) > 0:
-            children_values = sum([child.combined_values() for child in self.children],[])
+            children_values = [value_set for child in self.children for value_set in child.combined_values()]
             children_values.sort(key=sum, reverse=True)
             #Get the min size
             min_len = min(len(value_sets), len(children_values))
@@ -571,19 +571,19 @@ class RecipeTree (NodeMixin):
         >>> tree = RecipeTree(categories, [0, [1, [2, [3, [4, None]]]]])
         >>> tree.largest_categories(indices=True)[-1]
         [4]
-        >>> x=categories[4].values.pop()
+        >>> x=categories[4].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [3]
-        >>> x=categories[3].values.pop()
+        >>> x=categories[3].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [2]
-        >>> x=categories[2].values.pop()
+        >>> x=categories[2].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [1]
-        >>> x=categories[1].values.pop()
+        >>> x=categories[1].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [0]
-        >>> x=categories[0].values.pop()
+        >>> x=categories[0].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [4]
 
@@ -591,19 +591,19 @@ class RecipeTree (NodeMixin):
         >>> tree = RecipeTree(categories, [0, [1, [2, [3, [4, None]]]]], [1,2,1,2,1,1,1,1,1,1])
         >>> tree.largest_categories(indices=True)[-1]
         [0]
-        >>> x=categories[0].values.pop()
+        >>> x=categories[0].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [2]
-        >>> x=categories[2].values.pop()
+        >>> x=categories[2].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [4]
-        >>> x=categories[4].values.pop()
+        >>> x=categories[4].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [4]
-        >>> x=categories[4].values.pop()
+        >>> x=categories[4].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [3]
-        >>> x=categories[3].values.pop()
+        >>> x=categories[3].values_for_update().pop()
         >>> tree.largest_categories(indices=True)[-1]
         [3]
         """
@@ -646,6 +646,28 @@ class RecipeTree (NodeMixin):
         return num_of_deals
 
 
+    def num_of_deals_with_bounds(self)->(int,int,int):
+        """
+        :return: (num_of_deals, kmin, kmax) - the numeric part of num_of_deals_explained.
+
+        >>> categories = [AgentCategory("buyer", [9,8,7,6]), AgentCategory("seller", [-1,-2,-3]), AgentCategory("A", [-1,-2]), AgentCategory("B", [-1,-2,-3,-4,-5])]
+        >>> tree = RecipeTree(categories, [0, [1, None, 2, [3, None]]])
+        >>> tree.num_of_deals_with_bounds()
+        (4, 3, 5)
+        >>> (n, _, kmin, kmax) = tree.num_of_deals_explained(prices=[1,2,3,4]); (n, kmin, kmax)
+        (4, 3, 5)
+        """
+        self_num_of_deals = floor(self.category.size() / self.agent_count)
+        if len(self.children) == 0:
+            return (self_num_of_deals, self_num_of_deals, self_num_of_deals)
+        children_num_of_deals_with_bounds = [child.num_of_deals_with_bounds() for child in self.children]
+        sum_children_num_of_deals = sum([t[0] for t in children_num_of_deals_with_bounds])
+        children_kmins = [t[1] for t in children_num_of_deals_with_bounds if t[1] > 0]
+        kmin = min(children_kmins) if len(children_kmins) > 0 else 0
+        kmax = max([t[2] for t in children_num_of_deals_with_bounds])
+        return (min(sum_children_num_of_deals,self_num_of_deals), kmin, kmax)
+
+
     def num_of_deals_explained(self, prices:List[float], add_num_of_overall_deals=True)-> tuple[
         Union[int, Any], str, Any, Any]:
         """
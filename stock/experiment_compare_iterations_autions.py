@@ -39,18 +39,53 @@ Since:  2020-08
 """
 
 
-from markets import Market
+from markets import Market, batch_optimal_trade
 from agents import AgentCategory
+from mcafee_protocol import mcafee_trade_reduction, mcafee_trade_reduction_batch
+from trade_reduction_protocol import budget_balanced_trade_reduction, budget_balanced_trade_reduction_batch
+from ascending_auction_protocol import budget_balanced_ascending_auction, budget_balanced_ascending_auction_batch
 
 from tee_table.tee_table import TeeTable
 from collections import OrderedDict
+from functools import partial
 from get_stocks_data import getStocksPricesShuffled
-import random
-from os import path
+import numpy, random
+from os import path, remove
+from typing import *
+from experiment_runner import run_tasks, load_checkpoint, iteration_blocks, DEFAULT_BLOCK_SIZE
+
+# The batch version of each auction function, which runs on all the markets of a block of iterations at once.
+BATCH_AUCTIONS = {
+    mcafee_trade_reduction: mcafee_trade_reduction_batch,
+    budget_balanced_trade_reduction: budget_balanced_trade_reduction_batch,
+    budget_balanced_ascending_auction: budget_balanced_ascending_auction_batch,
+}
+
+def batch_auction(auction_function:Callable)->Optional[Callable]:
+    """
+    :return: the batch version of the given auction function (see BATCH_AUCTIONS), or None if it has none.
+    A functools.partial of an auction function is mapped to the same partial of its batch version.
+    """
+    if isinstance(auction_function, partial):
+        batch_function = batch_auction(auction_function.func)
+        return None if batch_function is None else partial(batch_function, *auction_function.args, **auction_function.keywords)
+    return BATCH_AUCTIONS.get(auction_function)
+
+def function_description(function:Callable)->str:
+    """
+    :return: a description of the given auction function that is the same in all runs (unlike its repr).
+
+    >>> function_description(partial(mcafee_trade_reduction, price_heuristic=False))
+    'mcafee_protocol.mcafee_trade_reduction(price_heuristic=False)'
+    """
+    if isinstance(function, partial):
+        arguments = [repr(argument) for argument in function.args] + ["{}={!r}".format(name, value) for (name, value) in function.keywords.items()]
+        return "{}({})".format(function_description(function.func), ", ".join(arguments))
+    return "{}.{}".format(getattr(function, "__module__", None), getattr(function, "__qualname__", repr(function)))
 
 def experiment(results_csv_file:str, auction_functions:list, auction_names:str, recipe:tuple, nums_of_agents=None,
                stocks_prices:list=None, stock_names:list=None, num_of_iterations=1000, run_with_stock_prices=True,
-               report_diff=False):
+               report_diff=False, num_of_workers:int=1, block_size:int=DEFAULT_BLOCK_SIZE):
     """
     Run an experiment similar to McAfee (1992) experiment on the given auction.
     :param results_csv_file: the experiment result file.
@@ -59,6 +94,14 @@ def experiment(results_csv_file:str, auction_functions:list, auction_names:str,
     :param recipe: can be any vector of ones, e.g. (1,1,1), for our trade-reduction mechanism, or any vector of positive integers for our ascending-auction mechanism.
     :param stocks_prices: list of prices for each stock and each agent.
     :param stock_names: list of stocks names which prices are belongs, for naming only.
+    :param num_of_workers: the number of processes that run the iterations (None = all CPUs). See experiment_runner.
+    :param block_size: the number of iterations in each task. When all the auction functions have batch versions (see BATCH_AUCTIONS),
+                       each auction runs once on all the markets of a block, so larger blocks amortize the per-auction overhead.
+                       Note that the random values depend on the block size.
+
+    The partial results of finished blocks of iterations are kept in a checkpoint file next to the results file.
+    If the experiment is interrupted, running it again with the same parameters resumes from the checkpoint
+    (a checkpoint of other parameters is discarded); the checkpoint is removed when the results file is written.
     """
     TABLE_COLUMNS = ["iterations", "stockname", "recipe", "numpossibletrades", "optimalcount", "gftratioformula",
                      "optimalcountwithgftzero", "optimalgft", "optimalgftwithgftzero"]
@@ -76,148 +119,37 @@ def experiment(results_csv_file:str, auction_functions:list, auction_names:str,
     column_names = TABLE_COLUMNS
     column_names += [auction_name + column for auction_name in auction_names for column in AUCTION_COLUMNS]
     results_table = TeeTable(column_names, results_csv_file)
-    recipe_str = ":".join(map(str,recipe))
-    recipe_sum = sum(recipe)
-    recipe_sum_for_buyer = (recipe_sum-recipe[0])/recipe[0]
     if nums_of_agents is None:
         nums_of_agents = [10000000]
     #print(nums_of_agents)
+    # The prices are sent to each worker once (see set_worker_stocks_prices), and each task refers to its stock by index:
+    tasks = [((stock_names[i], num_of_possible_ps, block), (i, stock_names[i], recipe, num_of_possible_ps, stop-start, num_of_iterations,
+                                               auction_functions, auction_names, run_with_stock_prices, report_diff))
+             for i in range(len(stocks_prices))
+             for num_of_possible_ps in nums_of_agents
+             for (block, (start, stop)) in enumerate(iteration_blocks(num_of_iterations, block_size))]
+    checkpoint_file = path.splitext(results_csv_file)[0] + ".checkpoint.jsonl"   # never the results file itself
+    # A checkpoint of a run with other parameters is discarded:
+    checkpoint_parameters = {"stock_names": list(stock_names), "recipe": list(recipe), "nums_of_agents": list(nums_of_agents),
+                             "num_of_iterations": num_of_iterations, "block_size": block_size,
+                             "auction_names": list(auction_names), "auction_functions": [function_description(f) for f in auction_functions],
+                             "run_with_stock_prices": run_with_stock_prices}
+    if load_checkpoint(checkpoint_file, checkpoint_parameters)[0] is not None:
+        print('Resuming from', checkpoint_file)
+    tasks_results = run_tasks(stock_experiment_iterations, tasks, num_of_workers, checkpoint_file=checkpoint_file,
+                              checkpoint_parameters=checkpoint_parameters, initializer=set_worker_stocks_prices, initargs=(stocks_prices,))
     total_results = {}
-    for num_of_agents_per_category in nums_of_agents:
-        total_results[str(num_of_agents_per_category)] = []
-    #print(total_results)
     for i in range(len(stocks_prices)):
-        stock_prices = stocks_prices[i]
         for num_of_possible_ps in nums_of_agents:
-            for iteration in range(num_of_iterations):
-                categories = []
-                if run_with_stock_prices:
-                    while len(stock_prices) < num_of_possible_ps * recipe_sum:
-                        stock_prices = stock_prices + stock_prices
-                    random.shuffle(stock_prices)
-                    index = 0
-                    for category in recipe:
-                        next_index = index + num_of_possible_ps * category
-                        price_sign = recipe_sum_for_buyer if index == 0 else -1
-                        #price_value_multiple = -1 * buyer_agent_count if index > 0 else recipe_sum - buyer_agent_count
-                        categories.append(AgentCategory("agent", [int(price*price_sign) for price in stock_prices[index:next_index]]))
-                        index = next_index
-                else: #prices from random.
-                    for index in range(len(recipe)):
-                    #for category in recipe:
-                        min_value = -100000 if index > 0 else recipe_sum_for_buyer
-                        max_value = -1 if index > 0 else 100000 * recipe_sum_for_buyer
-                        categories.append(AgentCategory.uniformly_random("agent", num_of_possible_ps*recipe[index],
-                                                                         min_value, max_value))
-                market = Market(categories)
-                (optimal_trade, _) = market.optimal_trade(ps_recipe=list(recipe), max_iterations=10000000, include_zero_gft_ps=False)
-                optimal_count = optimal_trade.num_of_deals()
-                optimal_gft = optimal_trade.gain_from_trade()
-                (optimal_trade_with_gft_zero, _) = market.optimal_trade(ps_recipe=list(recipe), max_iterations=10000000)
-                optimal_count_with_gft_zero = optimal_trade_with_gft_zero.num_of_deals()
-                optimal_gft_with_gft_zero = optimal_trade_with_gft_zero.gain_from_trade()
-
-                results = [("iterations", num_of_iterations),
-                           ("stockname", stock_names[i]),
-                           ("recipe", recipe_str),
-                           ("numpossibletrades", int(num_of_possible_ps)),
-                           ("optimalcount", optimal_count),
-                           ("gftratioformula", (optimal_count - 1) * 100 / (optimal_count if min(recipe) == max(recipe) and recipe[0] == 1 else optimal_count + 1) if optimal_count > 1 else 0),
-                           ("optimalcountwithgftzero", optimal_count_with_gft_zero),
-                           ("optimalgft", optimal_gft),
-                           ("optimalgftwithgftzero", optimal_gft_with_gft_zero)]
-                for auction_index in range(len(auction_functions)):
-                    auction_trade = auction_functions[auction_index](market, recipe)
-                    count = auction_trade.num_of_deals()
-                    total_gft = auction_trade.gain_from_trade(including_auctioneer=True)
-                    market_gft = auction_trade.gain_from_trade(including_auctioneer=False)
-                    auction_name = auction_names[auction_index]
-                    results.append((auction_name + "count", auction_trade.num_of_deals()))
-
-                    results.append((auction_name + "countratio",
-                                    0 if optimal_count==0 else (count / optimal_count_with_gft_zero) * 100))
-                    results.append((auction_name + "totalgft", total_gft))
-                    results.append((auction_name + "totalgftratio", 0 if optimal_gft==0 else total_gft / optimal_gft_with_gft_zero*100))
-                    results.append((auction_name + "marketgft", market_gft))
-                    results.append((auction_name + "marketgftratio",
-                                    0 if optimal_gft == 0 else market_gft / optimal_gft_with_gft_zero * 100))
-                    results.append((auction_name + "withoutgftzerocountratio",
-                                    0 if optimal_count==0 else (count / optimal_count) * 100))
-                    results.append((auction_name + "withoutgftzerototalgft", total_gft))
-                    results.append((auction_name + "withoutgftzerototalgftratio", 0 if optimal_gft==0 else total_gft / optimal_gft*100))
-                #We check which auction did better and print the market and their results.
-                if report_diff:
-                    gft_to_compare = -1
-                    k_to_compare = -1
-                    gft_found = False
-                    k_found = False
-                    for (label, value) in results:
-                        if 'SBB' in label:
-                            if gft_found is False and label.endswith('totalgft'):
-                                if gft_to_compare < 0:
-                                    gft_to_compare = value
-                                elif gft_to_compare != value:
-                                    with open('diff_in_sbbs_gft.txt', 'a') as f:
-                                        f.write('There is diff in gft between two auctions: ' + str(gft_to_compare) + ' ' + str(value) + '\n')
-                                        f.write(str(results) + '\n')
-                                        if num_of_possible_ps < 10:
-                                            f.write(str(market) + '\n')
-                                    gft_found = True
-                            elif k_found is False and label.endswith('count'):
-                                if k_to_compare < 0:
-                                    k_to_compare = value
-                                elif k_to_compare != value:
-                                    with open('diff_in_sbbs_k.txt', 'a') as f:
-                                        f.write('There is diff in gft between two auctions: ' + str(k_to_compare) + ' ' + str(value) + '\n')
-                                        f.write(str(results) + '\n')
-                                        if num_of_possible_ps < 10:
-                                            f.write(str(market) + '\n')
-                                    k_found = True
-                compare_sbbs = True
-                if compare_sbbs:
-                    gft_to_compare = -1
-                    k_to_compare = -1
-                    gft_found = False
-                    k_found = False
-                    for (label, value) in results:
-                        if 'SBB' in label:
-                            if gft_found is False and label.endswith('totalgft'):
-                                if gft_to_compare < 0:
-                                    gft_to_compare = value
-                                elif gft_to_compare > value:
-                                    with open('diff_in_sbbs_gft.txt', 'a') as f:
-                                        f.write('There is diff in gft between two auctions: ' + str(gft_to_compare) + ' ' + str(value) + '\n')
-                                        f.write(str(results) + '\n')
-                                        if num_of_possible_ps < 10:
-                                            f.write(str(market) + '\n')
-                                    gft_found = True
-                            elif k_found is False and label.endswith('count'):
-                                if k_to_compare < 0:
-                                    k_to_compare = value
-                                elif k_to_compare > value:
-                                    with open('diff_in_sbbs_k.txt', 'a') as f:
-                                        f.write('There is diff in gft between two auctions: ' + str(k_to_compare) + ' ' + str(value) + '\n')
-                                        f.write(str(results) + '\n')
-                                        if num_of_possible_ps < 10:
-                                            f.write(str(market) + '\n')
-                                    k_found = True
-                #results_table.add(OrderedDict(results))
-                #print(results)
-                if len(total_results[str(num_of_possible_ps)]) == 0:
-                    total_results[str(num_of_possible_ps)] = results[0:len(results)]
-                else:
-                    sum_result = total_results[str(num_of_possible_ps)]
-                    for index in range(len(results)):
-                        if index > 3:
-                            sum_result[index] = (results[index][0], sum_result[index][1] + results[index][1])
-            #print(total_results)
+            for (block, _) in enumerate(iteration_blocks(num_of_iterations, block_size)):
+                total_results[num_of_possible_ps] = add_results(total_results.get(num_of_possible_ps), tasks_results[(stock_names[i], num_of_possible_ps, block)])
         print(stock_names[i], end=',')
         #break
     print()
     division_number = num_of_iterations * len(stocks_prices)
     #division_number = num_of_iterations
     for num_of_possible_ps in nums_of_agents:
-        results = total_results[str(num_of_possible_ps)]
+        results = total_results[num_of_possible_ps]
         for index in range(len(results)):
             if 'gftratio' in results[index][0]:
                 results[index] = (results[index][0], padding_zeroes(results[index][1] / division_number, 3))
@@ -228,6 +160,201 @@ def experiment(results_csv_file:str, auction_functions:list, auction_names:str,
         #print(results)
         results_table.add(OrderedDict(results))
     results_table.done()
+    remove(checkpoint_file)
+
+
+worker_stocks_prices = None   # the prices of all the stocks of the current experiment, in the current process
+
+def set_worker_stocks_prices(stocks_prices:list):
+    """
+    Keeps the prices of all stocks in the current (worker) process; used as the initializer of the experiment's tasks.
+    """
+    global worker_stocks_prices
+    worker_stocks_prices = stocks_prices
+
+def stock_experiment_iterations(stock_index:int, *args)->list:
+    """
+    Runs experiment_iterations with the prices of the stock with the given index (see set_worker_stocks_prices).
+    """
+    return experiment_iterations(worker_stocks_prices[stock_index], *args)
+
+
+def experiment_iterations(stock_prices:list, stock_name:str, recipe:tuple, num_of_possible_ps:int, num_of_iterations_in_block:int,
+                          num_of_iterations:int, auction_functions:list, auction_names:list, run_with_stock_prices:bool,
+                          report_diff:bool)->list:
+    """
+    Runs a block of iterations of the experiment, with the prices of a single stock and a fixed number of possible trades.
+    If all the auction functions have batch versions, each auction runs once on the markets of all the iterations.
+    :return: the results of the first iteration, in which the values of the result columns (from the 5th on) are summed over the block.
+    """
+    recipe_sum = sum(recipe)
+    recipe_sum_for_buyer = (recipe_sum-recipe[0])/recipe[0]
+    stock_prices = list(stock_prices)   # it is shuffled below
+    markets_categories = []   # the agent categories of the market of each iteration
+    for iteration in range(num_of_iterations_in_block):
+        categories = []
+        if run_with_stock_prices:
+            while len(stock_prices) < num_of_possible_ps * recipe_sum:
+                stock_prices = stock_prices + stock_prices
+            random.shuffle(stock_prices)
+            index = 0
+            for category in recipe:
+                next_index = index + num_of_possible_ps * category
+                price_sign = recipe_sum_for_buyer if index == 0 else -1
+                #price_value_multiple = -1 * buyer_agent_count if index > 0 else recipe_sum - buyer_agent_count
+                categories.append(AgentCategory("agent", [int(price*price_sign) for price in stock_prices[index:next_index]]))
+                index = next_index
+        else: #prices from random.
+            for index in range(len(recipe)):
+            #for category in recipe:
+                min_value = -100000 if index > 0 else recipe_sum_for_buyer
+                max_value = -1 if index > 0 else 100000 * recipe_sum_for_buyer
+                categories.append(AgentCategory.uniformly_random("agent", num_of_possible_ps*recipe[index],
+                                                                 min_value, max_value))
+        markets_categories.append(categories)
+
+    batch_functions = [batch_auction(auction_function) for auction_function in auction_functions]
+    block_results = None
+    if all(batch_function is not None for batch_function in batch_functions):
+        batch = [numpy.array([categories[i].values for categories in markets_categories]) for i in range(len(recipe))]
+        (_, optimal_counts, optimal_gfts) = batch_optimal_trade(batch, recipe, include_zero_gft_ps=False)
+        (_, optimal_counts_with_gft_zero, optimal_gfts_with_gft_zero) = batch_optimal_trade(batch, recipe)
+        auction_trades = [batch_function(batch, recipe) for batch_function in batch_functions]
+        for (iteration, categories) in enumerate(markets_categories):
+            auction_results = [(trade.num_of_deals()[iteration].item(), trade.gain_from_trade(including_auctioneer=True)[iteration].item(),
+                                trade.gain_from_trade(including_auctioneer=False)[iteration].item()) for trade in auction_trades]
+            results = iteration_results(stock_name, recipe, num_of_possible_ps, num_of_iterations,
+                                        optimal_counts[iteration].item(), optimal_gfts[iteration].item(),
+                                        optimal_counts_with_gft_zero[iteration].item(), optimal_gfts_with_gft_zero[iteration].item(),
+                                        auction_names, auction_results)
+            report_differences(results, Market(categories), num_of_possible_ps, report_diff)
+            block_results = add_results(block_results, results)
+        return block_results
+
+    for categories in markets_categories:
+        market = Market(categories)
+        (optimal_trade, _) = market.optimal_trade(ps_recipe=list(recipe), max_iterations=10000000, include_zero_gft_ps=False)
+        (optimal_trade_with_gft_zero, _) = market.optimal_trade(ps_recipe=list(recipe), max_iterations=10000000)
+        auction_results = []
+        for auction_function in auction_functions:
+            auction_trade = auction_function(market, recipe)
+            auction_results.append((auction_trade.num_of_deals(), auction_trade.gain_from_trade(including_auctioneer=True),
+                                    auction_trade.gain_from_trade(including_auctioneer=False)))
+        results = iteration_results(stock_name, recipe, num_of_possible_ps, num_of_iterations,
+                                    optimal_trade.num_of_deals(), optimal_trade.gain_from_trade(),
+                                    optimal_trade_with_gft_zero.num_of_deals(), optimal_trade_with_gft_zero.gain_from_trade(),
+                                    auction_names, auction_results)
+        report_differences(results, market, num_of_possible_ps, report_diff)
+        #results_table.add(OrderedDict(results))
+        #print(results)
+        block_results = add_results(block_results, results)
+    return block_results
+
+
+def iteration_results(stock_name:str, recipe:tuple, num_of_possible_ps:int, num_of_iterations:int,
+                      optimal_count:int, optimal_gft:float, optimal_count_with_gft_zero:int, optimal_gft_with_gft_zero:float,
+                      auction_names:list, auction_results:list)->list:
+    """
+    :param auction_results: for each auction, a tuple (count, total GFT, market GFT).
+    :return: the list of (column, value) pairs of the results of a single iteration.
+    """
+    recipe_str = ":".join(map(str,recipe))
+    results = [("iterations", num_of_iterations),
+               ("stockname", stock_name),
+               ("recipe", recipe_str),
+               ("numpossibletrades", int(num_of_possible_ps)),
+               ("optimalcount", optimal_count),
+               ("gftratioformula", (optimal_count - 1) * 100 / (optimal_count if min(recipe) == max(recipe) and recipe[0] == 1 else optimal_count + 1) if optimal_count > 1 else 0),
+               ("optimalcountwithgftzero", optimal_count_with_gft_zero),
+               ("optimalgft", optimal_gft),
+               ("optimalgftwithgftzero", optimal_gft_with_gft_zero)]
+    for (auction_name, (count, total_gft, market_gft)) in zip(auction_names, auction_results):
+        results.append((auction_name + "count", count))
+
+        results.append((auction_name + "countratio",
+                        0 if optimal_count==0 else (count / optimal_count_with_gft_zero) * 100))
+        results.append((auction_name + "totalgft", total_gft))
+        results.append((auction_name + "totalgftratio", 0 if optimal_gft==0 else total_gft / optimal_gft_with_gft_zero*100))
+        results.append((auction_name + "marketgft", market_gft))
+        results.append((auction_name + "marketgftratio",
+                        0 if optimal_gft == 0 else market_gft / optimal_gft_with_gft_zero * 100))
+        results.append((auction_name + "withoutgftzerocountratio",
+                        0 if optimal_count==0 else (count / optimal_count) * 100))
+        results.append((auction_name + "withoutgftzerototalgft", total_gft))
+        results.append((auction_name + "withoutgftzerototalgftratio", 0 if optimal_gft==0 else total_gft / optimal_gft*100))
+    return results
+
+
+def report_differences(results:list, market:Market, num_of_possible_ps:int, report_diff:bool):
+    """
+    Writes to files the results of an iteration in which the SBB auctions got different results.
+    """
+    #We check which auction did better and print the market and their results.
+    if report_diff:
+        gft_to_compare = -1
+        k_to_compare = -1
+        gft_found = False
+        k_found = False
+        for (label, value) in results:
+            if 'SBB' in label:
+                if gft_found is False and label.endswith('totalgft'):
+                    if gft_to_compare < 0:
+                        gft_to_compare = value
+                    elif gft_to_compare != value:
+                        with open('diff_in_sbbs_gft.txt', 'a') as f:
+                            f.write('There is diff in gft between two auctions: ' + str(gft_to_compare) + ' ' + str(value) + '\n')
+                            f.write(str(results) + '\n')
+                            if num_of_possible_ps < 10:
+                                f.write(str(market) + '\n')
+                        gft_found = True
+                elif k_found is False and label.endswith('count'):
+                    if k_to_compare < 0:
+                        k_to_compare = value
+                    elif k_to_compare != value:
+                        with open('diff_in_sbbs_k.txt', 'a') as f:
+                            f.write('There is diff in gft between two auctions: ' + str(k_to_compare) + ' ' + str(value) + '\n')
+                            f.write(str(results) + '\n')
+                            if num_of_possible_ps < 10:
+                                f.write(str(market) + '\n')
+                        k_found = True
+    compare_sbbs = True
+    if compare_sbbs:
+        gft_to_compare = -1
+        k_to_compare = -1
+        gft_found = False
+        k_found = False
+        for (label, value) in results:
+            if 'SBB' in label:
+                if gft_found is False and label.endswith('totalgft'):
+                    if gft_to_compare < 0:
+                        gft_to_compare = value
+                    elif gft_to_compare > value:
+                        with open('diff_in_sbbs_gft.txt', 'a') as f:
+                            f.write('There is diff in gft between two auctions: ' + str(gft_to_compare) + ' ' + str(value) + '\n')
+                            f.write(str(results) + '\n')
+                            if num_of_possible_ps < 10:
+                                f.write(str(market) + '\n')
+                        gft_found = True
+                elif k_found is False and label.endswith('count'):
+                    if k_to_compare < 0:
+                        k_to_compare = value
+                    elif k_to_compare > value:
+                        with open('diff_in_sbbs_k.txt', 'a') as f:
+                            f.write('There is diff in gft between two auctions: ' + str(k_to_compare) + ' ' + str(value) + '\n')
+                            f.write(str(results) + '\n')
+                            if num_of_possible_ps < 10:
+                                f.write(str(market) + '\n')
+                        k_found = True
+
+
+def add_results(total_results:list, results:list)->list:
+    """
+    Adds the values of the result columns (from the 5th on) of `results` to `total_results`, which may be None.
+    The first four columns (iterations, stock name, recipe, n) are taken from the first results.
+    """
+    if total_results is None:
+        return list(results)
+    return total_results[0:4] + [(label, value + results[index][1]) for (index, (label, value)) in enumerate(total_results) if index > 3]
 
 
 def padding_zeroes(result, num_digits:int):
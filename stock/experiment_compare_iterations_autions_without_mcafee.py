@@ -40,7 +40,7 @@ from agents import AgentCategory
 
 from tee_table.tee_table import TeeTable
 from collections import OrderedDict
-from get_stocks_data import getStocksPrices
+from get_stocks_data import StockData
 
 
 def experiment(results_csv_file: str, auction_functions: list, auction_names: str, recipe: tuple, nums_of_agents:list = None,
@@ -53,6 +53,7 @@ def experiment(results_csv_file: str, auction_functions: list, auction_names: st
     :param recipe: can be any vector of ones, e.g. (1,1,1), for our trade-reduction mechanism, or any vector of positive integers for our ascending-auction mechanism.
     :param nums_of_agents: list of n(s) for number of possible trades to make the calculations.
     :param stocks_prices: list of prices for each stock and each agent.
+                          If None, the prices are read lazily, one stock at a time, from the stocks directory (see StockData).
     :param stock_names: list of stocks names which prices are belongs, for naming only.
     """
     TABLE_COLUMNS = ["stock_name", "recipe", "num_possible_trades", "optimal_count", "optimal_count_with_gft_zero",
@@ -60,7 +61,9 @@ def experiment(results_csv_file: str, auction_functions: list, auction_names: st
     AUCTION_COLUMNS = ["auction_count", "count_ratio", "gft", "gft_ratio"]
     print(recipe)
     if stocks_prices is None:
-        (stocks_prices, stock_names) = getStocksPrices(recipe)
+        stocks = StockData().prices(recipe)
+    else:
+        stocks = zip(stock_names, stocks_prices)
     column_names = TABLE_COLUMNS
     column_names += [auction_name + '_' + column for auction_name in auction_names for column in AUCTION_COLUMNS]
     results_table = TeeTable(column_names, results_csv_file)
@@ -68,10 +71,10 @@ def experiment(results_csv_file: str, auction_functions: list, auction_names: st
     if nums_of_agents is None:
         nums_of_agents = [10000000]
 
-    for i in range(len(stocks_prices)):
+    for (stock_name, stock_prices) in stocks:
         last_iteration = False
         for num_of_agents_per_category in nums_of_agents:
-            num_of_possible_ps = min(num_of_agents_per_category,len(stocks_prices[i][0]))
+            num_of_possible_ps = min(num_of_agents_per_category,len(stock_prices[0]))
             if last_iteration is True and num_of_possible_ps < num_of_agents_per_category:
                 break
             if num_of_possible_ps < num_of_agents_per_category:
@@ -79,27 +82,27 @@ def experiment(results_csv_file: str, auction_functions: list, auction_names: st
                     break
                 else:
                     last_iteration = True
-                    market = Market([AgentCategory("agent", stocks_prices[i][j]) for j in range(len(stocks_prices[i]))])
+                    market = Market([AgentCategory("agent", stock_prices[j]) for j in range(len(stock_prices))])
             else:
-                market = Market([AgentCategory("agent", stocks_prices[i][j][0:num_of_possible_ps*recipe[j]]) for j in range(len(stocks_prices[i]))])
+                market = Market([AgentCategory("agent", stock_prices[j][0:num_of_possible_ps*recipe[j]]) for j in range(len(stock_prices))])
             (optimal_trade, _) = market.optimal_trade(ps_recipe=list(recipe), max_iterations=10000000, include_zero_gft_ps=False)
             optimal_count = optimal_trade.num_of_deals()
             optimal_gft = optimal_trade.gain_from_trade()
             (optimal_trade_with_gft_zero, _) = market.optimal_trade(ps_recipe=list(recipe), max_iterations=10000000)
             optimal_count_with_gft_zero = optimal_trade_with_gft_zero.num_of_deals()
 
-            results = [("stock_name", stock_names[i]), ("recipe", recipe_str),
+            results = [("stock_name", stock_name), ("recipe", recipe_str),
                        ("num_possible_trades", round(num_of_possible_ps)), ("optimal_count", round(optimal_count,2)),
                        ("optimal_count_with_gft_zero", round(optimal_count_with_gft_zero,2)),
                        ("optimal_gft", round(optimal_gft,2))]
             for auction_index in range(len(auction_functions)):
                 auction_trade = auction_functions[auction_index](market, recipe)
                 auction_count = auction_trade.num_of_deals()
-                # for j in range(len(stocks_prices[i])):
-                #     print(sorted(stocks_prices[i][j][:num_of_possible_ps*recipe[j]]))
+                # for j in range(len(stock_prices)):
+                #     print(sorted(stock_prices[j][:num_of_possible_ps*recipe[j]]))
                 if(auction_trade.num_of_deals() > optimal_trade_with_gft_zero.num_of_deals()):
-                    # print(sorted(stocks_prices[i][0][:num_of_possible_ps*recipe[0]]))
-                    # print(sorted(stocks_prices[i][1][:num_of_possible_ps*recipe[1]]))
+                    # print(sorted(stock_prices[0][:num_of_possible_ps*recipe[0]]))
+                    # print(sorted(stock_prices[1][:num_of_possible_ps*recipe[1]]))
                     print("Warning!!! the number of deals in action is greater than optimal!")
                     print("Optimal num of deals: ", optimal_trade.num_of_deals())
                     print("Auction num of deals: ", auction_trade.num_of_deals())
@@ -25,74 +25,75 @@ sbb_functions = [budget_balanced_trade_reduction, budget_balanced_ascending_auct
 mcafee_functions = [mcafee_trade_reduction, mcafee_without_heuristic]
 mcafee_names = ["McAfee", "McAfeeWithoutHeuristic"]
 num_of_iterations = 30#3
+num_of_workers = None   # the number of processes that run the iterations; None = all CPUs.
+experiment = partial(experiment, num_of_workers=num_of_workers)
 recipes = [(4,3,2,1), (3,2,1), (2,1), (2,2), (2,3), (3,3),
            (3,2,2), (2,2,2), (1,2,3), (4,2,6),
            (10,2,3,4)]
 #recipes = []
-for recipe in recipes:
-    experiment("results/experiment_sbb_with_vectors_of_multi_stock_" + str(recipe).replace(' ', '') + ".csv",
-               sbb_functions,
-               sbb_names,
-               recipe=recipe,
-               nums_of_agents=nums_of_agents,
-               num_of_iterations=num_of_iterations)
-
-    experiment("results/experiment_sbb_with_vectors_of_multi_random_" + str(recipe).replace(' ', '') + ".csv",
-               sbb_functions,
-               sbb_names,
-               recipe=recipe,
-               nums_of_agents=nums_of_agents,
-               run_with_stock_prices=False,
-               num_of_iterations=num_of_iterations)
+if __name__ == "__main__":  # the worker processes may import this module
+    for recipe in recipes:
+        experiment("results/experiment_sbb_with_vectors_of_multi_stock_" + str(recipe).replace(' ', '') + ".csv",
+                   sbb_functions,
+                   sbb_names,
+                   recipe=recipe,
+                   nums_of_agents=nums_of_agents,
+                   num_of_iterations=num_of_iterations)
 
-if False:
-    exit(0)
-experiment("results/experiment_comparing_mcafee_to_sbb_stock.csv",
-           mcafee_functions + sbb_functions,
-           mcafee_names + sbb_names,
-           recipe=(1,1),
-           nums_of_agents = nums_of_agents,
-           num_of_iterations=num_of_iterations)
+        experiment("results/experiment_sbb_with_vectors_of_multi_random_" + str(recipe).replace(' ', '') + ".csv",
+                   sbb_functions,
+                   sbb_names,
+                   recipe=recipe,
+                   nums_of_agents=nums_of_agents,
+                   run_with_stock_prices=False,
+                   num_of_iterations=num_of_iterations)
 
-experiment("results/experiment_comparing_mcafee_to_sbb_random.csv",
-           mcafee_functions + sbb_functions,
-           mcafee_names + sbb_names,
-           recipe=(1,1),
-           nums_of_agents = nums_of_agents,
-           run_with_stock_prices=False,
-           num_of_iterations=num_of_iterations)
-
-for num_of_seller_categories in (2,4,8,16):
-    num_of_categories = num_of_seller_categories+1
-    experiment("results/experiment_sbb_with_vectors_of_ones_stock_shuffled_" + str(num_of_categories) + '.csv',
-               sbb_functions,
-               sbb_names,
-               recipe=num_of_categories*(1,),
+    if False:
+        exit(0)
+    experiment("results/experiment_comparing_mcafee_to_sbb_stock.csv",
+               mcafee_functions + sbb_functions,
+               mcafee_names + sbb_names,
+               recipe=(1,1),
                nums_of_agents = nums_of_agents,
                num_of_iterations=num_of_iterations)
 
-    experiment("results/experiment_sbb_with_vectors_of_ones_random_shuffled_" + str(num_of_categories) + '.csv',
-               sbb_functions,
-               sbb_names,
-               recipe=num_of_categories*(1,),
+    experiment("results/experiment_comparing_mcafee_to_sbb_random.csv",
+               mcafee_functions + sbb_functions,
+               mcafee_names + sbb_names,
+               recipe=(1,1),
                nums_of_agents = nums_of_agents,
                run_with_stock_prices=False,
                num_of_iterations=num_of_iterations)
 
-for num_of_seller_categories in (2,4,8,16):
-    experiment("results/experiment_sbb_with_vectors_of_multi_stock_(1," + str(num_of_seller_categories) + ").csv",
-               sbb_functions,
-               sbb_names,
-               recipe=(1, num_of_seller_categories),
-               nums_of_agents=nums_of_agents,
-               num_of_iterations=num_of_iterations)
+    for num_of_seller_categories in (2,4,8,16):
+        num_of_categories = num_of_seller_categories+1
+        experiment("results/experiment_sbb_with_vectors_of_ones_stock_shuffled_" + str(num_of_categories) + '.csv',
+                   sbb_functions,
+                   sbb_names,
+                   recipe=num_of_categories*(1,),
+                   nums_of_agents = nums_of_agents,
+                   num_of_iterations=num_of_iterations)
 
-    experiment("results/experiment_sbb_with_vectors_of_multi_random_(1," + str(num_of_seller_categories) + ").csv",
-               sbb_functions,
-               sbb_names,
-               recipe=(1, num_of_seller_categories),
-               nums_of_agents=nums_of_agents,
-               run_with_stock_prices=False,
-               num_of_iterations=num_of_iterations)
+        experiment("results/experiment_sbb_with_vectors_of_ones_random_shuffled_" + str(num_of_categories) + '.csv',
+                   sbb_functions,
+                   sbb_names,
+                   recipe=num_of_categories*(1,),
+                   nums_of_agents = nums_of_agents,
+                   run_with_stock_prices=False,
+                   num_of_iterations=num_of_iterations)
 
+    for num_of_seller_categories in (2,4,8,16):
+        experiment("results/experiment_sbb_with_vectors_of_multi_stock_(1," + str(num_of_seller_categories) + ").csv",
+                   sbb_functions,
+                   sbb_names,
+                   recipe=(1, num_of_seller_categories),
+                   nums_of_agents=nums_of_agents,
+                   num_of_iterations=num_of_iterations)
 
+        experiment("results/experiment_sbb_with_vectors_of_multi_random_(1," + str(num_of_seller_categories) + ").csv",
+                   sbb_functions,
+                   sbb_names,
+                   recipe=(1, num_of_seller_categories),
+                   nums_of_agents=nums_of_agents,
+                   run_with_stock_prices=False,
+                   num_of_iterations=num_of_iterations)
@@ -42,7 +42,7 @@ from typing import Callable
 
 from tee_table.tee_table import TeeTable
 from collections import OrderedDict
-from get_stocks_data import getStocksPrices
+from get_stocks_data import StockData
 
 TABLE_COLUMNS = ["stock_name","auction_name", "recipe", "num_possible_trades", "optimal_count", "auction_count",
                  "count_ratio", "optimal_gft", "auction_gft", "auction_gft_ratio", "auction_market_gft", "market_gft_ratio"]
@@ -56,15 +56,18 @@ def experiment(results_csv_file:str, auction_function:Callable, auction_name:str
     :param auction_name: title of the experiment, for printouts.
     :param recipe: can be any vector of ones, e.g. (1,1,1), for our trade-reduction mechanism, or any vector of positive integers for our ascending-auction mechanism.
     :param stocks_prices: list of prices for each stock and each agent.
+                          If None, the prices are read lazily, one stock at a time, from the stocks directory (see StockData).
     :param stock_names: list of stocks names which prices are belongs, for naming only.
     """
     if stocks_prices is None:
-        (stocks_prices, stock_names) = getStocksPrices(recipe)
+        stocks = StockData().prices(recipe)
+    else:
+        stocks = zip(stock_names, stocks_prices)
     results_table = TeeTable(TABLE_COLUMNS, results_csv_file)
     recipe_str = ":".join(map(str,recipe))
-    for i in range(len(stocks_prices)):
-        market = Market([AgentCategory("agent", category) for category in stocks_prices[i]])
-        num_of_possible_ps = min([len(stocks_prices[i][j])/recipe[j] for j in range(len(stocks_prices[i]))])
+    for (stock_name, stock_prices) in stocks:
+        market = Market([AgentCategory("agent", category) for category in stock_prices])
+        num_of_possible_ps = min([len(stock_prices[j])/recipe[j] for j in range(len(stock_prices))])
         (optimal_trade, _) = market.optimal_trade(recipe)
         auction_trade = auction_function(market, recipe)
         optimal_count = optimal_trade.num_of_deals()
@@ -77,7 +80,7 @@ def experiment(results_csv_file:str, auction_function:Callable, auction_name:str
         auction_gft = auction_trade.gain_from_trade(including_auctioneer=True)
         auction_market_gft = auction_trade.gain_from_trade(including_auctioneer=False)
         results_table.add(OrderedDict((
-            ("stock_name", stock_names[i]),
+            ("stock_name", stock_name),
             ("auction_name", auction_name),
             ("recipe", recipe_str),
             ("num_possible_trades", round(num_of_possible_ps)),
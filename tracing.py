@@ -0,0 +1,80 @@
+#!python3
+
+"""
+Structured tracing of the auction protocols.
+
+Besides the text messages of their loggers (which are formatted only when the logger is enabled for INFO),
+the ascending auctions can record a compact trace of their main loop:
+one event (iteration, category, price, size) per price change,
+where category is the category index and size is the number of agents that remain in that category.
+
+Events are recorded only while a TraceBuffer is active:
+
+>>> from agents import AgentCategory
+>>> from markets import Market
+>>> import ascending_auction_protocol
+>>> market = Market([AgentCategory("buyer", [9.,8.]),  AgentCategory("seller", [-4.,-3.])])
+>>> with TraceBuffer() as trace:
+...     trade = ascending_auction_protocol.budget_balanced_ascending_auction(market, [1,1])
+>>> list(trace)
+[(0, 0, 8.0, 1), (1, 1, -8.0, 2)]
+
+When no TraceBuffer is active and the loggers are not enabled for INFO, the protocols do no tracing work at all.
+"""
+
+from array import array
+from typing import *
+
+active_trace = None   # the TraceBuffer that currently records events, or None.
+
+
+class TraceBuffer:
+    """
+    A compact buffer of trace events.
+    The events are kept in four typed arrays rather than as a list of tuples.
+
+    >>> trace = TraceBuffer()
+    >>> trace.record(0, 2, -5, 7); trace.record(1, 0, 3.5, 4)
+    >>> len(trace), trace[1]
+    (2, (1, 0, 3.5, 4))
+    >>> list(trace)
+    [(0, 2, -5.0, 7), (1, 0, 3.5, 4)]
+    """
+    def __init__(self):
+        self.iterations = array('q')
+        self.categories = array('q')
+        self.prices = array('d')
+        self.sizes = array('q')
+        self.previous_trace = None
+
+    def record(self, iteration:int, category_index:int, price:float, size:int):
+        self.iterations.append(iteration)
+        self.categories.append(category_index)
+        self.prices.append(price)
+        self.sizes.append(size)
+
+    def __len__(self):
+        return len(self.iterations)
+
+    def __getitem__(self, index:int)->Tuple[int,int,float,int]:
+        return (self.iterations[index], self.categories[index], self.prices[index], self.sizes[index])
+
+    def __iter__(self):
+        return zip(self.iterations, self.categories, self.prices, self.sizes)
+
+    def __enter__(self):
+        global active_trace
+        self.previous_trace = active_trace
+        active_trace = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_trace
+        active_trace = self.previous_trace
+        self.previous_trace = None
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
@@ -13,7 +13,7 @@ Since: 2019-08
 """
 
 
-import math
+import math, numpy
 from agents import AgentCategory
 from typing import *
 
@@ -57,11 +57,65 @@ class TradeWithMaterialBalance (Trade):
     def __init__(self, procurement_sets:list):
         self.procurement_sets = procurement_sets
 
+    @staticmethod
+    def from_highest_values(highest_values:list, ps_recipe:list, num_of_deals:int):
+        """
+        Construct a trade lazily, without creating a tuple for each deal.
+        :param highest_values: for each category i, a list or NumPy array with the highest num_of_deals*ps_recipe[i] values,
+                               in descending order. Deal j contains the values in indices [j*ps_recipe[i], (j+1)*ps_recipe[i]).
+        The procurement-set tuples are created only when the procurement_sets attribute is accessed (or the trade is printed).
+
+        >>> t = TradeWithMaterialBalance.from_highest_values([[11, 9, 7], [-2, -4, -6, -8, -10, -12]], [1,2], 3)
+        >>> t.num_of_deals(), t.gain_from_trade()
+        (3, -15)
+        >>> t
+        3 deals: [(7, -10, -12), (9, -6, -8), (11, -2, -4)]
+        """
+        trade = TradeWithMaterialBalance(None)
+        trade._highest_values = highest_values
+        trade._ps_recipe = ps_recipe
+        trade._num_of_deals = num_of_deals
+        return trade
+
+    @property
+    def procurement_sets(self)->list:
+        if self._procurement_sets is None:
+            procurement_sets = [tuple(deal_values) for deal_values in self._deals()]
+            procurement_sets.sort(key=lambda ps: sum(ps))  # sort in increasing order of GFT
+            self._procurement_sets = procurement_sets
+        return self._procurement_sets
+
+    @procurement_sets.setter
+    def procurement_sets(self, procurement_sets:list):
+        self._procurement_sets = procurement_sets
+        self._gft_cache = None
+
     def num_of_deals(self):
-        return len(self.procurement_sets)
+        if self._procurement_sets is None:
+            return self._num_of_deals
+        return len(self._procurement_sets)
 
     def gain_from_trade(self):
-        return sum([sum(ps) for ps in self.procurement_sets])
+        if self._procurement_sets is not None:
+            return sum([sum(ps) for ps in self._procurement_sets])
+        if self._gft_cache is None:
+            arrays = [numpy.asarray(values_i) for values_i in self._highest_values]
+            if all(array.dtype.kind in "iu" for array in arrays):  # integers - the order of summation does not matter
+                self._gft_cache = int(sum(array.sum() for array in arrays))
+            else:  # floats - sum in the same order as the procurement-set tuples, to get exactly the same result
+                self._gft_cache = sum(sorted(sum(deal_values) for deal_values in self._deals()))
+        return self._gft_cache
+
+    def _deals(self):
+        """
+        Generates the values of the agents in each deal, in descending order of GFT.
+        """
+        highest_values = [values_i.tolist() if not isinstance(values_i, list) else values_i
+                          for values_i in self._highest_values]
+        for deal in range(self._num_of_deals):
+            yield [value
+                   for (values_i, recipe_i) in zip(highest_values, self._ps_recipe)
+                   for value in values_i[deal*recipe_i:(deal+1)*recipe_i]]
 
     def __repr__(self):
         return "{} deals: {}".format(self.num_of_deals(), self.procurement_sets)
@@ -125,9 +179,9 @@ class TradeWithSinglePrice (Trade):
             category = self.categories[i]
             agents_per_deal = self.ps_recipe[i]
             participating_agents_in_category = agents_per_deal*self.num_of_deals_cache
-            probability_to_participate_in_trade = participating_agents_in_category/len(category.values)
+            probability_to_participate_in_trade = participating_agents_in_category/category.size()
             price_per_agent_per_deal = self.prices[i]
-            gft += sum(category.values)*probability_to_participate_in_trade
+            gft += sum(category.highest_agent_values(category.size()))*probability_to_participate_in_trade
             if not including_auctioneer:
                 gft -= price_per_agent_per_deal*participating_agents_in_category
         return gft
@@ -151,6 +205,77 @@ class TradeWithSinglePrice (Trade):
 
 
 
+class BatchTradeWithSinglePrice:
+    """
+    The results of running an auction on many markets at once
+    (see for example mcafee_protocol.mcafee_trade_reduction_batch).
+    Entry m of each array is the result of the TradeWithSinglePrice of market m.
+
+    self.prices:        an array of shape (num_of_markets, num_of_categories) - the price-vector of each market.
+    self.optimal_count: if given, the number of deals in the optimal trade of each market.
+    self.optimal_gft:   if given, the gain-from-trade of the optimal trade of each market.
+
+    >>> t = BatchTradeWithSinglePrice([3, 0], [[2, -1], [0, 0]], [4., 0.], [1., 0.])
+    >>> len(t), t.num_of_deals().tolist(), t.gain_from_trade().tolist(), t.gain_from_trade(including_auctioneer=False).tolist()
+    (2, [3, 0], [4.0, 0.0], [1.0, 0.0])
+    """
+    def __init__(self, num_of_deals, prices, gft, market_gft, optimal_count=None, optimal_gft=None):
+        self.num_of_deals_array = numpy.asarray(num_of_deals)
+        self.prices = numpy.asarray(prices)
+        self.gft = numpy.asarray(gft)
+        self.market_gft = numpy.asarray(market_gft)
+        self.optimal_count = optimal_count
+        self.optimal_gft = optimal_gft
+
+    @staticmethod
+    def from_traders(categories:list, is_trading:list, ps_recipe:list, prices, optimal_count=None, optimal_gft=None):
+        """
+        The batch version of constructing a TradeWithSinglePrice from the actual traders.
+        :param categories: the per-category value arrays of the markets (see markets.batch_categories).
+        :param is_trading: for each category, a boolean array of the same shape, which marks the agents that trade.
+        The number of deals and the gain-from-trade are calculated exactly as in TradeWithSinglePrice
+        (including the order of summation, so that the results are equal also for float values).
+
+        >>> categories = [numpy.array([[7,4,2], [7,4,3]]), numpy.array([[-1,-3,-5], [-1,-3,-5]])]
+        >>> is_trading = [numpy.array([[True,True,True], [True,True,True]]), numpy.array([[True,True,True], [True,True,False]])]
+        >>> t = BatchTradeWithSinglePrice.from_traders(categories, is_trading, [1,1], [[2,-1], [1,-1]])
+        >>> t.num_of_deals().tolist(), t.gain_from_trade().tolist(), t.gain_from_trade(including_auctioneer=False).tolist()
+        ([3, 2], [4.0, 5.333333333333332], [1.0, 5.333333333333332])
+        """
+        num_of_markets = categories[0].shape[0]
+        prices = numpy.asarray(prices)
+        counts = [mask.sum(axis=1) for mask in is_trading]
+        num_of_deals = numpy.min([count // recipe_i for (count, recipe_i) in zip(counts, ps_recipe) if recipe_i > 0], axis=0)
+        gft = numpy.zeros(num_of_markets)
+        market_gft = numpy.zeros(num_of_markets)
+        for i in range(len(categories)):
+            participating_agents_in_category = ps_recipe[i] * num_of_deals
+            probability_to_participate_in_trade = numpy.divide(participating_agents_in_category, counts[i],
+                                                               out=numpy.zeros(num_of_markets), where=counts[i] > 0)
+            # cumsum adds the values one by one, in descending order, like the built-in sum over the category values:
+            values_sum = numpy.cumsum(numpy.where(is_trading[i], categories[i], 0), axis=1)[:, -1] if categories[i].shape[1] > 0 else 0
+            gft = gft + values_sum * probability_to_participate_in_trade
+            market_gft = market_gft + values_sum * probability_to_participate_in_trade - prices[:, i] * participating_agents_in_category
+        has_deals = num_of_deals > 0
+        return BatchTradeWithSinglePrice(num_of_deals, prices, numpy.where(has_deals, gft, 0), numpy.where(has_deals, market_gft, 0),
+                                         optimal_count, optimal_gft)
+
+    def __len__(self):
+        return len(self.num_of_deals_array)
+
+    def num_of_deals(self):
+        """
+        :return: an array with the number of deals in each market.
+        """
+        return self.num_of_deals_array
+
+    def gain_from_trade(self, including_auctioneer=True):
+        """
+        :return: an array with the gain-from-trade in each market. See TradeWithSinglePrice.gain_from_trade.
+        """
+        return self.gft if including_auctioneer else self.market_gft
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
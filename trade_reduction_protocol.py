@@ -10,10 +10,10 @@ Since:  2019-08
 
 
 from agents import AgentCategory
-from markets import Market
-from trade import TradeWithSinglePrice
+from markets import Market, batch_categories, batch_optimal_trade
+from trade import TradeWithSinglePrice, BatchTradeWithSinglePrice
 
-import logging, sys
+import logging, numpy, sys
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 #logger.setLevel(logging.INFO)
@@ -206,7 +206,7 @@ def budget_balanced_trade_reduction(market:Market, ps_recipe:list, including_gft
     logger.info("\n#### Budget-Balanced Trade Reduction\n")
     logger.info(market)
     (optimal_trade, remaining_market) = market.optimal_trade(ps_recipe)
-    if len(optimal_trade.procurement_sets) == 0:
+    if optimal_trade.num_of_deals() == 0:
         return TradeWithSinglePrice(market.empty_agent_categories(), ps_recipe, [0] * len(ps_recipe))
 
     highest_negative_ps = remaining_market.get_highest_agents(ps_recipe)
@@ -218,10 +218,11 @@ def budget_balanced_trade_reduction(market:Market, ps_recipe:list, including_gft
     for category in remaining_market.categories:
         if len(category)==0:
             category.append(-MAX_VALUE)
-    logger.info("Optimal trade including one highest non-positive trade, by increasing GFT: {}".format(optimal_trade))
-    logger.info("Remaining market: {}".format(remaining_market))
+    logger.info("Optimal trade including one highest non-positive trade, by increasing GFT: %s", optimal_trade)
+    logger.info("Remaining market: %s", remaining_market)
 
     actual_traders = market.empty_agent_categories()
+    actual_traders_values = [[] for _ in range(market.num_categories)]   # appended to actual_traders in bulk at the end
 
     # Preparing the order of pivot index for trade_reduction
     pivot_indexes = []
@@ -239,26 +240,26 @@ def budget_balanced_trade_reduction(market:Market, ps_recipe:list, including_gft
     for ps in list_ps_to_compete:
         ps = list(ps)
         if latest_prices is None:
-            logger.info("\nCalculating prices for PS {}:".format(ps))
+            logger.info("\nCalculating prices for PS %s:", ps)
             for pivot_index in pivot_indexes:
                 pivot_value = ps[pivot_index]
                 if found_external:
-                    actual_traders[pivot_index_to_category_index[pivot_index]].append(pivot_value)
+                    actual_traders_values[pivot_index_to_category_index[pivot_index]].append(pivot_value)
                     continue
                 pivot_category_index = convert_category_index(ps_recipe, pivot_index)
                 pivot_category = market.categories[pivot_category_index]
-                logger.info("  Looking for external competition to {} with value {}:".
-                            format(pivot_category.name, pivot_value))
+                logger.info("  Looking for external competition to %s with value %s:",
+                            pivot_category.name, pivot_value)
                 best_containing_PS = remaining_market.best_containing_PS(pivot_category_index, pivot_value)
                 best_containing_GFT = sum([best_containing_PS[i]*ps_recipe[i] for i in range(len(best_containing_PS))])
                 if best_containing_GFT > 0 or (including_gft_0 and best_containing_GFT == 0):  # EXTERNAL COMPETITION - KEEP TRADER
                     found_external = True
-                    logger.info("    best PS is {},{} with GFT {}. It is positive so it is an external competition.".
-                                format(best_containing_PS, ps_recipe, best_containing_GFT))
+                    logger.info("    best PS is %s,%s with GFT %s. It is positive so it is an external competition.",
+                                best_containing_PS, ps_recipe, best_containing_GFT)
                     prices = market.calculate_prices_by_external_competition(pivot_category_index, pivot_value, best_containing_PS, ps_recipe)
-                    logger.info("    Prices are {}".format(prices))
+                    logger.info("    Prices are %s", prices)
                     latest_prices = prices
-                    actual_traders[pivot_index_to_category_index[pivot_index]].append(pivot_value)
+                    actual_traders_values[pivot_index_to_category_index[pivot_index]].append(pivot_value)
                     #for i in range(len(prices)):
                     #    agent_prices = market.categories[i].values
                     #    for value in agent_prices:
@@ -267,25 +268,143 @@ def budget_balanced_trade_reduction(market:Market, ps_recipe:list, including_gft
                     #            actual_traders[i].append(value)
                     #break  # done with current PS - move to next PS
                 else:  # NO EXTERNAL COMPETITION - REMOVE TRADER
-                    logger.info("    Best PS is {},{} with GFT {}. It is negative so it is not an external competition.".
-                                format(best_containing_PS, ps_recipe, best_containing_GFT))
-                    logger.info("    Remove {} {} from trade and add to remaining market".
-                                format(pivot_category.name, pivot_value))
+                    logger.info("    Best PS is %s,%s with GFT %s. It is negative so it is not an external competition.",
+                                best_containing_PS, ps_recipe, best_containing_GFT)
+                    logger.info("    Remove %s %s from trade and add to remaining market",
+                                pivot_category.name, pivot_value)
                     ps[pivot_index] = None
                     remaining_market.append_trader(pivot_category_index, pivot_value)
-                    logger.info("    Remaining market is now: {}".format(remaining_market))
+                    logger.info("    Remaining market is now: %s", remaining_market)
         else:
-            logger.info("\nPrices for PS {} are {}".format(ps, latest_prices))
+            logger.info("\nPrices for PS %s are %s", ps, latest_prices)
             #print(pivot_index_to_category_index)
             for pivot_index in pivot_indexes:
                 pivot_value = ps[pivot_index]
-                actual_traders[pivot_index_to_category_index[pivot_index]].append(pivot_value)
+                actual_traders_values[pivot_index_to_category_index[pivot_index]].append(pivot_value)
+    for (category, values) in zip(actual_traders, actual_traders_values):
+        category.append(values)
     logger.info("\n")
     result = TradeWithSinglePrice(actual_traders, ps_recipe, latest_prices)
     logger.info(result)
     return result
 
 
+def budget_balanced_trade_reduction_batch(values, ps_recipe:list, including_gft_0:bool = True)->BatchTradeWithSinglePrice:
+    """
+    Runs budget_balanced_trade_reduction on many markets of the same shape at once.
+    The markets go through the pivots in lock-step: in each step, the next pivot of every market
+    that has not found external competition yet is checked against the highest remaining agents of the other categories.
+    :param values: the values of the markets - a list with an array of shape (num_of_markets, n_i) per category,
+                   or an array of shape (num_of_markets, num_of_categories, n); see markets.batch_categories.
+                   The values of each category in each market should be sorted in descending order.
+    :param ps_recipe: a list of positive integers, one integer per category.
+    :return: a BatchTradeWithSinglePrice, whose entry m is equal to the result of budget_balanced_trade_reduction on market m,
+             with the optimal count and GFT of each market. The prices of a market without external competition are NaN.
+
+    >>> values = [numpy.array([[9., 8.], [9., 8.], [9., 4.]]), numpy.array([[-3., -4.], [-7., -8.], [-3., -8.]])]
+    >>> trade = budget_balanced_trade_reduction_batch(values, [1,1])
+    >>> trade.num_of_deals().tolist(), trade.prices.tolist()
+    ([1, 1, 1], [[8.0, -8.0], [8.0, -8.0], [8.0, -8.0]])
+    >>> trade.gain_from_trade().tolist(), trade.optimal_count.tolist()
+    ([5.5, 1.5, 6.0], [2, 2, 1])
+
+    The results are the same as those of budget_balanced_trade_reduction on each market:
+
+    >>> generator = numpy.random.default_rng(1)
+    >>> values = [-numpy.sort(-generator.integers(0, 100, (200, 10))), -numpy.sort(-generator.integers(-50, 0, (200, 20)))]
+    >>> trade = budget_balanced_trade_reduction_batch(values, [1,2])
+    >>> single_trades = [budget_balanced_trade_reduction(Market([AgentCategory("buyer", values[0][m]), AgentCategory("seller", values[1][m])]), [1,2]) for m in range(200)]
+    >>> all(single.num_of_deals() == trade.num_of_deals()[m] and single.gain_from_trade() == trade.gain_from_trade()[m]
+    ...     and single.gain_from_trade(including_auctioneer=False) == trade.gain_from_trade(including_auctioneer=False)[m]
+    ...     for (m, single) in enumerate(single_trades))
+    True
+    """
+    categories = batch_categories(values, ps_recipe)
+    if any(r < 1 for r in ps_recipe):
+        raise ValueError("The batch trade-reduction protocol supports only positive recipes; {} was given".format(ps_recipe))
+    num_of_markets = categories[0].shape[0]
+    num_of_categories = len(categories)
+    (ps_gft, optimal_count, optimal_gft) = batch_optimal_trade(categories, ps_recipe)
+    max_num_of_deals = ps_gft.shape[1]
+    has_trade = optimal_count > 0
+    has_negative_ps = optimal_count < max_num_of_deals   # otherwise, the highest non-positive PS is incomplete
+    markets = numpy.arange(num_of_markets)
+
+    # The PS-s to compete, by their deal index: the highest non-positive PS (if any),
+    # and then the optimal PS-s in increasing order of GFT (sorted stably, like the optimal trade).
+    in_optimal_trade = numpy.arange(max_num_of_deals) < optimal_count[:, None]
+    sort_key = numpy.where(in_optimal_trade, ps_gft.astype(float), numpy.inf)
+    optimal_order = numpy.argsort(sort_key, axis=1, kind="stable")
+    ps_order = numpy.where(has_negative_ps[:, None],
+                           numpy.concatenate((optimal_count[:, None], optimal_order[:, :-1]), axis=1) if max_num_of_deals > 0 else optimal_order,
+                           optimal_order)
+    num_of_ps_to_compete = optimal_count + has_negative_ps
+    # order_of_deal[m,d] = the position of deal d in ps_order[m], or -1 if it does not compete (an extra column for the agents beyond the last deal).
+    order_of_deal = numpy.full((num_of_markets, max_num_of_deals+1), -1)
+    for position in range(max_num_of_deals):
+        competes = position < num_of_ps_to_compete
+        order_of_deal[markets[competes], ps_order[competes, position]] = position
+
+    # The highest value in each category of the remaining market (-MAX_VALUE if it is empty):
+    num_of_deals_removed = optimal_count + has_negative_ps
+    highest_remaining = numpy.stack([
+        numpy.take_along_axis(numpy.concatenate((category, numpy.full((num_of_markets, 1), -MAX_VALUE, dtype=category.dtype)), axis=1),
+                              (num_of_deals_removed * recipe_i)[:, None], axis=1)[:, 0]
+        for (category, recipe_i) in zip(categories, ps_recipe)], axis=1)
+    if highest_remaining.dtype.kind != "f":
+        highest_remaining = highest_remaining.astype(numpy.int64)
+
+    # Preparing the order of pivot index for trade_reduction: the agents of each category, from the lowest to the highest.
+    pivots = [(category_index, offset) for (category_index, recipe_i) in enumerate(ps_recipe) for offset in range(recipe_i-1, -1, -1)]
+    num_of_pivots = len(pivots)
+    found_position = numpy.full(num_of_markets, -1)   # the position of the PS in which external competition was found
+    found_pivot = numpy.full(num_of_markets, -1)      # the pivot in that PS
+    prices = numpy.full((num_of_markets, num_of_categories), numpy.nan)
+    for step in range(max_num_of_deals * num_of_pivots):
+        (position, pivot) = divmod(step, num_of_pivots)
+        active = markets[has_trade & (found_position < 0) & (position < num_of_ps_to_compete)]
+        if len(active) == 0:
+            if position >= num_of_ps_to_compete.max(initial=0):
+                break
+            continue
+        (pivot_category_index, offset) = pivots[pivot]
+        recipe_p = ps_recipe[pivot_category_index]
+        pivot_value = categories[pivot_category_index][active, ps_order[active, position] * recipe_p + offset]
+        # The GFT of the best PS that contains the pivot agent, summed like in budget_balanced_trade_reduction:
+        best_containing_values = [pivot_value if i == pivot_category_index else highest_remaining[active, i] for i in range(num_of_categories)]
+        best_containing_GFT = best_containing_values[0] * ps_recipe[0]
+        for i in range(1, num_of_categories):
+            best_containing_GFT = best_containing_GFT + best_containing_values[i] * ps_recipe[i]
+        is_external = (best_containing_GFT > 0) | (including_gft_0 & (best_containing_GFT == 0))
+        found = active[is_external]
+        found_position[found] = position
+        found_pivot[found] = pivot
+        for i in range(num_of_categories):
+            if i == pivot_category_index:
+                prices[found, i] = ((pivot_value*recipe_p - best_containing_GFT) / recipe_p)[is_external]
+            else:
+                prices[found, i] = highest_remaining[found, i]
+        not_found = active[~is_external]   # the pivot agent is removed from the trade and added to the remaining market
+        highest_remaining[not_found, pivot_category_index] = numpy.maximum(
+            highest_remaining[not_found, pivot_category_index], pivot_value[~is_external])
+
+    # The traders are the agents of the PS-s after the one in which external competition was found,
+    # and the agents of that PS from the pivot on (a category with a larger index, or a higher agent of the same category).
+    prices[~has_trade] = 0
+    is_found = found_position >= 0
+    found_category = numpy.array([category_index for (category_index, _) in pivots])[numpy.maximum(found_pivot, 0)]
+    found_offset = numpy.array([offset for (_, offset) in pivots])[numpy.maximum(found_pivot, 0)]
+    is_trading = []
+    for (category_index, (category, recipe_i)) in enumerate(zip(categories, ps_recipe)):
+        agents = numpy.arange(category.shape[1])
+        position_of_agent = order_of_deal[:, numpy.minimum(agents // recipe_i, max_num_of_deals)]
+        is_in_found_ps_from_pivot = (position_of_agent == found_position[:, None]) & (
+            (category_index > found_category[:, None]) |
+            ((category_index == found_category[:, None]) & (agents % recipe_i <= found_offset[:, None])))
+        is_trading.append(is_found[:, None] & ((position_of_agent > found_position[:, None]) | is_in_found_ps_from_pivot))
+    return BatchTradeWithSinglePrice.from_traders(categories, is_trading, ps_recipe, prices, optimal_count, optimal_gft)
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)